@@ -18,26 +18,60 @@ from .gje_prop import Reason_GJE
 from .gje_prop_n import State_GJE
 from .gje_simplex import Simplex_GJE
 from .gje_xorsat import XorSat_GJE
+from .gje_watch import Watch_GJE
 from .up_total import UPTotalPropagator
 from .tree_check import TreeCheckPropagator
 from random import sample
 import sys as _sys
-import os as _os
 import clingo as _clingo
 from textwrap import dedent as _dedent
+from collections import Counter as _Counter
 
-def translate_binary_xor(backend, lhs, rhs):
+def translate_binary_xor(backend, lhs, rhs, memo=None):
+    """
+    Returns a literal equivalent to the XOR of the given literals. With a
+    memo, pairs of the same variables share one atom, which is negated if
+    exactly one of the literals is negative.
+    """
+    if memo is not None:
+        key = (min(abs(lhs), abs(rhs)), max(abs(lhs), abs(rhs)))
+        aux = memo.get(key)
+        if aux is None:
+            aux = memo[key] = translate_binary_xor(backend, *key)
+        return -aux if (lhs < 0) != (rhs < 0) else aux
     aux = backend.add_atom()
     backend.add_rule([aux], [ lhs, -rhs])
     backend.add_rule([aux], [-lhs,  rhs])
     return aux
 
-def transform(prg, files):
+def add_parity_nogoods(backend, literals, parity):
+    """
+    Add a nogood for each assignment of the literals whose number of true
+    literals does not have the given parity.
+    """
+    for signs in util.product((1, -1), repeat=len(literals)):
+        if signs.count(1) % 2 != parity:
+            backend.add_rule([], [sign * lit for sign, lit in zip(signs, literals)])
+
+def translate_chunked_xor(backend, literals, k):
+    """
+    Add nogoods for a XOR constraint with odd parity cut into chunks of at
+    most k literals. Each chunk but the last ends in a fresh atom equivalent
+    to the XOR of its other literals, which starts the next chunk.
+    """
+    while len(literals) > k:
+        aux = backend.add_atom()
+        backend.add_rule([aux], [], True)
+        add_parity_nogoods(backend, literals[:k-1] + [aux], 0)
+        literals = [aux] + literals[k-1:]
+    add_parity_nogoods(backend, literals, 1)
+
+def transform(prg, files, name=_tf.g_aux_name):
     with prg.builder() as b:
         files = [open(f) for f in files]
         if len(files) == 0:
             files.append(_sys.stdin)
-        _tf.transform((f.read() for f in files), b.add)
+        _tf.transform((f.read() for f in files), b.add, name)
 
 def normal_form(prg, files):
     with prg.builder() as b:
@@ -50,7 +84,7 @@ class Leaf:
     def __init__(self, atom):
         self.__atom = atom
 
-    def translate(self, backend):
+    def translate(self, backend, memo=None):
         return self.__atom
 
 class Tree:
@@ -58,20 +92,73 @@ class Tree:
         self.__lhs = lhs
         self.__rhs = rhs
 
-    def translate(self, backend):
-        lhs = self.__lhs.translate(backend)
-        rhs = self.__rhs.translate(backend)
-        return translate_binary_xor(backend, lhs, rhs)
+    def translate(self, backend, memo=None):
+        lhs = self.__lhs.translate(backend, memo)
+        rhs = self.__rhs.translate(backend, memo)
+        return translate_binary_xor(backend, lhs, rhs, memo)
 
 class List:
     def __init__(self, literals):
         assert(len(literals) > 0)
         self.__literals = literals
 
-    def translate(self, backend):
-        return util.reduce(lambda l, r: translate_binary_xor(backend, l, r), self.__literals)
+    def translate(self, backend, memo=None):
+        return util.reduce(lambda l, r: translate_binary_xor(backend, l, r, memo), self.__literals)
 
-def translate(mode, prg, cutoff):
+def get_program_lit(atom):
+    return atom.literal, True if atom.is_fact else None
+
+def translate_rules(mode, prg, chunk=4, ids=None, definitions=None):
+    """
+    Translate the parity constraints with the given identifiers, all if None,
+    to rules ("list" or "tree") or nogoods ("cnf") using the backend.
+
+    With definitions observed while grounding, the element atoms are replaced
+    by the literals of their conditions. The rules of equal subterms are
+    shared. To find more of them, the literals of each constraint are ordered
+    by decreasing number of occurrences of their variables in all
+    constraints.
+    """
+    def to_tree(constraint):
+        layer = [Leaf(literal) for literal in constraint]
+        def tree(l, r):
+            return l if r is None else Tree(l, r)
+        while len(layer) > 1:
+            layer = list(util.starmap(tree, util.zip_longest(layer[0::2], layer[1::2])))
+        return layer[0]
+
+    get_lit = get_program_lit
+    if definitions is not None:
+        def get_lit(atom):
+            lit, truth = get_program_lit(atom)
+            return definitions.alias(lit), truth
+
+    ret = util.symbols_to_xor_r(prg.symbolic_atoms, get_lit, ids)
+    with prg.backend() as b:
+        if ret is None:
+            b.add_rule([], [])
+        else:
+            constraints, facts = ret
+            for fact in facts:
+                b.add_rule([], [-fact])
+            memo = {}
+            occurrences = _Counter(abs(lit) for constraint in constraints for lit in constraint)
+            for constraint in constraints:
+                if mode == "cnf":
+                    translate_chunked_xor(b, constraint, chunk)
+                    continue
+                constraint = sorted(constraint, key=lambda lit: (-occurrences[abs(lit)], abs(lit)))
+                tree = List(constraint) if mode == "list" else to_tree(constraint)
+                b.add_rule([], [-tree.translate(b, memo)])
+
+def translate(mode, prg, cutoff, backoff=64, trigger="change", heuristic=0.0, chunk=4, size=5, overlap=3, definitions=None):
+    """
+    Translate the parity constraints according to the given mode. Returns the
+    list of registered propagators, which is empty if the constraints are
+    rewritten. The rewriting modes can use a util.Definitions observer
+    registered before grounding.
+    """
+    propagators = []
     if mode == "count":
         prg.add("__count", [], _dedent("""\
             :- { __parity(ID,even,X) } = N, N\\2!=0, __parity(ID,even).
@@ -80,56 +167,52 @@ def translate(mode, prg, cutoff):
         prg.ground([("__count", [])])
 
     elif mode == "countp":
-        prg.register_propagator(CountCheckPropagator())
+        propagators.append(CountCheckPropagator())
 
     elif mode == "up":
-        prg.register_propagator(UnitPropagator())
+        propagators.append(UnitPropagator(heuristic))
 
     elif mode == "gje-prop":
-        prg.register_propagator(Reason_GJE(cutoff))
+        propagators.append(Reason_GJE(cutoff, backoff, trigger, heuristic))
 
     elif mode == "gje-prop-n":
-        prg.register_propagator(State_GJE(cutoff))
+        propagators.append(State_GJE(cutoff, backoff, trigger, heuristic))
 
     elif mode == "gje-simplex":
-        prg.register_propagator(Simplex_GJE(cutoff))
+        propagators.append(Simplex_GJE(cutoff))
 
     elif mode == "gje-xorsat":
-        prg.register_propagator(XorSat_GJE())
+        propagators.append(XorSat_GJE())
+
+    elif mode == "gje-watch":
+        propagators.append(Watch_GJE())
 
     elif mode == "up-check":
-        prg.register_propagator(UPTotalPropagator())
+        propagators.append(UPTotalPropagator())
 
     elif mode == "tree-check":
-        prg.register_propagator(TreeCheckPropagator())
+        propagators.append(TreeCheckPropagator())
 
-    elif mode in ["list", "tree"]:
-        def to_tree(constraint):
-            layer = [Leaf(literal) for literal in constraint]
-            def tree(l, r):
-                return l if r is None else Tree(l, r)
-            while len(layer) > 1:
-                layer = list(util.starmap(tree, util.zip_longest(layer[0::2], layer[1::2])))
-            return layer[0]
+    elif mode in ["list", "tree", "cnf"]:
+        translate_rules(mode, prg, chunk, None, definitions)
 
-        def get_lit(atom):
-            return atom.literal, True if atom.is_fact else None
-
-        ret = util.symbols_to_xor_r(prg.symbolic_atoms, get_lit)
-        with prg.backend() as b:
-            if ret is None:
-                b.add_rule([], [])
-            else:
-                constraints, facts = ret
-                for fact in facts:
-                    b.add_rule([], [-fact])
-                for constraint in constraints:
-                    tree = List(constraint) if mode == "list" else to_tree(constraint)
-                    b.add_rule([], [-tree.translate(b)])
+    elif mode == "hybrid":
+        ## Short constraints become nogoods, overlapping groups use GJE, and
+        ## the remaining long constraints unit propagation
+        nogoods, up, gje = util.select_approaches(util.symbols_to_variables(prg.symbolic_atoms, get_program_lit), size, overlap)
+        translate_rules("cnf", prg, chunk, set(nogoods), definitions)
+        if up:
+            propagators.append(UnitPropagator(heuristic, set(up)))
+        if gje:
+            propagators.append(Reason_GJE(cutoff, backoff, trigger, heuristic, set(gje)))
 
     else:
         raise RuntimeError("unknow transformation mode: {}".format(mode))
 
+    for propagator in propagators:
+        prg.register_propagator(propagator)
+    return propagators
+
 class Application:
     """
     Application object as accepted by clingo.clingo_main().
@@ -147,6 +230,12 @@ class Application:
         self.version = "1.0"
         self.__approach = "count"
         self.__cutoff = 0.0
+        self.__backoff = 64
+        self.__trigger = "change"
+        self.__heuristic = 0.0
+        self.__chunk = 4
+        self.__size = 5
+        self.__overlap = 3
         self.__s = 0
         self.__q = 0.5
         self.__sampling = _clingo.Flag(False)
@@ -159,7 +248,7 @@ class Application:
         Parse approach argument.
         """
         self.__approach = str(value)
-        return self.__approach in ["count", "list", "tree", "countp", "up", "gje-prop", "gje-prop-n", "gje-simplex", "gje-xorsat", "up-check", "tree-check"]
+        return self.__approach in ["count", "list", "tree", "cnf", "hybrid", "countp", "up", "gje-prop", "gje-prop-n", "gje-simplex", "gje-xorsat", "gje-watch", "up-check", "tree-check"]
 
     def __parse_cutoff(self, value):
         """
@@ -168,6 +257,48 @@ class Application:
         self.__cutoff = float(value)
         return self.__cutoff >=0.0 and self.__cutoff <=1.0
 
+    def __parse_backoff(self, value):
+        """
+        Parse backoff argument.
+        """
+        self.__backoff = int(value)
+        return self.__backoff >= 0
+
+    def __parse_trigger(self, value):
+        """
+        Parse trigger argument.
+        """
+        self.__trigger = str(value)
+        return self.__trigger in ["change", "batch", "fixpoint", "total"]
+
+    def __parse_heuristic(self, value):
+        """
+        Parse heuristic argument.
+        """
+        self.__heuristic = float(value)
+        return self.__heuristic >= 0.0 and self.__heuristic <= 1.0
+
+    def __parse_chunk(self, value):
+        """
+        Parse chunk argument.
+        """
+        self.__chunk = int(value)
+        return self.__chunk >= 3
+
+    def __parse_size(self, value):
+        """
+        Parse size argument.
+        """
+        self.__size = int(value)
+        return self.__size >= 0
+
+    def __parse_overlap(self, value):
+        """
+        Parse overlap argument.
+        """
+        self.__overlap = int(value)
+        return self.__overlap >= 1
+
     def __parse_s(self, value):
         """
         Parse s value as the number of xor constraints.
@@ -198,17 +329,51 @@ class Application:
         group = "Xorro Options"
         options.add(group, "approach", _dedent("""\
         Approach to handle XOR constraints [count]
-              <arg>: {count|list|tree|countp|up|gje}
+              <arg>: {count|list|tree|cnf|hybrid|countp|up|gje|gje-watch}
                 count      : Add count aggregates modulo 2
                 {list,tree}: Translate binary XOR operators to rules
                              (binary operators are arranged in list/tree)
+                cnf        : Add nogoods for chunks of XOR constraints
+                             linked by auxiliary atoms
+                hybrid     : Choose cnf, up, or gje-prop per constraint
+                             by its size and overlap with others
                 countp     : Propagator simply counting assigned literals
                 up         : Propagator implementing unit propagation
-                gje        : Propagator implementing Gauss-Jordan Elimination"""), self.__parse_approach)
+                gje        : Propagator implementing Gauss-Jordan Elimination
+                gje-watch  : Propagator keeping the reduced matrix with two
+                             watched columns per row"""), self.__parse_approach)
         
         options.add(group, "cutoff", _dedent("""\
         Percentage of literals assigned before GJE [0-1]"""), self.__parse_cutoff)
 
+        options.add(group, "backoff", _dedent("""\
+        Maximum number of GJE calls skipped after calls deducing nothing.
+        Default=64, 0 (GJE on every call)"""), self.__parse_backoff)
+
+        options.add(group, "trigger", _dedent("""\
+        When to run GJE in gje-prop and gje-prop-n [change]
+              <arg>: {change|batch|fixpoint|total}
+                change  : Whenever a XOR constraint becomes unit
+                batch   : Once per propagate call
+                fixpoint: Once per propagation fixpoint
+                total   : Only on total assignments"""), self.__parse_trigger)
+
+        options.add(group, "xor-heuristic", _dedent("""\
+        Ratio of decisions made on XOR variables in up, gje-prop and
+        gje-prop-n, the others are left to clasp [0-1]. Default=0"""), self.__parse_heuristic)
+
+        options.add(group, "chunk", _dedent("""\
+        Maximum number of literals per chunk in cnf, each chunk adds
+        2^(<n>-1) nogoods. Default=4, at least 3"""), self.__parse_chunk)
+
+        options.add(group, "hybrid-size", _dedent("""\
+        Maximum number of literals of XOR constraints translated to nogoods
+        in hybrid. Default=5"""), self.__parse_size)
+
+        options.add(group, "hybrid-overlap", _dedent("""\
+        Minimum number of XOR constraints sharing variables handled by GJE in
+        hybrid. Default=3"""), self.__parse_overlap)
+
         options.add_flag(group, "sampling", _dedent("""\
         Enable sampling by generating random XOR constraints"""), self.__sampling)
 
@@ -242,97 +407,96 @@ class Application:
         #normal_form(prg,files)
 
         """
-        Sampling features before grounding/solving
-        Building random parity constraints and configure clingo control
+        Parse and ground the input once. With preprocessing, the parity
+        constraints are extracted from the ground program, passed through
+        sampling, GJE and split in memory, and grounded as a separate program.
         """
-        
-        if self.__sampling.value:
-            selected = []
-            requested_models = int(str(prg.configuration.solve.models))
-            prg.configuration.solve.models = 0
-
-            s = self.__s
-            q = self.__q
-
-            cl = _clingo.Control()
-            xors = util.generate_random_xors(cl, files, s, q)
-            if self.__display.value:
-                print(xors)
-            files.append("examples/__temp_xors.lp")
-
-        """
-        GJE preprocessing
-        """
-        if self.__pre_gje.value:
-            print("Performing GJE preprocessing")
-            cl = _clingo.Control()
-            xors_lits, xors_parities, all_lits = util.get_xors(cl, files)
-            prepro_xors, prepro_pars = util.pre_gje(xors_lits, xors_parities, all_lits, self.__display.value)
-
-            xors = ""
-            for i in range(len(prepro_xors)):
-                xors = util.build_theory_atoms(xors,prepro_xors[i], prepro_pars[i])
-            if self.__display.value:
-                ## Display all the XORs after the GJE preprocessing
-                print("Simplified parity constraints after GJE")
-                print(xors)
-
-            ## Update the files
-            files = util.write_file("examples/__pre_gje_.lp", files, xors, "")
-            ## Remove the file
-            
-        """
-        Split preprocessing
-        """
-        if self.__split >=2:
-            print("Splitting XORs")
-            choice_rule = [None]
-            cl = _clingo.Control()
-            xors_lits, xors_parities, all_lits = util.get_xors(cl, files)
-
-            if self.__display.value:
-                print("Total number of XORs: %s"%len(xors_lits))
-
-            prepro_xors, prepro_pars, choice_rule, splitted = util.split(xors_lits, xors_parities, self.__split, self.__display.value)
-
-            xors = ""
-            for i in range(len(prepro_xors)):
-                xors = util.build_theory_atoms(xors,prepro_xors[i], prepro_pars[i])
-            if self.__display.value:
-                if splitted:
-                    ## Display all the XORs after the split
-                    print("")
-                    print("Splitted parity constraints")
-                else:
-                    print("")
-                    print("No parity constraint was split")
-                print(xors)
-                for choice in choice_rule:
-                    print(choice)
-
-            if splitted:
-                ## Update the files
-                files = util.write_file("examples/__split_.lp", files, xors, choice_rule)
-        
+        preprocessing = self.__sampling.value or self.__pre_gje.value or self.__split >= 2
+        definitions = None
+        if preprocessing or self.__approach in ["list", "tree", "cnf", "hybrid"]:
+            definitions = util.Definitions()
+            prg.register_observer(definitions)
+        transform(prg, files, _tf.g_pre_name if preprocessing else _tf.g_aux_name)
+        prg.ground([("base", [])])
+
+        if preprocessing:
+            ## Variables are replaced by the literals of the conditions if
+            ## these are atoms, so that they can be shared between constraints
+            symbols = dict((atom.literal, str(atom.symbol)) for atom in prg.symbolic_atoms)
+            def get_lit(atom):
+                lit, truth = get_program_lit(atom)
+                alias = definitions.alias(lit)
+                return alias if abs(alias) in symbols else lit, truth
+
+            xors = util.xor_r_to_xors(util.symbols_to_xor_r(prg.symbolic_atoms, get_lit, name=_tf.g_pre_name))
+            choice_rule = []
+
+            """
+            Sampling features before solving
+            Building random parity constraints and configure clingo control
+            """
+            if self.__sampling.value:
+                selected = []
+                requested_models = int(str(prg.configuration.solve.models))
+                prg.configuration.solve.models = 0
+
+                variables = [atom.literal for atom in prg.symbolic_atoms if atom.is_fact is False and atom.symbol.name != _tf.g_pre_name]
+                random_xors = xors.empty()
+                util.random_parities(random_xors, variables, self.__s, self.__q)
+                if self.__display.value:
+                    print(random_xors.theory_atoms(symbols))
+                for i in range(len(random_xors)):
+                    xors.add(*random_xors[i])
+
+            """
+            GJE preprocessing
+            """
+            if self.__pre_gje.value:
+                print("Performing GJE preprocessing")
+                xors = util.pre_gje(xors, self.__display.value)
+                if self.__display.value:
+                    ## Display all the XORs after the GJE preprocessing
+                    print("Simplified parity constraints after GJE")
+                    print(xors.theory_atoms(symbols))
+
+            """
+            Split preprocessing
+            """
+            if self.__split >= 2:
+                print("Splitting XORs")
+                if self.__display.value:
+                    print("Total number of XORs: %s"%len(xors))
+
+                xors, choice_rule, splitted = util.split(xors, self.__split, self.__display.value)
+                if self.__display.value:
+                    if splitted:
+                        ## Display all the XORs after the split
+                        print("")
+                        print("Splitted parity constraints")
+                    else:
+                        print("")
+                        print("No parity constraint was split")
+                    print(xors.theory_atoms(symbols))
+                    for choice in choice_rule:
+                        print(choice)
+
+            prg.add("__preprocessed", [], util.parities_to_program(xors, symbols, choice_rule, _tf.g_aux_name))
+            prg.ground([("__preprocessed", [])])
+
         """
         Standard xorro workflow
         """
-        transform(prg,files)
-        prg.ground([("base", [])])
-        translate(self.__approach, prg, self.__cutoff)
-        ret = prg.solve(None, lambda model: models.append(model.symbols(shown=True)))
-
-        ## Remove temp files
-        if _os.path.exists("examples/__pre_gje_.lp"):
-            _os.remove("examples/__pre_gje_.lp")
-        if _os.path.exists("examples/__split_.lp"):
-            _os.remove("examples/__split_.lp")
-        
+        propagators = translate(self.__approach, prg, self.__cutoff, self.__backoff, self.__trigger, self.__heuristic, self.__chunk, self.__size, self.__overlap, definitions)
+        def on_statistics(step, accu):
+            for propagator in propagators:
+                if hasattr(propagator, "on_statistics"):
+                    propagator.on_statistics(step, accu)
+        ret = prg.solve(None, lambda model: models.append(model.symbols(shown=True)), on_statistics)
+
         """
         Sample from all answer sets remaining in the cluster
         """
-        if self.__sampling.value:            
-            _os.remove("examples/__temp_xors.lp")
+        if self.__sampling.value:
             if requested_models == -1:
                 requested_models = 1
             elif requested_models == 0:
@@ -7,25 +7,32 @@ the nogood and let clasp to propagate again
 
 from . import util
 
-class XOR:
-    def __init__(self, literals):
+class XOR(object):
+    """
+    The literals of a XOR are the slice [begin, end) of an array of literals
+    as returned by util.pack.
+    """
+    __slots__ = ("__literals", "__begin", "__end")
+
+    def __init__(self, literals, begin, end):
         self.__literals = literals
+        self.__begin = begin
+        self.__end = end
+
 
     def check(self, ass):
         if not sum(1 for lit in self if ass.is_true(lit)) % 2:
             return [lit if ass.is_true(lit) else -lit for lit in self]
 
     def __iter__(self):
-        return iter(self.__literals)
+        return iter(self.__literals[self.__begin:self.__end])
 
 class CountCheckPropagator:
     def __init__(self):
-        self.__states = []
+        self.__state = []
+        self.__parities = []
 
     def init(self, init):
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append([])
-
         # NOTE: quite a bit of ceremony here
         #       it would be better to handle these cases here more elegantly
         #       but this propagator is just a toy anyway
@@ -36,14 +43,27 @@ class CountCheckPropagator:
             constraints, facts = ret
             constraints.extend([fact] for fact in facts)
 
-        for constraint in constraints:
-            xor = XOR(list(sorted(constraint)))
-            self.__states[thread_id].append(xor)
+        literals, offsets = util.pack(sorted(constraint) for constraint in constraints)
+        self.__state = [XOR(literals, offsets[i], offsets[i+1]) for i in range(len(offsets) - 1)]
+
+        ## Every thread counts the assigned literals of the constraints
+        occurs = util.occurrences(literals, offsets)
+        for variable in occurs:
+            init.add_watch( variable)
+            init.add_watch(-variable)
+        self.__parities = [util.Parities(occurs, offsets) for thread_id in range(init.number_of_threads)]
+
+    def propagate(self, control, changes):
+        self.__parities[control.thread_id].assign(changes)
+
+    def undo(self, thread_id, assignment, changes):
+        self.__parities[thread_id].unassign(changes)
 
     def check(self, control):
-        state = self.__states[control.thread_id]
-        for xor in state:
-            nogood = xor.check(control.assignment)
-            if nogood is not None:
-                control.add_nogood(nogood) and control.propagate()
-                return
+        """
+        Only the constraints that became fully assigned are checked.
+        """
+        i = self.__parities[control.thread_id].violated()
+        if i is not None:
+            nogood = self.__state[i].check(control.assignment)
+            control.add_nogood(nogood) and control.propagate()
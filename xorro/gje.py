@@ -1,6 +1,12 @@
 """
 This module contains all the methods to perform Gauss Jordan Elimination. 
 
+Classes:
+BitMatrix -- Binary matrix with rows packed into integers (used by all GJE paths)
+Echelon   -- Reduced row echelon form maintained incrementally under assignments
+SparseMatrix -- Binary matrix stored as sets of columns (used to preprocess sparse systems)
+Schedule  -- Decides when triggered GJE is worth running
+
 Functions:
 For pre process
 columns_state_to_matrix -- Transform the state of columns to a single matrix including the parity column
@@ -16,6 +22,487 @@ deduced_clause -- Obtain implications after GJE
 """
 
 import numpy as np
+import heapq
+
+def popcount(x):
+    """ Number of set bits of a packed row """
+    return bin(x).count("1")
+
+def lowest(x):
+    """ Index of the lowest set bit of a packed row """
+    return (x & -x).bit_length() - 1
+
+def bits(x):
+    """ Iterate over the indexes of the set bits of a packed row """
+    while x:
+        low = x & -x
+        yield low.bit_length() - 1
+        x ^= low
+
+class BitMatrix:
+    """
+    A binary matrix whose rows are packed into Python integers.
+
+    Bit i of a row corresponds to column i and bit cols holds the augmented
+    (parity) column. Adding rows, searching pivots and checking rows for
+    conflicts and implications are word-parallel operations on these integers
+    instead of loops over single cells.
+
+    Bits above the parity bit are not part of the matrix. They are added along
+    with the rows and used to record of which original rows a row is the sum.
+    """
+    def __init__(self, rows, cols):
+        self.__rows = rows
+        self.__cols = cols
+
+    @classmethod
+    def from_rows(cls, m, cols=None):
+        """ Pack a list of 0/1 rows whose last element is the parity """
+        if cols is None:
+            cols = len(m[0]) - 1 if len(m) > 0 else 0
+        rows = []
+        for row in m:
+            packed = 0
+            for i in range(len(row)):
+                if row[i]:
+                    packed |= 1 << i
+            rows.append(packed)
+        return cls(rows, cols)
+
+    @classmethod
+    def from_constraints(cls, constraints, index):
+        """
+        Pack xor constraints in the form of symbols_to_xor_r, i.e., a negative
+        first literal marks an even constraint. Column of variable v is index[v].
+        """
+        cols = len(index)
+        rows = []
+        for constraint in constraints:
+            packed = 0
+            for lit in constraint:
+                packed ^= 1 << index[abs(lit)]
+            if constraint[0] > 0:
+                packed |= 1 << cols
+            rows.append(packed)
+        return cls(rows, cols)
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __getitem__(self, idx):
+        return self.__rows[idx]
+
+    def __setitem__(self, idx, row):
+        self.__rows[idx] = row
+
+    def __iter__(self):
+        return iter(self.__rows)
+
+    def columns(self):
+        """ Number of columns without the augmented one """
+        return self.__cols
+
+    def parity_bit(self):
+        return 1 << self.__cols
+
+    def copy(self):
+        return BitMatrix(self.__rows[:], self.__cols)
+
+    def to_rows(self):
+        """ Unpack into a list of 0/1 rows including the parity column """
+        return [[(row >> i) & 1 for i in range(self.__cols + 1)] for row in self.__rows]
+
+    def swap(self, r1, r2):
+        """ Swap rows in forward elimination """
+        self.__rows[r1], self.__rows[r2] = self.__rows[r2], self.__rows[r1]
+
+    def xor(self, i, j):
+        """ Add row i to row j """
+        self.__rows[j] ^= self.__rows[i]
+
+    def remove_row(self, row):
+        """ Remove the first occurrence of the given packed row """
+        self.__rows.remove(row)
+
+    def remove_zero_rows(self):
+        """ Remove rows with all zeros including the augmented column """
+        mask = (2 << self.__cols) - 1
+        self.__rows = [row for row in self.__rows if row & mask]
+
+    def remove_column(self, col):
+        """ Delete a column shifting the following ones (and the parity) to the left """
+        low = (1 << col) - 1
+        self.__rows = [(row & low) | ((row >> (col + 1)) << col) for row in self.__rows]
+        self.__cols -= 1
+
+    def restrict(self, unassigned, true, explain=False):
+        """
+        Return the matrix of a partial assignment. Columns outside the
+        unassigned mask are dropped and the columns in the true mask are
+        folded into the parity column.
+
+        If explain is set, the coefficients of the original rows are kept
+        above the parity bit, see combination().
+        """
+        pbit = 1 << self.__cols
+        keep = unassigned | pbit
+        rows = []
+        for row in self.__rows:
+            reduced = row & keep
+            if popcount(row & true) & 1:
+                reduced ^= pbit
+            if explain:
+                reduced |= (row & (pbit - 1)) << (self.__cols + 1)
+            rows.append(reduced)
+        return BitMatrix(rows, self.__cols)
+
+    def simplify(self, assigned, true):
+        """
+        Fold the assigned columns into the parity column and delete them.
+        Satisfied rows without coefficients and duplicate rows are dropped.
+        Returns the smaller matrix and the old indexes of its columns.
+        """
+        pbit = 1 << self.__cols
+        kept = [col for col in range(self.__cols) if not (assigned >> col) & 1]
+        index = dict((col, i) for i, col in enumerate(kept))
+        rows, seen = [], set()
+        for row in self.restrict(~assigned & (pbit - 1), true & assigned):
+            packed = (1 << len(kept)) if row & pbit else 0
+            for col in bits(row & (pbit - 1)):
+                packed |= 1 << index[col]
+            if packed and packed not in seen:
+                seen.add(packed)
+                rows.append(packed)
+        return BitMatrix(rows, len(kept)), kept
+
+    def combination(self, i):
+        """
+        Columns of the original rows summed up in row i of a matrix restricted
+        with explain set. The assigned ones among them explain the row.
+        """
+        return self.__rows[i] >> (self.__cols + 1)
+
+    def eliminate(self):
+        """
+        Bring the matrix into reduced row echelon form.
+
+        Pivot columns are found by or-ing the remaining rows, so empty columns
+        are skipped at once. As usual, the first remaining row containing the
+        pivot is swapped up and added to all other rows containing the pivot.
+        Rows without coefficients (all zeros or conflicting) end up at the
+        bottom.
+        """
+        rows = self.__rows
+        mask = (1 << self.__cols) - 1
+        n = len(rows)
+        r = 0
+        while r < n:
+            remaining = 0
+            for i in range(r, n):
+                remaining |= rows[i]
+            remaining &= mask
+            if not remaining:
+                break
+            bit = remaining & -remaining
+            i = r
+            while not rows[i] & bit:
+                i += 1
+            rows[r], rows[i] = rows[i], rows[r]
+            pivot = rows[r]
+            for j in range(n):
+                if j != r and rows[j] & bit:
+                    rows[j] ^= pivot
+            r += 1
+        return self
+
+    def check_sat(self):
+        """ Return True if there is a conflict, i.e., an empty odd row """
+        pbit = 1 << self.__cols
+        for row in self.__rows:
+            if row & (2 * pbit - 1) == pbit:
+                return True
+        return False
+
+    def conflicts(self):
+        """ Indexes of the empty odd rows """
+        pbit = 1 << self.__cols
+        return [i for i in range(len(self.__rows)) if self.__rows[i] & (2 * pbit - 1) == pbit]
+
+    def units(self):
+        """ Pairs of row index and (column, value) for rows with exactly one coefficient """
+        units = []
+        mask = (1 << self.__cols) - 1
+        for i in range(len(self.__rows)):
+            coeffs = self.__rows[i] & mask
+            if coeffs and not coeffs & (coeffs - 1):
+                units.append((i, (coeffs.bit_length() - 1, bool((self.__rows[i] >> self.__cols) & 1))))
+        return units
+
+    def deduce_clause(self, lits):
+        """ Literals implied by rows with exactly one coefficient """
+        clause = []
+        mask = (1 << self.__cols) - 1
+        for row in self.__rows:
+            coeffs = row & mask
+            if coeffs and not coeffs & (coeffs - 1):
+                lit = lits[coeffs.bit_length() - 1]
+                lit = lit if (row >> self.__cols) & 1 else -lit
+                if lit not in clause:
+                    clause.append(lit)
+        return clause
+
+    def print_matrix(self):
+        print_matrix(self.to_rows())
+
+class Echelon:
+    """
+    Reduced row echelon form of a BitMatrix kept up to date while columns are
+    assigned.
+
+    Assigning a column folds it into the parity column of the rows containing
+    it. If the column was the pivot of a row, the lowest remaining column of
+    that row becomes its pivot and is eliminated from the other rows. Every
+    row change is recorded on a trail so that assignments can be undone in
+    reverse order when backtracking.
+
+    Above the parity bit, every row keeps its coefficients without folding.
+    The assigned columns among them are the reason of the row.
+    """
+    def __init__(self, matrix):
+        """
+        Initializes the state from a matrix in reduced row echelon form.
+        """
+        self.__cols   = matrix.columns()
+        self.__rows   = [row | ((row & (matrix.parity_bit() - 1)) << (self.__cols + 1)) for row in matrix]
+        self.__pivot  = {}
+        self.__pivots = []
+        self.__trail  = []
+        self.__marks  = []
+        mask = (1 << self.__cols) - 1
+        for i in range(len(self.__rows)):
+            coeffs = self.__rows[i] & mask
+            col = (coeffs & -coeffs).bit_length() - 1 if coeffs else None
+            self.__pivots.append(col)
+            if col is not None:
+                self.__pivot[col] = i
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __getitem__(self, idx):
+        return self.__rows[idx] & ((2 << self.__cols) - 1)
+
+    def parity_bit(self):
+        return 1 << self.__cols
+
+    def assigned(self):
+        """ Number of assignments folded into the matrix """
+        return len(self.__marks)
+
+    def __set(self, i, row, pivot):
+        self.__trail.append((i, self.__rows[i], self.__pivots[i]))
+        self.__rows[i] = row
+        if pivot != self.__pivots[i]:
+            if self.__pivots[i] is not None:
+                del self.__pivot[self.__pivots[i]]
+            if pivot is not None:
+                self.__pivot[pivot] = i
+            self.__pivots[i] = pivot
+
+    def assign(self, col, value):
+        """
+        Fold the given column with the given truth value into the parity
+        column and return the indexes of the changed rows.
+        """
+        self.__marks.append(len(self.__trail))
+        rows, pivots = self.__rows, self.__pivots
+        bit = 1 << col
+        flip = bit | (1 << self.__cols) if value else bit
+        changed = []
+        for i in range(len(rows)):
+            if rows[i] & bit:
+                changed.append(i)
+                self.__set(i, rows[i] ^ flip, pivots[i])
+
+        p = self.__pivot.get(col)
+        if p is not None:
+            coeffs = rows[p] & ((1 << self.__cols) - 1)
+            if not coeffs:
+                self.__set(p, rows[p], None)
+            else:
+                low = coeffs & -coeffs
+                self.__set(p, rows[p], low.bit_length() - 1)
+                for i in range(len(rows)):
+                    if i != p and rows[i] & low:
+                        changed.append(i)
+                        self.__set(i, rows[i] ^ rows[p], pivots[i])
+        return changed
+
+    def backtrack(self, n):
+        """ Undo all but the first n assignments """
+        if n >= len(self.__marks):
+            return
+        mark = self.__marks[n]
+        del self.__marks[n:]
+        trail, rows, pivots = self.__trail, self.__rows, self.__pivots
+        while len(trail) > mark:
+            i, row, pivot = trail.pop()
+            rows[i] = row
+            if pivot != pivots[i]:
+                if pivots[i] is not None:
+                    del self.__pivot[pivots[i]]
+                if pivot is not None:
+                    self.__pivot[pivot] = i
+                pivots[i] = pivot
+
+    def conflict(self, i):
+        """ Whether row i is an empty odd row """
+        return self.__rows[i] & ((2 << self.__cols) - 1) == 1 << self.__cols
+
+    def implied(self, i):
+        """
+        Return (column, value) if row i has exactly one coefficient left and
+        None otherwise.
+        """
+        row = self.__rows[i]
+        coeffs = row & ((1 << self.__cols) - 1)
+        if coeffs and not coeffs & (coeffs - 1):
+            return coeffs.bit_length() - 1, bool((row >> self.__cols) & 1)
+        return None
+
+    def reason(self, i):
+        """ Mask of the assigned columns row i depends on """
+        row = self.__rows[i]
+        return (row >> (self.__cols + 1)) ^ (row & ((1 << self.__cols) - 1))
+
+class SparseMatrix:
+    """
+    A binary matrix storing for every row the set of its columns and for
+    every column the set of rows containing it.
+
+    The work of the elimination depends on the number of nonzeros and the
+    fill-in instead of rows x columns. Pivots are selected following
+    Markowitz: the shortest remaining row and, within it, the column occurring
+    in the fewest rows, which keeps the fill-in low.
+    """
+    def __init__(self, rows, parities):
+        self.__rows     = [set(row) for row in rows]
+        self.__parities = [parity & 1 for parity in parities]
+        self.__cols     = {}
+        self.__pivots   = []
+        for i, row in enumerate(self.__rows):
+            for col in row:
+                self.__cols.setdefault(col, set()).add(i)
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __iter__(self):
+        """
+        Iterate over the rows as pairs of sorted columns and parity. Pivot
+        rows come first in the order they were eliminated.
+        """
+        pivots = set(self.__pivots)
+        order = self.__pivots + [i for i in range(len(self.__rows)) if i not in pivots]
+        for i in order:
+            yield sorted(self.__rows[i]), self.__parities[i]
+
+    def nonzeros(self):
+        return sum(len(row) for row in self.__rows)
+
+    def xor(self, i, j):
+        """ Add row i to row j """
+        row, cols = self.__rows[j], self.__cols
+        for col in self.__rows[i]:
+            if col in row:
+                row.remove(col)
+                cols[col].remove(j)
+            else:
+                row.add(col)
+                cols.setdefault(col, set()).add(j)
+        self.__parities[j] ^= self.__parities[i]
+
+    def eliminate(self):
+        """
+        Bring the matrix into reduced row echelon form, i.e., every pivot
+        column occurs in exactly one row.
+        """
+        rows, cols = self.__rows, self.__cols
+        remaining = set(i for i in range(len(rows)) if rows[i])
+        ## Queue of rows by length, entries of changed rows are outdated
+        queue = [(len(rows[i]), i) for i in remaining]
+        heapq.heapify(queue)
+        while queue:
+            n, i = heapq.heappop(queue)
+            if i not in remaining or n != len(rows[i]):
+                continue
+            remaining.remove(i)
+            if not rows[i]:
+                continue
+            col = min(rows[i], key=lambda col: len(cols[col]))
+            for j in list(cols[col]):
+                if j != i:
+                    self.xor(i, j)
+                    if j in remaining:
+                        heapq.heappush(queue, (len(rows[j]), j))
+            self.__pivots.append(i)
+        return self
+
+    def check_sat(self):
+        """ Return True if there is a conflict, i.e., an empty odd row """
+        for row, parity in zip(self.__rows, self.__parities):
+            if not row and parity:
+                return True
+        return False
+
+    def print_matrix(self):
+        for row, parity in self:
+            print(row, parity)
+
+class Schedule:
+    """
+    Decides whether GJE is run when a propagator triggers it, similar to the
+    usefulness tracking of Gauss-Jordan elimination in CryptoMiniSat.
+
+    GJE is only run if at least the cutoff fraction of the variables is
+    assigned. The caller keeps the number of assigned variables and reports
+    whether a run found a conflict or an implication. After a useless run
+    the following triggers are skipped. The number of skipped triggers
+    doubles with every useless run up to the given limit and is halved with
+    every useful one.
+    """
+    def __init__(self, n, cutoff, limit):
+        self.__n       = n
+        self.__cutoff  = cutoff
+        self.__limit   = limit
+        self.__backoff = 0
+        self.__skip    = 0
+        self.__calls   = 0
+        self.__useful  = 0
+
+    def run(self, assigned):
+        """ Whether GJE should run with the given number of assigned variables """
+        if assigned < self.__cutoff * self.__n:
+            return False
+        if self.__skip > 0:
+            self.__skip -= 1
+            return False
+        return True
+
+    def report(self, useful):
+        self.__calls += 1
+        if useful:
+            self.__useful += 1
+            self.__backoff >>= 1
+        else:
+            self.__backoff = min(2 * self.__backoff + 1, self.__limit)
+        self.__skip = self.__backoff
+
+    def calls(self):
+        return self.__calls
+
+    def useful(self):
+        return self.__useful
 
 def print_matrix(m):
     for row in m:
@@ -63,220 +550,46 @@ def remove_rows_zeros(m):
 
 def check_sat(m):
     """ Check the matrix satisfiability wrt the augmented (parity) column  """
-    conflict = False
-    matrix = np.array(m)
-
-    ## If only augmented column remains
-    if len(matrix[0]) == 1:
-        for i in range(len(matrix)):
-            if matrix[i,0] == 1:
-                conflict = True
-                break
-    else:
-        ## Check if exist empty odd which means UNSAT i.e. a conflict
-        for row in matrix[::-1]:
-            if row[-1] == 1 and np.sum(row[:-1]) == 0:
-                ## UNSAT
-                conflict = True                        
-                break 
-    return conflict
+    return BitMatrix.from_rows(m).check_sat()
 
 def deduce_clause(m, lits):
     """ If no conflict, deduce the implications after GJE """
-    clause = []
-
-    #Pre work... Remove rows with all zeros
-    mm = remove_rows_zeros(m)
-    matrix = np.array(mm)
-
-    ## If empty matrix, means there are no implications
-    if matrix.size > 0:
-        ## If matrix is square
-        if len(matrix) >= (len(matrix[0])-1):                 
-            for i in range(len(lits)):
-                if matrix[i,-1] == 1:
-                    clause.append( lits[i])
-                else:
-                    clause.append(-lits[i])
-        else: ## Rectangular matrix
-            for row in matrix:
-                if np.sum(row[:-1]) == 1:
-                    index = np.where(row[:-1] == 1)[0][0]
-                    if row[-1] == 1:
-                        clause.append( lits[index])
-                    else:
-                        clause.append(-lits[index])
-    return clause
+    return BitMatrix.from_rows(m).deduce_clause(lits)
 
 
 def perform_gauss_jordan_elimination(m, show):
     """ 
-    Perform GJE using swap and xor operations.
+    Perform GJE on a list of rows using a BitMatrix.
     Print options are available using the show flag for tests/debbuging to check the GJE Procedure.
     """
     if show:
         print("Initial State")
         print_matrix(m)
 
-    r, c = 0, 0
-    rows = len(m)
-    cols = len(m[0])
+    matrix = BitMatrix.from_rows(m).eliminate()
 
     if show:
-        print("rows: %s cols: %s"%(rows, cols))
-
-    while True:
-        _swap = False
-
-        if show:
-            print("r %s c %s"%(r, c))
-
-        ## Check Pivot
-        if m[r][c] == 0:
-            ## Swap
-            for i in range(rows):
-                if r != i and i > r: ## Avoid comparing the same row and do not swap to upper rows
-                    if m[i][c] == 1 and not _swap: ## Check if a swap is not performed before in the same column
-                        if show:
-                            print("Swapping %s %s and %s %s"%(r, m[r], i, m[i]))
-                        #m = swap(m,r,i)
-                        temp  = m[r]
-                        m[r]  = m[i]
-                        m[i]  = temp
-                        _swap = True
-                        if show:
-                            print_matrix(m)
-            if not _swap: ## If not swap, means there is no 1 to swap, so go to the next column
-                c+=1
-
-        if m[r][c] == 1:
-            ## XOR
-            for i in range(rows):
-                if r != i: ## Avoid comparing the same row
-                    if m[i][c] == 1:
-                        if show:
-                            print("XOR Row %s: %s  into Row %s: %s"%(r, m[r], i, m[i]))
-                        for e in range(len(m[0])):
-                            m[i][e] ^= m[r][e]
-                        if show:
-                            print_matrix(m)
-
-        ## Increase row and column
-        r+=1
-        c+=1
-
-        ## break condition if all rows or all columns (except the augmented column are treated)
-        if r == rows or c >= cols-1:
-            break
-        
-    return m
+        print("Final State")
+        matrix.print_matrix()
+
+    return matrix.to_rows()
 
 """
 Updated methods using only numpy
 """
-def lits_to_binary_(constraint, literals):
-    row = []
-    for lit in literals:
-        if lit in constraint or -lit in constraint:
-            row.append(1)
-        else:
-            row.append(0)
-    return row
-
-def remove_rows_zeros_(m):
-    matrix = []
-    for row in m:
-        if np.sum(row) > 0:
-            matrix.append(row)
-    return np.array(matrix)
-
-def xor_(l1, l2):
-    """ XOR a column with the parity values from the state  """
-    return np.bitwise_xor(l1,l2)
-
-def check_sat_(m, lits):
-    """ Check the matrix satisfiability wrt the augmented (parity) column  and get implications if no conflict """
-    conflict = False
-    clause   = []
-
-    ## If only augmented column remains
-    if len(m[0]) == 1:
-        if np.sum(m[:,0]) > 0:
-            conflict = True
-    else:
-        ## Check if exist empty odd which means UNSAT i.e. a conflict
-        for row in m[::-1]:
-            if row[-1] == 1 and np.sum(row[:-1]) == 0:
-                ## UNSAT
-                conflict = True                        
-                break
-            elif np.sum(row[:-1]) == 1:
-                ## Unit XOR
-                i, = np.where(row[:-1] == 1)[0]
-                if row[-1] == 1:
-                    if  lits[i] not in clause:
-                        clause.append( lits[i])
-                else:
-                    if -lits[i] not in clause:
-                        clause.append(-lits[i])
-    return conflict, clause
-
 def perform_gauss_jordan_elimination_(m, show):
     """ 
-    Perform GJE using swap and xor operations.
+    Perform GJE on a numpy array using a BitMatrix.
     Print options are available using the show flag for tests/debbuging to check the GJE Procedure.
     """
     if show:
         print("Initial State")
         print_matrix(m)
-    
-    r = 0
-    c = 0
-    rows, cols = len(m), len(m[0])
 
-    if show:
-        print("rows: %s cols: %s"%(rows, cols))
-
-    while True:
-        if show:
-            print("r %s c %s"%(r, c))
-
-        ## Check Pivot
-        _swap = False
-        if m[r,c] == 0:
-            for i in range(r+1,rows):
-                if m[i,c] == 1:# If new pivot found... swap
-                    if show:
-                        print("Swapping %s %s and %s %s"%(r, m[r], i, m[i]))
-                    m[[i,r]] = m[[r,i]] ## Swap
-                    _swap = True
-                    if show:
-                        print_matrix(m)
-                    break # No more swapping in this column
-            if not _swap: ## No swap, move to the next column, same row
-                c+=1
-
-        if m[r,c] == 1:
-            ## XOR
-            for i in range(rows):
-                indexes = np.setdiff1d(np.where(m[:,c] == 1),r) # Get all the ones to XOR in the same column
-                for i in indexes:
-                    m[i] = np.bitwise_xor(m[i],m[r]) # Bitwise XOR
-                    if show:
-                        print("XOR Row %s: %s  into Row %s: %s"%(r, m[r], i, m[i]))
-                if show:
-                    print_matrix(m)
-
-        ## Increase row and column
-        r+=1
-        c+=1
-
-        ## break condition if all rows or all columns (except the augmented column) are treated
-        if r == rows or c >= cols-1:
-            break
+    matrix = BitMatrix.from_rows(m).eliminate()
 
     if show:
         print("Final State")
-        print_matrix(m)
-        
-    return m
+        matrix.print_matrix()
+
+    return np.array(matrix.to_rows(), dtype=np.asarray(m).dtype)
@@ -3,147 +3,172 @@ from . import gje
 from itertools import chain
 import clingo
 
-def xor_columns(col, parity):
-    result = []
-    for i in range(len(col)):
-        result.append(col[i] ^ parity[i])
-    return result
-
-def lits_to_binary(columns, lits, constraint):
-    for i in range(len(lits)):
-        if lits[i] in constraint:
-            columns.setdefault(lits[i], []).append(1)
-        elif -lits[i] in constraint:
-            columns.setdefault(lits[i], []).append(1)
-        else:
-            columns.setdefault(lits[i], []).append(0)
-    return columns
-
-class XOR:
+class XOR(object):
     """
     A XOR constraint maintains the following invariants:
     1. there are at least two literals, and
-    2. the first two literals are unassigned, or all literals are assigned and
-       the first two literals have been assigned last on the same decision
+    2. the two watched literals are unassigned, or all literals are assigned
+       and the watched literals have been assigned last on the same decision
        level.
     Furthermore, an index pointing to the literal after the literal assigned
     last is maintained. We start the search for the next unassigned literal
     from this point. This is important to get the amortized linear propagation
     time.
+
+    The literals are never modified and can be shared by the XORs of all
+    threads. They are the slice [begin, end) of an array of literals as
+    returned by util.pack. Only the positions of the watched literals and the
+    index belong to a thread.
     """
-    def __init__(self, literals):
-        assert(len(literals) >= 2)
+    __slots__ = ("__literals", "__begin", "__size", "__watches", "__index")
+
+    def __init__(self, literals, begin=0, end=None):
+        if end is None:
+            end = len(literals)
+        assert(end - begin >= 2)
         self.__literals = literals
+        self.__begin = begin
+        self.__size = end - begin
+        self.__watches = [0, 1]
         self.__index = 2
 
     def __len__(self):
-        return len(self.__literals)
+        return self.__size
 
     def __getitem__(self, idx):
-        return self.__literals[idx]
+        return self.__literals[self.__begin + idx]
 
-    def __setitem__(self, idx, val):
-        self.__literals[idx] = val
-        return val            
+    def watched(self, i):
+        """ The i-th watched literal """
+        return self.__literals[self.__begin + self.__watches[i]]
 
-    def propagate(self, assignment, i):
+    def propagate(self, values, i):
         """
         Propagates the given assigned index.
 
-        If an unwatched unassigned literal is found, the literals are
-        rearranged so that the given index points to it. The function returns
-        true if an such a literal is found.
+        If an unwatched unassigned literal is found, the given watch is moved
+        to it. The function returns true if an such a literal is found.
         """
         assert(i < 2)
-        for j in chain(range(self.__index, len(self)), range(2, self.__index)):
-            if assignment.value(self[j]) is None:
-                self.__index = j + 1 if j + 1 < len(self) else 2
-                self[i], self[j] = self[j], self[i]
+        watches = self.__watches
+        for j in chain(range(self.__index, len(self)), range(0, self.__index)):
+            if j != watches[0] and j != watches[1] and not values[self[j]]:
+                self.__index = j + 1 if j + 1 < len(self) else 0
+                watches[i] = j
                 return True
         return False
 
-    def reason_gje(self, columns, assignment, n_lits, cutoff):
-        state = {}
-        partial = []
-        deduced_literals = []
-
-        ## Get Partial Assignment
-        state["parity"] = columns["parity"]
-        for lit, column in columns.items():
-            if lit != "parity":
-                value = assignment.value(lit)
-                if value == None:
-                    state[lit] = column
-                elif value == True:
-                    state["parity"] = xor_columns(column, state["parity"])
-                    partial.append( lit)
-                elif value == False:                    
-                    partial.append(-lit)                           
-
-        ## Build the matrix from columns state
-        matrix, xor_lits= gje.columns_state_to_matrix(state)
-
-        ## Percentage of assigned literals
-        assigned_lits_perc = 1.0-float("%.1f"%(len(xor_lits)/n_lits))
-        ## If there are more than unary xors perform GJE
-        if len(state) > 2 and assigned_lits_perc >= cutoff:
-            matrix = gje.remove_rows_zeros(matrix)
-            matrix = gje.perform_gauss_jordan_elimination(matrix, False)
-
-        ## Check SATISFIABILITY
-        conflict = gje.check_sat(matrix)
-        if not conflict and xor_lits:
-            ## Imply literals 
-            deduced_literals = gje.deduce_clause(matrix, xor_lits)
-
-        return conflict, partial, deduced_literals
+    def reason(self, values, i):
+        """
+        If the constraint is unit resulting or conflicting returns a reason in
+        form of a clause.
+        """
+        # Switch to the index of the other watched literal that is either
+        # unassigned and has to be propagated or has to be checked for a
+        # conflict. In the second case it was assigned on the same level as the
+        # propagated literal.
+        i = self.__watches[1 - i]
+        count = 0
+        clause = []
+        for j in range(len(self)):
+            if i == j:
+                continue
+            if values[self[j]] == util.TRUE:
+                clause.append(-self[j])
+                count += 1
+            else:
+                clause.append(self[j])
+
+        clause.append(-self[i] if count % 2 else self[i])
+
+        return None if values[clause[-1]] == util.TRUE else clause
 
 
 class Reason_GJE:
-    def __init__(self, cutoff):
-        self.__states  = []
-        self.__columns = []
+    """
+    Propagator performing Gauss-Jordan Elimination whenever a watched XOR
+    constraint becomes unit or conflicting.
+
+    The XOR constraints are split into components not sharing variables, each
+    with its own matrix. Each thread keeps the matrices in reduced row echelon
+    form. Assigned variables are recorded when they are propagated and folded
+    into the echelon form of their component only when GJE is triggered, so
+    the work per trigger depends on the number of new assignments and not on
+    the size of the system. The assignments are undone again when
+    backtracking.
+
+    The trigger decides when GJE runs. With "change" it runs as soon as a
+    constraint becomes unit or conflicting. Otherwise such a constraint is
+    propagated on its own and only marks its component dirty. The dirty
+    components are eliminated once after all changes passed to propagate
+    ("batch"), at the next fixpoint ("fixpoint"), or only on total
+    assignments ("total").
+    """
+    def __init__(self, cutoff, backoff=64, trigger="change", heuristic=0.0, ids=None):
+        self.__states     = []
+        self.__values     = []
+        self.__caches     = []
+        self.__heuristics = []
+        self.__echelons   = []
+        self.__schedules  = []
+        self.__assigned   = []
+        self.__pending    = []
+        self.__dirty      = []
+        self.__pushed     = []
+        self.__literals   = []
+        self.__component  = {}
+        self.__index      = {}
+        self.__size       = 0
         self.__sat = True
         self.__consequences = []
         self.__cutoff = cutoff
-        self.__n_literals = 0
-        self.__counter = 0
+        self.__backoff = backoff
+        self.__trigger = trigger
+        self.__ratio = heuristic
+        self.__ids = ids
 
-    def __add_watch(self, ctl, xor, unassigned, thread_ids):
+    def __add_watch(self, xor, unassigned, thread_ids):
         """
         Adds a watch for the for the given index.
 
         The literal at the given index has to be either unassigned or become
         unassigned through backtracking before the associated constraint can
-        become unit resulting again.
+        become unit resulting again. All variables of the matrix are watched
+        in the solver, so only the watch lists of the threads are updated.
         """
-        variable = abs(xor[unassigned])
-        ctl.add_watch( variable)
-        ctl.add_watch(-variable)
+        variable = abs(xor.watched(unassigned))
         for thread_id in thread_ids:
-            self.__states[thread_id].setdefault(variable, []).append((xor, unassigned))
+            state = self.__states[thread_id]
+            if state[variable] is None:
+                state[variable] = []
+            state[variable].append((xor, unassigned))
 
     def init(self, init):
         """
-        Initializes xor constraints based on the symbol table to build a binary matrix.
+        Initializes xor constraints based on the symbol table to build a binary matrix per component.
         This propagator is called on fixpoints to perform Gauss-Jordan Elimination after Unit Propagation
         """
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append({})
-            self.__columns.append({})
-
         init.check_mode = clingo.PropagatorCheckMode.Fixpoint
-        literals = []
-        for atom in init.symbolic_atoms.by_signature("__parity",3):
-            lit = init.solver_literal(atom.literal)
-            value = init.assignment.value(lit)
-            if value == None and abs(lit) not in literals:
-                literals.append(abs(lit))
-        
+
+        ## Start over when solving again, only the watches of the solver stay
+        self.__states     = []
+        self.__values     = []
+        self.__caches     = []
+        self.__heuristics = []
+        self.__echelons   = []
+        self.__schedules  = []
+        self.__assigned   = []
+        self.__pending    = []
+        self.__dirty      = []
+        self.__pushed     = []
+        self.__literals   = []
+        self.__component  = {}
+        self.__index      = {}
+        self.__sat = True
+        self.__consequences = []
+
         ## Get the constraints
-        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
-        # Number of literals in GJ Matrix
-        self.__n_literals = float(len(literals))
+        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init), self.__ids)
         
         if ret is None:
             self.__sat = False
@@ -154,31 +179,47 @@ class Reason_GJE:
             constraints, facts = ret
             self.__consequences.extend(facts)
 
-            ## Get the literals and parities
-            for constraint in constraints:
-                # FIXME: check if there is another way to do this. All constraints are represented as "odd" constraints but GJE only uses non-negative variables/literals.
-                # Somehow we need to convert xor constraints with a negative into a positive literal and invert the parity to build the matrix.
-                even = False
-                if constraint[0] < 0:
-                    even = True
+            ## Watch the XORs, the threads share the literals
+            literals, offsets = util.pack(constraints)
+            if self.__ratio:
+                self.__heuristics = [util.Heuristic(literals, offsets, self.__ratio) for thread_id in range(init.number_of_threads)]
+            ## The mirrors also cover the variables watched in earlier calls
+            self.__size = max([self.__size] + [abs(lit) for lit in literals])
+            variables = self.__size
+            self.__states = [[None] * (variables + 1) for thread_id in range(init.number_of_threads)]
+            for i in range(len(constraints)):
                 for thread_id in range(init.number_of_threads):
-                    if even:
-                        self.__columns[thread_id].setdefault("parity", []).append(0)
-                    else:
-                        self.__columns[thread_id].setdefault("parity", []).append(1)
-
-            ## Build the rest of the matrix
-            for constraint in constraints:
-                if len(constraint) == 1:
-                    lit = next(iter(constraint))
-                    self.__consequences.append(lit if constraint[0] > 1 else -lit)
-                elif len(constraint):
-                    xor = XOR(constraint)
-                    self.__add_watch(init, xor, 0, range(init.number_of_threads))
-                    self.__add_watch(init, xor, 1, range(init.number_of_threads))
-                
-                for thread_id in range(init.number_of_threads):
-                    self.__columns[thread_id] = lits_to_binary(self.__columns[thread_id], sorted(literals), constraint)
+                    xor = XOR(literals, offsets[i], offsets[i+1])
+                    self.__add_watch(xor, 0, (thread_id,))
+                    self.__add_watch(xor, 1, (thread_id,))
+
+            ## Reduce the matrix of each component once, every thread continues from this echelon form
+            matrices = []
+            for component in util.components(constraints):
+                literals = sorted(set(abs(lit) for constraint in component for lit in constraint))
+                for i, lit in enumerate(literals):
+                    self.__component[lit] = len(self.__literals)
+                    self.__index[lit] = i
+                matrix = gje.BitMatrix.from_constraints(component, dict((lit, i) for i, lit in enumerate(literals))).eliminate()
+                if matrix.check_sat():
+                    self.__sat = False
+                self.__consequences.extend(matrix.deduce_clause(literals))
+                self.__literals.append(literals)
+                matrices.append(matrix)
+
+                for lit in literals:
+                    init.add_watch( lit)
+                    init.add_watch(-lit)
+
+            for thread_id in range(init.number_of_threads):
+                self.__values.append(util.values(init.assignment, variables))
+                self.__caches.append(util.Cache())
+                self.__echelons.append([gje.Echelon(matrix) for matrix in matrices])
+                self.__assigned.append([[] for matrix in matrices])
+                self.__pending.append([set() for matrix in matrices])
+                self.__dirty.append(set())
+                self.__pushed.append(0)
+                self.__schedules.append([gje.Schedule(len(literals), self.__cutoff, self.__backoff) for literals in self.__literals])
                     
         else:
             # NOTE: if the propagator is to be used standalone, this case has to be handled
@@ -199,51 +240,183 @@ class Reason_GJE:
         if not self.__sat:
             control.add_clause([]) and control.propagate()
             return
-        for lit in self.__consequences:
+        ## Consequences are pushed once per thread on the top level
+        pushed = self.__pushed
+        while control.assignment.decision_level == 0 and pushed[control.thread_id] < len(self.__consequences):
+            lit = self.__consequences[pushed[control.thread_id]]
+            pushed[control.thread_id] += 1
             if not control.add_clause([lit]) or not control.propagate():
                 return
+        if self.__trigger == "fixpoint" or (self.__trigger == "total" and control.assignment.is_total):
+            self.__gje_dirty(control)
+
+    def __unit(self, control, xor, unassigned):
+        """
+        Handle a XOR constraint that became unit or conflicting. Returns false
+        if propagation has to stop.
+
+        GJE runs on the component of the constraint if the trigger is "change"
+        and the schedule of the component agrees. Otherwise, only the given
+        constraint is propagated.
+        """
+        component = self.__component[abs(xor[0])]
+        if self.__trigger != "change":
+            self.__dirty[control.thread_id].add(component)
+        elif self.__schedules[control.thread_id][component].run(len(self.__assigned[control.thread_id][component])):
+            return self.__gje(control, component)
+
+        clause = xor.reason(self.__values[control.thread_id], unassigned)
+        return clause is None or (control.add_clause(clause) and control.propagate())
+
+    def __gje_dirty(self, control):
+        """
+        Run GJE once on each dirty component whose schedule agrees. Returns
+        false if propagation has to stop.
+        """
+        dirty    = self.__dirty[control.thread_id]
+        assigned = self.__assigned[control.thread_id]
+        while dirty:
+            component = dirty.pop()
+            if self.__schedules[control.thread_id][component].run(len(assigned[component])) and not self.__gje(control, component):
+                return False
+        return True
+
+    def __gje(self, control, component):
+        """
+        Fold the pending assignments into the echelon form of the given
+        component and propagate the rows that became unit or conflicting.
+        Returns false if propagation has to stop. Nogoods only contain the
+        assigned variables of the rows summed up in a row.
+        """
+        assigned  = self.__assigned[control.thread_id][component]
+        echelon   = self.__echelons[control.thread_id][component]
+        lits      = self.__literals[component]
+        schedule  = self.__schedules[control.thread_id][component]
+
+        ## Rows not checked yet stay pending, they might still be unit or
+        ## conflicting after the solver backjumped
+        pending = self.__pending[control.thread_id][component]
+        for literal in assigned[echelon.assigned():]:
+            pending.update(echelon.assign(self.__index[abs(literal)], literal > 0))
+
+        useful = False
+        while pending:
+            i = pending.pop()
+            if echelon.conflict(i):
+                pending.add(i)
+                schedule.report(True)
+                return self.__add_nogood(control, self.__reason(self.__values[control.thread_id], lits, echelon.reason(i))) and control.propagate()
+            implied = echelon.implied(i)
+            if implied is not None:
+                col, value = implied
+                lit = lits[col] if value else -lits[col]
+                useful = True
+                if not self.__add_nogood(control, self.__reason(self.__values[control.thread_id], lits, echelon.reason(i))+[-lit]) or not control.propagate():
+                    pending.add(i)
+                    schedule.report(True)
+                    return False
+        schedule.report(useful)
+        return True
+
+    def __reason(self, values, lits, mask):
+        """
+        The assigned literals of the given columns. These are the variables of
+        the original rows summed up in a row, which suffice to explain it.
+        """
+        reason = []
+        for col in gje.bits(mask):
+            reason.append(lits[col] if values[lits[col]] == util.TRUE else -lits[col])
+        return reason
 
     def propagate(self, control, changes):
         """
         Propagates XOR constraints maintaining two watches per constraint.
+        A constraint becoming unit or conflicting triggers GJE.
 
         Generated conflicts are guaranteed to be asserting (have at least two
         literals from the current decision level).
         """
-        state = self.__states[control.thread_id]
-        columns = self.__columns[control.thread_id]
-        n = self.__n_literals
-        cutoff = self.__cutoff
-        counter = self.__counter
+        state    = self.__states[control.thread_id]
+        values   = self.__values[control.thread_id]
+        assigned = self.__assigned[control.thread_id]
+        util.assign(values, changes)
+        if self.__heuristics:
+            self.__heuristics[control.thread_id].assign(changes)
+        for literal in changes:
+            component = self.__component.get(abs(literal))
+            if component is not None:
+                assigned[component].append(literal)
         
         for literal in changes:
             variable = abs(literal)
+            watches = state[variable]
+            if not watches:
+                continue
 
-            state[variable], watches = [], state[variable]
-            assert(len(watches) > 0)
+            # The watches that stay are moved to the front of the list.
+            j = 0
             for i in range(len(watches)):
-                xor, unassigned = watches[i]
-                if xor.propagate(control.assignment, unassigned):
+                watch = watches[i]
+                xor, unassigned = watch
+                if xor.propagate(values, unassigned):
                     # We found an unassigned literal, which is watched next.
-                    self.__add_watch(control, xor, unassigned, (control.thread_id,))
+                    self.__add_watch(xor, unassigned, (control.thread_id,))
                 else:
                     # Here the constraint is either unit, satisfied, or
                     # conflicting. In any case, we can keep the watch because
                     # (*) the current decision level has to be backtracked
                     # before the constraint can become unit again.
-                    state[variable].append((xor, unassigned))                                                           
-                    
+                    watches[j] = watch
+                    j += 1
+
                     ## GJE
-                    conflict, partial, clause = xor.reason_gje(columns, control.assignment, n, cutoff)
-                    if clause is not None:
-                        for lit in clause:
-                            if not control.add_nogood(partial+[-lit]) or not control.propagate():
-                                return                                
-                    if conflict:
-                        if not control.add_nogood(partial) or not control.propagate():
-                            return
-                    
-            if len(state[variable]) == 0:
-                control.remove_watch( variable)
-                control.remove_watch(-variable)
-                state.pop(variable)
+                    if not self.__unit(control, xor, unassigned):
+                        # reestablish the remaining watches with the same
+                        # reason as in (*)
+                        watches[j:i + 1] = []
+                        return
+            del watches[j:]
+
+        if self.__trigger == "batch":
+            self.__gje_dirty(control)
+
+    def __add_nogood(self, control, nogood):
+        """
+        Add a nogood unless the cache of the thread skips it as a repeated
+        one. Returns false if propagation has to stop.
+        """
+        return self.__caches[control.thread_id].skip(control.assignment, nogood) or control.add_nogood(nogood)
+
+    def on_statistics(self, step, accu):
+        """
+        Report the hit rate of the nogood caches.
+        """
+        accu["Nogood Cache"] = util.cache_statistics(self.__caches)
+
+    def decide(self, thread_id, assignment, fallback):
+        """
+        Branch on the variables of the XOR constraints if a heuristic ratio
+        is set, otherwise keep the decision of the solver.
+        """
+        if not self.__heuristics:
+            return fallback
+        return self.__heuristics[thread_id].decide(self.__values[thread_id], assignment, fallback)
+
+    def undo(self, thread_id, assignment, changes):
+        """
+        Backtrack the assignments of the thread and restore the echelon forms
+        of the affected components.
+        """
+        assigned = self.__assigned[thread_id]
+        echelons = self.__echelons[thread_id]
+        util.unassign(self.__values[thread_id], changes)
+        if self.__heuristics:
+            self.__heuristics[thread_id].unassign(changes)
+        undone = {}
+        for literal in changes:
+            component = self.__component.get(abs(literal))
+            if component is not None:
+                undone[component] = undone.get(component, 0) + 1
+        for component, n in undone.items():
+            del assigned[component][len(assigned[component])-n:]
+            echelons[component].backtrack(len(assigned[component]))
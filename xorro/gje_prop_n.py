@@ -4,138 +4,200 @@ from itertools import chain
 import clingo
 import numpy as np
 
-class List:
-    """
-    All columns of the state are built in this class, the parity column and the literals
-    """
-    def __init__(self, ls):
-        self.__list = ls
-
-    def __len__(self):
-        return len(self.__list)
-
-    def __getitem__(self, idx):
-        return self.__list[idx]
-                
-class XOR:
+class XOR(object):
     """
     A XOR constraint maintains the following invariants:
     1. there are at least two literals, and
-    2. the first two literals are unassigned, or all literals are assigned and
-       the first two literals have been assigned last on the same decision
+    2. the two watched literals are unassigned, or all literals are assigned
+       and the watched literals have been assigned last on the same decision
        level.
     Furthermore, an index pointing to the literal after the literal assigned
     last is maintained. We start the search for the next unassigned literal
     from this point. This is important to get the amortized linear propagation
     time.
+
+    The literals are never modified and can be shared by the XORs of all
+    threads. They are the slice [begin, end) of an array of literals as
+    returned by util.pack. Only the positions of the watched literals and the
+    index belong to a thread.
     """
-    def __init__(self, literals):
-        assert(len(literals) >= 2)
+    __slots__ = ("__literals", "__begin", "__size", "__watches", "__index")
+
+    def __init__(self, literals, begin=0, end=None):
+        if end is None:
+            end = len(literals)
+        assert(end - begin >= 2)
         self.__literals = literals
+        self.__begin = begin
+        self.__size = end - begin
+        self.__watches = [0, 1]
         self.__index = 2
 
     def __len__(self):
-        return len(self.__literals)
+        return self.__size
 
     def __getitem__(self, idx):
-        return self.__literals[idx]
+        return self.__literals[self.__begin + idx]
 
-    def __setitem__(self, idx, val):
-        self.__literals[idx] = val
-        return val            
+    def watched(self, i):
+        """ The i-th watched literal """
+        return self.__literals[self.__begin + self.__watches[i]]
 
-    def propagate(self, assignment, i):
+    def propagate(self, values, i):
         """
         Propagates the given assigned index.
 
-        If an unwatched unassigned literal is found, the literals are
-        rearranged so that the given index points to it. The function returns
-        true if an such a literal is found.
+        If an unwatched unassigned literal is found, the given watch is moved
+        to it. The function returns true if an such a literal is found.
         """
         assert(i < 2)
-        for j in chain(range(self.__index, len(self)), range(2, self.__index)):
-            if assignment.value(self[j]) is None:
-                self.__index = j + 1 if j + 1 < len(self) else 2
-                self[i], self[j] = self[j], self[i]
+        watches = self.__watches
+        for j in chain(range(self.__index, len(self)), range(0, self.__index)):
+            if j != watches[0] and j != watches[1] and not values[self[j]]:
+                self.__index = j + 1 if j + 1 < len(self) else 0
+                watches[i] = j
                 return True
         return False
 
-    def reason_gje(self, columns, assignment, cutoff):
-        state = {}
-        parities = columns["parity"]
-        partial = []
+    def reason(self, values, i):
+        """
+        If the constraint is unit resulting or conflicting returns a reason in
+        form of a clause.
+        """
+        # Switch to the index of the other watched literal that is either
+        # unassigned and has to be propagated or has to be checked for a
+        # conflict. In the second case it was assigned on the same level as the
+        # propagated literal.
+        i = self.__watches[1 - i]
+        count = 0
+        clause = []
+        for j in range(len(self)):
+            if i == j:
+                continue
+            if values[self[j]] == util.TRUE:
+                clause.append(-self[j])
+                count += 1
+            else:
+                clause.append(self[j])
+
+        clause.append(-self[i] if count % 2 else self[i])
+
+        return None if values[clause[-1]] == util.TRUE else clause
+
+    def reason_gje(self, matrix, lits, columns, values):
+        """
+        Returns a conflicting nogood or None and a list of implied literals
+        with their nogoods. The nogood of a row of the reduced matrix consists
+        of the assigned literals of the original rows summed up in it.
 
+        The partial assignment of the columns is gathered from the value
+        mirror, columns holds the literals of the matrix as a numpy array.
+        """
         ## Get Partial Assignment
-        for key, value in columns.items():
-            if key != "parity":
-                assign = assignment.value(key)
-                if assign == None:
-                    state[key] = value
-                elif assign == True:
-                    parities = gje.xor_(value._List__list, parities)
-                    partial.append( key)
-                elif assign == False:
-                    partial.append(-key)
-        
-        ## Build the matrix from columns state
-        xor_lits = [ lit for lit in state ]
-        m = [ col._List__list for col in state.values()]
-        m.append(parities)
-        matrix = np.array(m).T
+        unassigned, true = util.masks(values, columns)
+
+        ## Build the matrix of the partial assignment
+        matrix = matrix.restrict(unassigned, true, True)
 
-        ## Check SATISFIABILITY and find consequences
-        conflict, clause = gje.check_sat_(matrix, xor_lits)
-        ## Detect conflict or clauses before GJE
-        if conflict:
-            return conflict, partial, clause
-        
         ## If there are more than unary xors perform GJE
-        if len(matrix[0]) > 2 and len(parities)>1:
-            matrix = gje.remove_rows_zeros_(matrix)
-            matrix = gje.perform_gauss_jordan_elimination_(matrix, False)
+        ## Detect conflict or clauses before GJE
+        if not matrix.conflicts() and gje.popcount(unassigned) > 1 and len(matrix) > 1:
+            matrix.remove_zero_rows()
+            matrix.eliminate()
 
-            ## Check SATISFIABILITY and find consequences
-            conflict, clause = gje.check_sat_(matrix, xor_lits)
+        ## Check SATISFIABILITY and find consequences
+        def nogood(i):
+            nogood = []
+            for col in gje.bits(matrix.combination(i) & ~unassigned):
+                nogood.append(lits[col] if (true >> col) & 1 else -lits[col])
+            return nogood
 
-        return conflict, partial, clause
+        conflicts = matrix.conflicts()
+        if conflicts:
+            return nogood(conflicts[0]), []
 
+        clause = []
+        for i, (col, value) in matrix.units():
+            clause.append((lits[col] if value else -lits[col], nogood(i)))
+        return None, clause
 
 class State_GJE:
-    def __init__(self, cutoff):
-        self.__states   = []
-        self.__columns  = []
-        self.__literals = []
+    """
+    Propagator performing Gauss-Jordan Elimination on the matrix of the
+    partial assignment whenever a watched XOR constraint becomes unit or
+    conflicting and the schedule of its component decides so.
+
+    Unless the trigger is "change", the constraint is only propagated on its
+    own and its component is marked dirty. Dirty components are eliminated
+    once per call to propagate ("batch"), at the next fixpoint ("fixpoint"),
+    or on total assignments ("total").
+    """
+    def __init__(self, cutoff, backoff=64, trigger="change", heuristic=0.0):
+        self.__states    = []
+        self.__assigned  = []
+        self.__schedules = []
+        self.__matrices  = []
+        self.__literals  = []
+        self.__columns   = []
+        self.__values    = []
+        self.__caches    = []
+        self.__heuristics = []
+        self.__pushed    = []
+        self.__dirty     = []
+        self.__component = {}
+        self.__size      = 0
         self.__sat = True
         self.__consequences = []
         self.__cutoff = cutoff
+        self.__backoff = backoff
+        self.__trigger = trigger
+        self.__ratio = heuristic
 
-    def __add_watch(self, ctl, xor, unassigned, thread_ids):
+    def __add_watch(self, xor, unassigned, thread_ids):
         """
         Adds a watch for the for the given index.
 
         The literal at the given index has to be either unassigned or become
         unassigned through backtracking before the associated constraint can
-        become unit resulting again.
+        become unit resulting again. All variables of the matrices are watched
+        in the solver to count the assigned ones, so only the watch lists of
+        the threads are updated.
         """
-        variable = abs(xor[unassigned])
-        ctl.add_watch( variable)
-        ctl.add_watch(-variable)
+        variable = abs(xor.watched(unassigned))
         for thread_id in thread_ids:
-            self.__states[thread_id].setdefault(variable, []).append((xor, unassigned))
+            state = self.__states[thread_id]
+            if state[variable] is None:
+                state[variable] = []
+            state[variable].append((xor, unassigned))
 
     def init(self, init):
         """
-        Initializes xor constraints based on the symbol table to build a binary matrix.
+        Initializes xor constraints based on the symbol table to build a binary matrix per component.
         This propagator is called on fixpoints to perform Gauss-Jordan Elimination after Unit Propagation
         """
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append({})
-            self.__columns.append({})
-
         init.check_mode = clingo.PropagatorCheckMode.Fixpoint
 
+        ## Start over when solving again, only the watches of the solver stay
+        self.__states    = []
+        self.__assigned  = []
+        self.__schedules = []
+        self.__matrices  = []
+        self.__literals  = []
+        self.__columns   = []
+        self.__values    = []
+        self.__caches    = []
+        self.__heuristics = []
+        self.__pushed    = []
+        self.__dirty     = []
+        self.__component = {}
+        self.__sat = True
+        self.__consequences = []
+
         ## Get the constraints
         ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
+        if ret is not None:
+            ## Binary constraints are replaced by clauses over equivalent variables
+            ret = util.equivalences(*ret)
         
         if ret is None:
             self.__sat = False
@@ -143,53 +205,61 @@ class State_GJE:
             # NOTE: whether facts should be handled here is up to question
             #       this should only be necessary if the propagator is to be used standalone
             #       without any of the other approaches
-            constraints, facts = ret
+            constraints, facts, clauses = ret
+            for clause in clauses:
+                if not init.add_clause(clause):
+                    break
             self.__consequences.extend(facts)
 
-            ## Get the literals and parities
-            pars = []
-            literals = []
-            for constraint in constraints:
+            ## Get the literals
+            literals, offsets = util.pack(constraints)
+            if self.__ratio:
+                self.__heuristics = [util.Heuristic(literals, offsets, self.__ratio) for thread_id in range(init.number_of_threads)]
+            ## The mirrors also cover the variables watched in earlier calls
+            self.__size = max([self.__size] + [abs(lit) for lit in literals])
+            variables = self.__size
+            self.__states = [[None] * (variables + 1) for thread_id in range(init.number_of_threads)]
+            for i, constraint in enumerate(constraints):
                 # Consequences
                 if len(constraint) == 1:
                     lit = next(iter(constraint))
                     self.__consequences.append(lit if constraint[0] > 1 else -lit)
-                # Watch XOR
+                # Watch XOR, the threads share the literals
                 elif len(constraint):
-                    xor = XOR(constraint)
-                    self.__add_watch(init, xor, 0, range(init.number_of_threads))
-                    self.__add_watch(init, xor, 1, range(init.number_of_threads))
-                # Get literals
-                for lit in constraint:
-                    value = init.assignment.value(lit)
-                    if value == None and abs(lit) not in literals:
-                        literals.append(abs(lit))
-            
-                # FIXME: check if there is another way to do this. All constraints are represented as "odd" constraints but GJE only uses non-negative variables/literals.
-                # Somehow we need to convert xor constraints with a negative into a positive literal and invert the parity to build the matrix.
-                # Get parities
-                if constraint[0] < 0:
-                    pars.append(0)
-                else:
-                    pars.append(1)
+                    for thread_id in range(init.number_of_threads):
+                        xor = XOR(literals, offsets[i], offsets[i+1])
+                        self.__add_watch(xor, 0, (thread_id,))
+                        self.__add_watch(xor, 1, (thread_id,))
+
+            # Build a matrix for each component, the threads share the matrices
+            # until simplifying on the top level replaces them by their own
+            matrices = []
+            for component in util.components(constraints):
+                literals = []
+                for constraint in component:
+                    for lit in constraint:
+                        value = init.assignment.value(lit)
+                        if value == None and abs(lit) not in literals:
+                            literals.append(abs(lit))
+                literals.sort()
+                for lit in literals:
+                    self.__component[lit] = len(matrices)
+                index = dict((lit, i) for i, lit in enumerate(literals))
+                matrices.append((gje.BitMatrix.from_constraints(component, index), literals))
+                for lit in literals:
+                    init.add_watch( lit)
+                    init.add_watch(-lit)
 
-            # Sort literals
-            self.__literals = List(sorted(literals))
-            
-            # Add parities to the state
-            for thread_id in range(init.number_of_threads):
-                self.__columns[thread_id]["parity"] = List(np.array(pars))
-                
-            # Build the rest of the matrix
-            matrix = []
-            for constraint in constraints:
-                matrix.append(gje.lits_to_binary_(constraint, literals))
-
-            # Transpose
-            matrix = np.array(matrix).T
             for thread_id in range(init.number_of_threads):
-                for i in range(len(literals)):
-                    self.__columns[thread_id][literals[i]] = List(matrix[i])
+                self.__matrices.append([matrix for matrix, literals in matrices])
+                self.__literals.append([literals for matrix, literals in matrices])
+                self.__columns.append([np.array(literals, dtype=np.intp) for matrix, literals in matrices])
+                self.__pushed.append(0)
+                self.__values.append(util.values(init.assignment, variables))
+                self.__caches.append(util.Cache())
+                self.__dirty.append({})
+                self.__assigned.append([0 for matrix in matrices])
+                self.__schedules.append([gje.Schedule(len(literals), self.__cutoff, self.__backoff) for matrix, literals in matrices])
             
         else:
             # NOTE: if the propagator is to be used standalone, this case has to be handled
@@ -211,9 +281,47 @@ class State_GJE:
         if not self.__sat:
             control.add_clause([]) and control.propagate()
             return
-        for lit in self.__consequences:
-            if not control.add_clause([lit]) or not control.propagate():
+        if control.assignment.decision_level == 0:
+            ## Consequences are pushed once per thread
+            consequences = self.__consequences
+            while self.__pushed[control.thread_id] < len(consequences):
+                lit = consequences[self.__pushed[control.thread_id]]
+                self.__pushed[control.thread_id] += 1
+                if not control.add_clause([lit]) or not control.propagate():
+                    return
+            if not self.__simplify(control):
                 return
+        if self.__trigger == "fixpoint" or (self.__trigger == "total" and control.assignment.is_total):
+            self.__gje_dirty(control)
+
+    def __simplify(self, control):
+        """
+        Fold the variables fixed on the top level into the parity column of
+        the matrices of the thread and delete their columns. Rows becoming
+        unit are propagated once, their columns are deleted the next time.
+        Returns false if propagation has to stop.
+        """
+        thread_id = control.thread_id
+        matrices  = self.__matrices[thread_id]
+        literals  = self.__literals[thread_id]
+        columns   = self.__columns[thread_id]
+        values    = self.__values[thread_id]
+        for component in range(len(matrices)):
+            unassigned, true = util.masks(values, columns[component])
+            assigned = ((1 << len(literals[component])) - 1) & ~unassigned
+            if not assigned:
+                continue
+            matrix, kept = matrices[component].simplify(assigned, true)
+            lits = [literals[component][col] for col in kept]
+            matrices[component] = matrix
+            literals[component] = lits
+            columns[component] = np.array(lits, dtype=np.intp)
+            if matrix.check_sat():
+                return control.add_clause([]) and control.propagate()
+            for i, (col, value) in matrix.units():
+                if not control.add_clause([lits[col] if value else -lits[col]]) or not control.propagate():
+                    return False
+        return True
 
     def propagate(self, control, changes):
         """
@@ -222,37 +330,127 @@ class State_GJE:
         Generated conflicts are guaranteed to be asserting (have at least two
         literals from the current decision level).
         """
+        if not self.__sat:
+            ## Only watches of earlier calls are left
+            return
         state     = self.__states[control.thread_id]
-        columns   = self.__columns[control.thread_id]
-        cutoff    = self.__cutoff
+        values    = self.__values[control.thread_id]
+        assigned  = self.__assigned[control.thread_id]
+        schedules = self.__schedules[control.thread_id]
+        util.assign(values, changes)
+        if self.__heuristics:
+            self.__heuristics[control.thread_id].assign(changes)
+        for literal in changes:
+            component = self.__component.get(abs(literal))
+            if component is not None:
+                assigned[component] += 1
         
         for literal in changes:
             variable = abs(literal)
-            state[variable], watches = [], state[variable]
-            assert(len(watches) > 0)
+            watches = state[variable]
+            if not watches:
+                continue
+
+            # The watches that stay are moved to the front of the list.
+            j = 0
             for i in range(len(watches)):
-                xor, unassigned = watches[i]
-                if xor.propagate(control.assignment, unassigned):
+                watch = watches[i]
+                xor, unassigned = watch
+                if xor.propagate(values, unassigned):
                     # We found an unassigned literal, which is watched next.
-                    self.__add_watch(control, xor, unassigned, (control.thread_id,))
+                    self.__add_watch(xor, unassigned, (control.thread_id,))
                 else:
                     # Here the constraint is either unit, satisfied, or
                     # conflicting. In any case, we can keep the watch because
                     # (*) the current decision level has to be backtracked
                     # before the constraint can become unit again.
-                    state[variable].append((xor, unassigned))                                                           
+                    watches[j] = watch
+                    j += 1
                     
-                    ## GJE
-                    conflict, partial, clause = xor.reason_gje(columns, control.assignment, cutoff)
-                    if conflict:
-                        if not control.add_nogood(partial):
-                            return
-                    elif clause:
-                        for lit in clause:
-                            if not control.add_nogood(partial+[-lit]):
-                                return                                
-                    
-            if len(state[variable]) == 0:
-                control.remove_watch( variable)
-                control.remove_watch(-variable)
-                state.pop(variable)
+                    ## GJE on the component of the constraint
+                    component = self.__component[variable]
+                    if self.__trigger == "change":
+                        run = schedules[component].run(assigned[component])
+                    else:
+                        self.__dirty[control.thread_id][component] = xor
+                        run = False
+                    if not self.__gje(control, xor, unassigned, component, run):
+                        # reestablish the remaining watches with the same
+                        # reason as in (*)
+                        watches[j:i + 1] = []
+                        return
+            del watches[j:]
+
+        if self.__trigger == "batch":
+            self.__gje_dirty(control)
+
+    def __gje_dirty(self, control):
+        """
+        Run GJE once on each dirty component whose schedule agrees. Returns
+        false if propagation has to stop.
+        """
+        dirty     = self.__dirty[control.thread_id]
+        assigned  = self.__assigned[control.thread_id]
+        schedules = self.__schedules[control.thread_id]
+        while dirty:
+            component, xor = dirty.popitem()
+            if schedules[component].run(assigned[component]) and not self.__gje(control, xor, None, component, True):
+                return False
+        return True
+
+    def __gje(self, control, xor, unassigned, component, run):
+        """
+        Propagate the given XOR constraint, using GJE on the matrix of its
+        component if run is set. Returns false if propagation has to stop.
+        """
+        if not run:
+            clause = xor.reason(self.__values[control.thread_id], unassigned)
+            return clause is None or control.add_clause(clause)
+
+        thread_id = control.thread_id
+        conflict, clause = xor.reason_gje(self.__matrices[thread_id][component], self.__literals[thread_id][component], self.__columns[thread_id][component], self.__values[thread_id])
+        self.__schedules[control.thread_id][component].report(conflict is not None or bool(clause))
+        if conflict is not None:
+            return self.__add_nogood(control, conflict)
+        for lit, nogood in clause:
+            if not self.__add_nogood(control, nogood+[-lit]):
+                return False
+        return True
+
+    def __add_nogood(self, control, nogood):
+        """
+        Add a nogood unless the cache of the thread skips it as a repeated
+        one. Returns false if propagation has to stop.
+        """
+        return self.__caches[control.thread_id].skip(control.assignment, nogood) or control.add_nogood(nogood)
+
+    def on_statistics(self, step, accu):
+        """
+        Report the hit rate of the nogood caches.
+        """
+        accu["Nogood Cache"] = util.cache_statistics(self.__caches)
+
+    def decide(self, thread_id, assignment, fallback):
+        """
+        Branch on the variables of the XOR constraints if a heuristic ratio
+        is set, otherwise keep the decision of the solver.
+        """
+        if not self.__heuristics:
+            return fallback
+        return self.__heuristics[thread_id].decide(self.__values[thread_id], assignment, fallback)
+
+    def undo(self, thread_id, assignment, changes):
+        """
+        Update the value mirror and the number of assigned variables of the
+        components.
+        """
+        if not self.__sat:
+            return
+        util.unassign(self.__values[thread_id], changes)
+        if self.__heuristics:
+            self.__heuristics[thread_id].unassign(changes)
+        assigned = self.__assigned[thread_id]
+        for literal in changes:
+            component = self.__component.get(abs(literal))
+            if component is not None:
+                assigned[component] -= 1
@@ -1,14 +1,16 @@
 from . import util
 from . import gje
 from itertools import chain
+from array import array
 import clingo
+import numpy as np
 
-def get_nogood(assignment, literals, display):
+def get_nogood(values, literals, display):
     ng = []
     for lit in literals:
-        if assignment.value(lit) is False:
+        if values[lit] == util.FALSE:
             ng.append(-lit)
-        elif assignment.value(lit) is True:
+        elif values[lit] == util.TRUE:
             ng.append( lit)
     return ng
 
@@ -17,11 +19,14 @@ class Matrix:
     The Matrix maintains the following invariants:
     1. Every row must contain at least three 1 entries
     2. Two watched literals, one basic and one non basic
-    
+
+    Rows are stored packed in a gje.BitMatrix.
     """
     def __init__(self, matrix):
+        if not isinstance(matrix, gje.BitMatrix):
+            matrix = gje.BitMatrix.from_rows(matrix)
         self.__rows = len(matrix)
-        self.__cols = len(matrix[0])
+        self.__cols = matrix.columns() + 1
         self.__matrix = matrix
 
     def __getitem__(self, idx):
@@ -30,6 +35,9 @@ class Matrix:
     def __setitem__(self, idx, item):
         self.__matrix[idx] = item
 
+    def copy(self):
+        return Matrix(self.__matrix.copy())
+
     def __get_rows__(self):
         return self.__rows
 
@@ -37,69 +45,63 @@ class Matrix:
         return self.__cols
 
     def __print__(self):
-        for row in self.__matrix:
-            print(row)
-        print("")
+        self.__matrix.print_matrix()
 
     def __reduce__(self, col, pos):
-        pivot_row = self.__matrix[pos]
-        pivot_val = self.__matrix[pos][col]
+        bit = 1 << col
         changes = []
         unaffected = []
         
         for i in range(self.__rows):
-            if self.__matrix[i] != pivot_row:
-                if self.__matrix[i][col] == 1:
+            if i != pos:
+                if self.__matrix[i] & bit:
                     changes.append(i)
-                    for k in range(self.__cols):
-                        self.__matrix[i][k] ^= pivot_row[k]
+                    self.__matrix.xor(pos, i)
                 else:
                     unaffected.append(i)
         return changes, unaffected
 
-    def __check_conflict__(self, literals, assignment, display):
-        conflict = False
+    def __check_conflict__(self, literals, columns, values, display):
+        """
+        Returns the assigned literals of a conflicting row or None if there is
+        no conflict.
+        """
+        pbit = self.__matrix.parity_bit()
+        unassigned, true = util.masks(values, columns)
         for row in self.__matrix:
-            xor = []
             if display:
                 print(row)
-            parity = row[-1]## Find the potential conflicting parity
-            for i in range(len(row)-1):
-                if row[i] == 1:
-                    assmt = assignment.value(literals[i])
-                    if assmt is None:
-                        xor.append(literals[i])
-                    if assmt is True:
-                        parity ^= 1
+            coeffs = row & (pbit - 1)
+            parity = (row >> self.__matrix.columns()) ^ (gje.popcount(coeffs & true) & 1) ## Find the potential conflicting parity
             if display:
-                print(xor)
-            if not xor and parity == 1:
-                conflict = True
-                break
+                print([literals[i] for i in gje.bits(coeffs & unassigned)])
+            if not coeffs & unassigned and parity == 1:
+                return get_nogood(values, [literals[i] for i in gje.bits(coeffs)], display)
                             
-        return conflict
+        return None
 
     def __remove_row__(self, row):
-        self.__matrix.remove(row)
-        return self.__matrix
+        self.__matrix.remove_row(gje.BitMatrix.from_rows([row])[0])
+        self.__rows = len(self.__matrix)
+        return self.__matrix.to_rows()
 
     def __remove_col__(self, col):
-        for row in self.__matrix:
-            del row[col]
-        return self.__matrix
+        self.__matrix.remove_column(col)
+        self.__cols = self.__matrix.columns() + 1
+        return self.__matrix.to_rows()
 
-    def __update_xors__(self, xor_index, variable, literals, assignment, affected):
+    def __update_xors__(self, xor_index, variable, literals, values, affected):
         row = self.__matrix[xor_index]
         xor = []
         assigned = []
-        for i in range(len(literals)):
-            if row[i] == 1 and literals[i] != variable:
-                if assignment.value(literals[i]) is None:
+        for i in gje.bits(row & (self.__matrix.parity_bit() - 1)):
+            if literals[i] != variable:
+                if not values[literals[i]]:
                     xor.append(literals[i])
                 else:
                     assigned.append(literals[i])
         xor = xor+assigned
-        if row[-1] == 0:
+        if not row >> self.__matrix.columns():
             xor[0] = -xor[0]
 
         if affected:
@@ -107,34 +109,38 @@ class Matrix:
         return xor
 
 
-    def get_implication(self, assignment, literals, display):
+    def get_implication(self, values, literals, columns, display):
+        """
+        Returns the implied literals together with their reasons. The reason
+        of an implied literal consists of the assigned literals of the rows
+        and the reasons of the literals used to derive it.
+
+        The values of the columns, given as a numpy array of literals, are
+        gathered from the value mirror once for all rows.
+        """
         xors = []
+        xors_reasons = []
         unit = []
-        partial_assignment = []
+        reasons = []
         ## Get reduced XORs via UP
+        pbit = self.__matrix.parity_bit()
+        unassigned, true = util.masks(values, columns)
         for row in self.__matrix:
-            parity = row[-1]
-            xor = []
-            for i in range(len(literals)):
-                if row[i] == 1:
-                    if assignment.value(literals[i]) == None:
-                        xor.append(literals[i])
-                    elif assignment.value(literals[i]) == True:
-                        parity = parity ^ 1
-                        if literals[i] not in partial_assignment:
-                            partial_assignment.append(literals[i])
-                    elif assignment.value(literals[i]) == False:
-                        if -literals[i] not in partial_assignment:
-                            partial_assignment.append(-literals[i])
+            coeffs = row & (pbit - 1)
+            parity = (row >> self.__matrix.columns()) ^ (gje.popcount(coeffs & true) & 1)
+            xor = [literals[i] for i in gje.bits(coeffs & unassigned)]
+            reason = [literals[i] if (true >> i) & 1 else -literals[i] for i in gje.bits(coeffs & ~unassigned)]
             if len(xor) == 1:
                 if parity == 0: 
                     unit.append(-xor[0])
                 elif parity == 1:
                     unit.append( xor[0])
+                reasons.append(reason)
             else:
                 if parity == 0 and xor:
                     xor[0] = -xor[0]
                 xors.append(xor)
+                xors_reasons.append(reason)
 
         if display:
             print("xors after simplicacion %s"%xors)
@@ -145,10 +151,13 @@ class Matrix:
         if xors:
             while True:
                 state = unit[:]
-                for lit in unit:
+                k = 0
+                while k < len(unit):
+                    lit = unit[k]
                     if display:
                         print("lit %s"%lit)
-                    for xor in xors:
+                    for j in range(len(xors)):
+                        xor = xors[j]
                         if display:
                             print("xor %s"%xor)
                         if not xor:
@@ -160,71 +169,83 @@ class Matrix:
                                 xor.remove(lit)
                                 if xor:# and lit > 0:
                                     xor[0] = -xor[0]## Keep the even parity
-                                #elif xor and lit < 0:
-                                #    xor[0] = -xor[0]## Keep the even parity
+                                xors_reasons[j] = xors_reasons[j] + [l for l in reasons[k] if l not in xors_reasons[j]]
                             elif -lit in xor:
                                 if display:
                                     print("negative case")
                                 xor.remove(-lit)
-                                #if xor and lit  0:
-                                #    xor[0] = -xor[0]## Keep the even parity
+                                xors_reasons[j] = xors_reasons[j] + [l for l in reasons[k] if l not in xors_reasons[j]]
                             if display:
                                 print(xor)
                             if len(xor) == 1: ## New implication
                                 unit.append(xor[0])
+                                reasons.append(xors_reasons[j])
                                 xor.remove(xor[0])
+                    k += 1
 
                 if unit == state:
                     break
 
-        return unit, partial_assignment
+        return unit, reasons
 
 
 
-class XOR:
+class XOR(object):
     """
     A XOR constraint maintains the following invariants:
     1. there are at least two literals, and
-    2. the first two literals are unassigned, or all literals are assigned and
-       the first two literals have been assigned last on the same decision
+    2. the two watched literals are unassigned, or all literals are assigned
+       and the watched literals have been assigned last on the same decision
        level.
     Furthermore, an index pointing to the literal after the literal assigned
     last is maintained. We start the search for the next unassigned literal
     from this point. This is important to get the amortized linear propagation
     time.
+
+    The literals are never modified and can be shared by the XORs of all
+    threads. They are the slice [begin, end) of an array of literals as
+    returned by util.pack. Only the positions of the watched literals and the
+    index belong to a thread.
     """
-    def __init__(self, literals):
-        assert(len(literals) >= 2)
+    __slots__ = ("__literals", "__begin", "__size", "__watches", "__index")
+
+    def __init__(self, literals, begin=0, end=None):
+        if end is None:
+            end = len(literals)
+        assert(end - begin >= 2)
         self.__literals = literals
+        self.__begin = begin
+        self.__size = end - begin
+        self.__watches = [0, 1]
         self.__index = 2
 
     def __len__(self):
-        return len(self.__literals)
+        return self.__size
 
     def __getitem__(self, idx):
-        return self.__literals[idx]
+        return self.__literals[self.__begin + idx]
 
-    def __setitem__(self, idx, val):
-        self.__literals[idx] = val
-        return val            
+    def watched(self, i):
+        """ The i-th watched literal """
+        return self.__literals[self.__begin + self.__watches[i]]
 
-    def propagate(self, assignment, i):
+    def propagate(self, values, i):
         """
         Propagates the given assigned index.
 
-        If an unwatched unassigned literal is found, the literals are
-        rearranged so that the given index points to it. The function returns
-        true if an such a literal is found.
+        If an unwatched unassigned literal is found, the given watch is moved
+        to it. The function returns true if an such a literal is found.
         """
         assert(i < 2)
-        for j in chain(range(self.__index, len(self)), range(2, self.__index)):
-            if assignment.value(self[j]) is None:
-                self.__index = j + 1 if j + 1 < len(self) else 2
-                self[i], self[j] = self[j], self[i]
+        watches = self.__watches
+        for j in chain(range(self.__index, len(self)), range(0, self.__index)):
+            if j != watches[0] and j != watches[1] and not values[self[j]]:
+                self.__index = j + 1 if j + 1 < len(self) else 0
+                watches[i] = j
                 return True
         return False
 
-    def reason(self, assignment, i):
+    def reason(self, values, i):
         """
         If the constraint is unit resulting or conflicting returns a reason in
         form of a clause.
@@ -233,13 +254,13 @@ class XOR:
         # unassigned and has to be propagated or has to be checked for a
         # conflict. In the second case it was assigned on the same level as the
         # propagated literal.
-        i = 1 - i
+        i = self.__watches[1 - i]
         count = 0
         clause = []
         for j in range(len(self)):
             if i == j:
                 continue
-            if assignment.is_true(self[j]):
+            if values[self[j]] == util.TRUE:
                 clause.append(-self[j])
                 count += 1
             else:
@@ -247,68 +268,238 @@ class XOR:
 
         clause.append(-self[i] if count % 2 else self[i])
 
-        return None if assignment.is_true(clause[-1]) else clause
+        return None if values[clause[-1]] == util.TRUE else clause
         
                 
 
 class Simplex_GJE:
+    """
+    Propagator keeping the matrix of each component in reduced row echelon
+    form with one basic variable per row. When a basic variable gets
+    assigned, an unassigned variable of its row becomes basic and is
+    eliminated from the other rows.
+
+    The matrices and basic variables are preprocessed once in init. Each
+    thread pivots its own copy, which is made when the thread first touches a
+    component. Pivoting yields an equivalent system, so the copies need no
+    restoration when backtracking.
+    """
     def __init__(self, cutoff):
         self.__states       = []
         self.__states_xor   = []
+        self.__threads      = []
         self.__sat          = True
         self.__consequences = []
+        self.__implied      = []
+        self.__pushed       = []
         self.__cutoff       = cutoff
         self.__literals     = []
-        self.__matrix       = []
-        self.__basic_lits   = {}
-        self.__cols_lits    = {}
-        self.__lits_xor     = []
+        self.__lits_array   = []
+        self.__values       = []
+        self.__caches       = []
+        self.__m            = []
+        self.__basic_lits   = []
+        self.__cols_lits    = []
+        self.__component    = {}
+        self.__size         = 0
         self.__display      = False
 
         
-    def __add_watch(self, ctl, xor, unassigned, thread_ids, states):
+    def __add_watch(self, xor, unassigned, thread_ids, states):
         """
         Adds a watch for the for the given index.
 
         The literal at the given index has to be either unassigned or become
         unassigned through backtracking before the associated constraint can
         become unit resulting again.
+
+        The watch lists are indexed by variable. All variables are watched in
+        the solver to keep the value mirrors up to date, so only the lists of
+        the threads are updated.
+        """
+        variable = abs(xor.watched(unassigned))
+        for thread_id in thread_ids:
+            state = states[thread_id]
+            if state[variable] is None:
+                state[variable] = []
+            state[variable].append((xor, unassigned))
+
+    def __add_xor(self, constraint, thread_ids, states):
+        """
+        Watches the given constraint in the given threads. The threads share
+        the literals of the constraint.
         """
-        variable = abs(xor[unassigned])
-        ctl.add_watch( variable)
-        ctl.add_watch(-variable)
+        literals = array('i', constraint)
         for thread_id in thread_ids:
-            states[thread_id].setdefault(variable, []).append((xor, unassigned))
+            xor = XOR(literals)
+            self.__add_watch(xor, 0, (thread_id,), states)
+            self.__add_watch(xor, 1, (thread_id,), states)
+
+    def __thread_component(self, thread_id, component):
+        """
+        Returns the matrix and the basic literals of the component for the
+        given thread, copying the preprocessed ones on first use.
+        """
+        components = self.__threads[thread_id]
+        if components[component] is None:
+            components[component] = self.__m[component].copy(), dict(self.__basic_lits[component])
+        return components[component]
+
+    def __init_component(self, init, constraints):
+        """
+        Builds the matrix of a component of the XOR constraints. Returns false
+        if the component is unsatisfiable.
+        """
+        literals = []
+        for constraint in constraints:
+            for lit in constraint:
+                if abs(lit) not in literals:
+                    literals.append(abs(lit))
+
+        # Build Matrix if more than 1 constraint
+        if len(constraints) > 1:
+            index = dict((lit, i) for i, lit in enumerate(literals))
+            matrix_ = gje.BitMatrix.from_constraints(constraints, index)
+
+            # Preprocess by reducing the matrix to Reduced Row Echelon Form
+            ## Reduce
+            matrix_.eliminate()
+
+            ## Rebuild XORs after initial GJE
+            ## Check cases if XORs of size 1, 2 or greater or equal than 3.
+            matrix = []
+            constraints = []
+            remove_columns = False
+            pbit = matrix_.parity_bit()
+            for row in matrix_:
+                constraint = [literals[i] for i in gje.bits(row & (pbit - 1))]
+                elements = len(constraint)
+                if elements > 0 and not row & pbit:
+                    constraint[0] = -constraint[0]
+                ## UNSAT
+                if elements == 0 and row & pbit:
+                    return False
+                ## Consequences
+                elif elements == 1:
+                    self.__consequences.extend(constraint)
+                    remove_columns = True
+                ## Binary XORs
+                elif elements == 2:                    
+                    self.__add_xor(constraint, range(init.number_of_threads), self.__states)
+                    remove_columns = True
+                ## Ternary XORs or greater
+                elif elements > 2:
+                    constraints.append(constraint)
+                    ## Add the row to the matrix
+                    matrix.append(row)
+
+            # There is only one constraint of size 2 or greater, then pass it to the UP state
+            if len(constraints) == 1 and len(constraints[0]) > 1:
+                for constraint in constraints:
+                    self.__add_xor(constraint, range(init.number_of_threads), self.__states)
+
+            ## There are enough constraints to build the matrix
+            elif len(constraints) > 1:
+                for constraint in constraints:
+                    self.__add_xor(constraint, range(init.number_of_threads), self.__states_xor)
+                              
+                ## Create the Matrix
+                m = Matrix(gje.BitMatrix(matrix, len(literals)))
+
+                ## Remove colums (and literals) only if parity constraints were removed from the matrix as consequences or binary xors
+                if remove_columns:            
+                    ## Columns with at least one 1
+                    used = 0
+                    for row in matrix:
+                        used |= row
+
+                    ## Remove columns of zeros
+                    for i in reversed(range(len(literals))):
+                        if not (used >> i) & 1:
+                            m.__remove_col__(i)
+                            del literals[i]
+
+                ## Get basic and non basic literals
+                basic_lits = {}
+                cols_lits  = {}
+                col = 0
+                for lit in literals:
+                    cols_lits[lit] = col
+                    if col < len(constraints):
+                        basic_lits[lit] = col
+                    col+=1
+
+                for lit in literals:
+                    self.__component[lit] = len(self.__m)
+                self.__m.append(m)
+                self.__literals.append(literals)
+                self.__lits_array.append(np.array(literals, dtype=np.intp))
+                self.__basic_lits.append(basic_lits)
+                self.__cols_lits.append(cols_lits)
+
+        elif len(constraints) == 1:
+            ## There are no enough constraints for a matrix. The single constraint goes to the UP state or is a consequence
+            for constraint in constraints:
+                if len(constraint) > 1:
+                    self.__add_xor(constraint, range(init.number_of_threads), self.__states)
+                else:
+                    self.__consequences.extend(constraint)
+        return True
 
     def init(self, init):
         """
-        Initializes xor constraints based on the symbol table to build a binary matrix.
+        Initializes xor constraints based on the symbol table to build a binary matrix per component.
         This propagator is called on fixpoints to perform Gauss-Jordan Elimination after Unit Propagation
         """
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append({})
-            self.__states_xor.append({})
-            self.__lits_xor.append({})
+        ## Start over when solving again, only the watches of the solver stay
+        self.__states       = []
+        self.__states_xor   = []
+        self.__implied      = [[] for thread_id in range(init.number_of_threads)]
+        self.__threads      = []
+        self.__sat          = True
+        self.__consequences = []
+        self.__pushed       = []
+        self.__literals     = []
+        self.__lits_array   = []
+        self.__values       = []
+        self.__caches       = []
+        self.__m            = []
+        self.__basic_lits   = []
+        self.__cols_lits    = []
+        self.__component    = {}
 
         init.check_mode = clingo.PropagatorCheckMode.Fixpoint
         ## Get the constraints
         ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
+        if ret is not None:
+            ## Binary constraints are replaced by clauses over equivalent variables
+            ret = util.equivalences(*ret)
 
-        ## Store indexes of columns to remove
-        columns_to_remove = []
-        
         if ret is None:
             self.__sat = False
         elif ret is not None:
             # NOTE: whether facts should be handled here is up to question
             #       this should only be necessary if the propagator is to be used standalone
             #       without any of the other approaches
-            constraints, facts = ret
+            constraints, facts, clauses = ret
+            for clause in clauses:
+                if not init.add_clause(clause):
+                    break
             self.__consequences.extend(facts)
             ## Add facts to the matrix. Unit xors serves to deduce more information after GJE.
             for fact in facts:
                 constraints.append([fact])
 
+            ## The mirrors also cover the variables watched in earlier calls
+            self.__size = max([self.__size] + [abs(lit) for constraint in constraints for lit in constraint])
+            variables = self.__size
+            self.__states     = [[None] * (variables + 1) for thread_id in range(init.number_of_threads)]
+            self.__states_xor = [[None] * (variables + 1) for thread_id in range(init.number_of_threads)]
+            ## All variables are watched in the solver to mirror their values
+            for variable in set(abs(lit) for constraint in constraints for lit in constraint):
+                init.add_watch( variable)
+                init.add_watch(-variable)
+
             
             """
             How the preprocessing works:
@@ -323,134 +514,18 @@ class Simplex_GJE:
             TODO: Analyze if the XORs belonging to the matrix are going to be handled in the same state as the other XORs or separately.
             """
             
-            for constraint in constraints:
-                for lit in constraint:
-                    if abs(lit) not in self.__literals:
-                        self.__literals.append(abs(lit))
+            ## Every component gets its own matrix
+            for component in util.components(constraints):
+                if not self.__init_component(init, component):
+                    self.__sat = False
+                    break
 
+            for thread_id in range(init.number_of_threads):
+                self.__threads.append([None for m in self.__m])
+                self.__values.append(util.values(init.assignment, variables))
+                self.__caches.append(util.Cache())
+                self.__pushed.append([0, 0])
 
-            ## The Matrix
-            self.__m = []
-            
-            # Build Matrix if more than 1 constraint
-            if len(constraints) > 1:
-                for constraint in constraints:
-                    row = []
-                    for lit in self.__literals:
-                        if lit in constraint or -lit in constraint:
-                            row.append(1)
-                        else:
-                            row.append(0)
-                    # If even constraint
-                    if constraint[0] < 0:
-                        row.append(0)
-                    else:
-                        row.append(1)
-                    self.__matrix.append(row)
-
-                # Preprocess by reducing the matrix to Reduced Row Echelon Form
-                ## Reduce
-                self.__matrix = gje.perform_gauss_jordan_elimination(self.__matrix,False)
-
-                ## Rebuild XORs after initial GJE
-                ## Check cases if XORs of size 1, 2 or greater or equal than 3.
-                matrix = []
-                constraints = []
-                remove_columns = False
-                for row in self.__matrix:
-                    constraint = []
-                    elements = sum(row[:-1])
-                    ## UNSAT
-                    if elements == 0 and row[-1] == 1:
-                        self.__sat = False
-                        break
-                    ## Consequences
-                    elif elements == 1:
-                        for i in range(len(row)-1):
-                            if row[i] == 1:
-                                constraint.append(self.__literals[i])
-                        if row[-1] == 0:
-                            constraint[0] = -constraint[0]
-                        self.__consequences.extend(constraint)
-                        remove_columns = True
-                    ## Binary XORs
-                    elif elements == 2:                    
-                        for i in range(len(row)-1):
-                            if row[i] == 1:
-                                constraint.append(self.__literals[i])
-                        if row[-1] == 0:
-                            constraint[0] = -constraint[0]
-                        xor = XOR(constraint)
-                        self.__add_watch(init, xor, 0, range(init.number_of_threads), self.__states)
-                        self.__add_watch(init, xor, 1, range(init.number_of_threads), self.__states)
-                        remove_columns = True
-                    ## Ternary XORs or greater
-                    elif elements > 2:
-                        for i in range(len(row)-1):
-                            if row[i] == 1:
-                                constraint.append(self.__literals[i])
-                        if row[-1] == 0:
-                            constraint[0] = -constraint[0]
-                        constraints.append(constraint)
-                        ## Add the row to the matrix
-                        matrix.append(row)
-
-                # There is only one constraint of size 2 or greater, then pass it to the UP state
-                if len(constraints) == 1 and len(constraints[0]) > 1:
-                    for constraint in constraints:
-                        xor = XOR(constraint)
-                        self.__add_watch(init, xor, 0, range(init.number_of_threads), self.__states)
-                        self.__add_watch(init, xor, 1, range(init.number_of_threads), self.__states)
-
-                ## There are enough constraints to build the matrix
-                elif len(constraints) > 1:
-                    for constraint in constraints:
-                        xor = XOR(constraint)
-                        self.__add_watch(init, xor, 0, range(init.number_of_threads), self.__states_xor)
-                        self.__add_watch(init, xor, 1, range(init.number_of_threads), self.__states_xor)
-                        for lit in constraint:
-                            for thread in range(init.number_of_threads):
-                                self.__lits_xor[thread_id].setdefault(lit, []).append(xor)
-                                
-                                  
-                    ## Create the Matrix
-                    self.__m = Matrix(matrix)
-
-                    ## Remove colums (and literals) only if parity constraints were removed from the matrix as consequences or binary xors
-                    if remove_columns:            
-                        ## Count the number of 1s per column
-                        colsums = [sum(i) for i in zip(*matrix)]
-                        del colsums[-1]
-
-                        ## Remove columns of zeros
-                        for i in reversed(range(len(colsums))):
-                            if colsums[i] == 0:
-                                self.__m.__remove_col__(i)
-                                del self.__literals[i]
-
-                        ## Update the number of columns
-                        self.__m._Matrix__cols = len(self.__literals)+1
-
-                    ## Get basic and non basic literals
-                    number_basics = len(constraints)
-                    if number_basics > 0:
-                        col = 0
-                        for lit in self.__literals:
-                            self.__cols_lits[lit] = col
-                            if col < len(constraints):
-                                self.__basic_lits[lit] = col
-                            col+=1
-
-            elif len(constraints) == 1:
-                ## There are no enough constraints for a matrix. The single constraint goes to the UP state or is a consequence
-                for constraint in constraints:
-                    if len(constraint) > 1:
-                        xor = XOR(constraint)
-                        self.__add_watch(init, xor, 0, range(init.number_of_threads), self.__states)
-                        self.__add_watch(init, xor, 1, range(init.number_of_threads), self.__states)
-                    else:
-                        self.__consequences.extend(constraint)
-                                                
         else:
             # NOTE: if the propagator is to be used standalone, this case has to be handled
             pass
@@ -472,9 +547,15 @@ class Simplex_GJE:
         if not self.__sat:
             control.add_clause([]) and control.propagate()
             return
-        for lit in self.__consequences:
-            if not control.add_clause([lit]) or not control.propagate():
-                return
+        ## The consequences and the literals implied in the thread are pushed
+        ## once per thread, the clauses stay in the solver
+        pushed = self.__pushed[control.thread_id]
+        for k, lits in enumerate((self.__consequences, self.__implied[control.thread_id])):
+            while pushed[k] < len(lits):
+                lit = lits[pushed[k]]
+                pushed[k] += 1
+                if not control.add_clause([lit]) or not control.propagate():
+                    return
 
     def propagate(self, control, changes):
         """
@@ -483,76 +564,84 @@ class Simplex_GJE:
         Generated conflicts are guaranteed to be asserting (have at least two
         literals from the current decision level).
         """
+        if not self.__sat:
+            ## Only watches of earlier calls are left
+            return
         state_xor_thread = self.__states_xor[control.thread_id]
         state_xor        = self.__states_xor
         state_thread     = self.__states[control.thread_id]
         state            = self.__states
-        basic            = self.__basic_lits
-        columns          = self.__cols_lits
-        matrix           = self.__m
-        literals         = self.__literals
+        values           = self.__values[control.thread_id]
         display          = self.__display
+        util.assign(values, changes)
                 
         for literal in changes:
             variable = abs(literal)
         
-            if variable in state_xor_thread and state_xor_thread[variable]: ## Because we are changing the xors during propagation
+            if state_xor_thread[variable]: ## Because we are changing the xors during propagation
+                component = self.__component[variable]
+                matrix, basic = self.__thread_component(control.thread_id, component)
+                columns   = self.__cols_lits[component]
+                literals  = self.__literals[component]
+                lits_array = self.__lits_array[component]
                 state_xor_thread[variable], watches = [], state_xor_thread[variable]
                 assert(len(watches) > 0)
                 
                 for i in range(len(watches)):
                     xor, unassigned = watches[i]
-                    if xor.propagate(control.assignment, unassigned):
+                    if xor.propagate(values, unassigned):
                         # Basic vabriables
                         # GJE process
                         if variable in basic:
                             row = basic[variable]
                             del basic[variable]
-                            col = columns[abs(xor._XOR__literals[unassigned])]
-                            basic[xor._XOR__literals[unassigned]] = row
+                            col = columns[abs(xor.watched(unassigned))]
+                            basic[xor.watched(unassigned)] = row
 
-                            for key in state_xor_thread.keys():
-                                state_xor_thread[key] = []
+                            for key in literals:
+                                if state_xor_thread[key] is not None:
+                                    state_xor_thread[key] = []
                                 
                             update_xor_index, unaffected = matrix.__reduce__(col, row)
                                                         
-                            self.__add_watch(control, xor, 0, (control.thread_id,), state_xor)
-                            self.__add_watch(control, xor, 1, (control.thread_id,), state_xor)
+                            self.__add_watch(xor, 0, (control.thread_id,), state_xor)
+                            self.__add_watch(xor, 1, (control.thread_id,), state_xor)
                             
                             updated_xors = []
                             unaffected_xors = []
                             for index in update_xor_index:
-                                updated_xors.append(matrix.__update_xors__(index, variable, literals, control.assignment, True))
+                                updated_xors.append(matrix.__update_xors__(index, variable, literals, values, True))
 
                             if display:
                                 print("")
                             for xor_ in updated_xors:
                                 if len(xor_) == 2:
                                     xor = XOR(xor_)
-                                    self.__add_watch(control, xor, 0, (control.thread_id,), state)
-                                    self.__add_watch(control, xor, 1, (control.thread_id,), state)
+                                    self.__add_watch(xor, 0, (control.thread_id,), state)
+                                    self.__add_watch(xor, 1, (control.thread_id,), state)
                                 elif len(xor_) == 1:
                                     ## Consequences
-                                    self.__consequences.extend(xor_)
+                                    if xor_[0] not in self.__implied[control.thread_id]:
+                                        self.__implied[control.thread_id].extend(xor_)
                                 else:
                                     xor = XOR(xor_)
-                                    self.__add_watch(control, xor, 0, (control.thread_id,), state_xor)
-                                    self.__add_watch(control, xor, 1, (control.thread_id,), state_xor)
+                                    self.__add_watch(xor, 0, (control.thread_id,), state_xor)
+                                    self.__add_watch(xor, 1, (control.thread_id,), state_xor)
                                 
                             for index in unaffected:
-                                unaffected_xors.append(matrix.__update_xors__(index, variable, literals, control.assignment, False))
+                                unaffected_xors.append(matrix.__update_xors__(index, variable, literals, values, False))
 
                             for xor_ in unaffected_xors:
                                 xor = XOR(xor_)
-                                self.__add_watch(control, xor, 0, (control.thread_id,), state_xor)
-                                self.__add_watch(control, xor, 1, (control.thread_id,), state_xor)
+                                self.__add_watch(xor, 0, (control.thread_id,), state_xor)
+                                self.__add_watch(xor, 1, (control.thread_id,), state_xor)
 
                         else:
                             # reestablish the remaining watches
-                            self.__add_watch(control, xor, unassigned, (control.thread_id,), state_xor)
+                            self.__add_watch(xor, unassigned, (control.thread_id,), state_xor)
 
                     else: ## If cannot propagate
-                        unit_clauses, partial = matrix.get_implication(control.assignment, literals, display)
+                        unit_clauses, reasons = matrix.get_implication(values, literals, lits_array, display)
                         # UP
                         # Here the constraint is either unit, satisfied, or
                         # conflicting. In any case, we can keep the watch because
@@ -561,54 +650,63 @@ class Simplex_GJE:
                         state_xor_thread[variable].append((xor, unassigned))
 
                         if not unit_clauses: ## Check for potential conflicts
-                            conflict = matrix.__check_conflict__(literals, control.assignment, display)
+                            nogood = matrix.__check_conflict__(literals, lits_array, values, display)
 
-                            if conflict:
-                                ## Return the partial assignment
-                                nogood = get_nogood(control.assignment, literals, display)
-                                if not control.add_nogood(nogood) or not control.propagate():
+                            if nogood is not None:
+                                ## Return the assigned literals of the conflicting row
+                                if not self.__add_nogood(control, nogood) or not control.propagate():
                                     return
 
-                        if unit_clauses is not None:
-                            for unit in unit_clauses:
-                                if not control.add_nogood([-unit]+partial) or not control.propagate():
-                                    return
-                        else:
-                            if not control.add_clause(partial) or not control.propagate():
+                        for unit, reason in zip(unit_clauses, reasons):
+                            if not self.__add_nogood(control, [-unit]+reason) or not control.propagate():
                                 return
-                                
-                if len(state_xor_thread[variable]) == 0:
-                    control.remove_watch( variable)
-                    control.remove_watch(-variable)
-                    state_xor_thread.pop(variable)
+
 
             # Plain UP for XOR constraints of size 2
-            if variable in state_thread:# and state[variable]:
-                state_thread[variable], watches = [], state_thread[variable]
-                assert(len(watches) > 0)
+            watches = state_thread[variable]
+            if watches:
+                # The watches that stay are moved to the front of the list.
+                j = 0
                 for i in range(len(watches)):
-                    xor, unassigned = watches[i]
-                    if xor.propagate(control.assignment, unassigned):
+                    watch = watches[i]
+                    xor, unassigned = watch
+                    if xor.propagate(values, unassigned):
                         # We found an unassigned literal, which is watched next.
-                        self.__add_watch(control, xor, unassigned, (control.thread_id,), state)
+                        self.__add_watch(xor, unassigned, (control.thread_id,), state)
                     else:
                         # Here the constraint is either unit, satisfied, or
                         # conflicting. In any case, we can keep the watch because
                         # (*) the current decision level has to be backtracked
                         # before the constraint can become unit again.
-                        state_thread[variable].append((xor, unassigned))
+                        watches[j] = watch
+                        j += 1
 
-                        clause = xor.reason(control.assignment, unassigned)
+                        clause = xor.reason(values, unassigned)
                         if clause is not None:
                             if not control.add_clause(clause) or not control.propagate():
-                                assert(state_thread[variable])
                                 # reestablish the remaining watches with the same
                                 # reason as in (*)
-                                state_thread[variable].extend(watches[i + 1:])
+                                watches[j:i + 1] = []
                                 return
+                del watches[j:]
 
-                if len(state_thread[variable]) == 0:
-                    control.remove_watch( variable)
-                    control.remove_watch(-variable)
-                    state_thread.pop(variable)
+    def __add_nogood(self, control, nogood):
+        """
+        Add a nogood unless the cache of the thread skips it as a repeated
+        one. Returns false if propagation has to stop.
+        """
+        return self.__caches[control.thread_id].skip(control.assignment, nogood) or control.add_nogood(nogood)
 
+    def on_statistics(self, step, accu):
+        """
+        Report the hit rate of the nogood caches.
+        """
+        accu["Nogood Cache"] = util.cache_statistics(self.__caches)
+
+    def undo(self, thread_id, assignment, changes):
+        """
+        Unassign the changes in the value mirror of the thread.
+        """
+        if not self.__sat:
+            return
+        util.unassign(self.__values[thread_id], changes)
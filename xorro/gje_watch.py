@@ -0,0 +1,311 @@
+from . import util
+from . import gje
+import clingo
+
+def _split(matrix):
+    """
+    Split the nonzero rows of a matrix in reduced row echelon form into rows
+    with at least two columns together with their basic columns, and units
+    given as pairs of column and value. The basic column of a row is its
+    lowest column.
+    """
+    rows, basic, units = [], [], []
+    pbit = matrix.parity_bit()
+    for row in matrix:
+        cols = row & (pbit - 1)
+        if not cols:
+            continue
+        col = gje.lowest(cols)
+        if cols == 1 << col:
+            units.append((col, bool(row & pbit)))
+        else:
+            rows.append(row)
+            basic.append(col)
+    return rows, basic, units
+
+class Rows:
+    """
+    A component of XOR constraints kept in reduced row echelon form with two
+    watched columns per row.
+
+    Every row has a basic column, which occurs in no other row. Rows are
+    packed like in gje.BitMatrix. The two watched columns of a row are
+    unassigned as long as the row has two unassigned columns, and the basic
+    column is one of them. Otherwise, the remaining watches are on the columns
+    assigned last. Assigning a column that is not watched costs nothing.
+
+    When a watched column is assigned, the row looks for another unassigned
+    column to watch or becomes unit or conflicting. When its basic column is
+    assigned, another unassigned column becomes basic and is eliminated from
+    the other rows. Pivoting yields an equivalent system, so only the
+    assignment has to be restored when backtracking.
+    """
+    def __init__(self, rows, basic, columns):
+        self.__rows     = rows
+        self.__basic    = basic
+        self.__mask     = (1 << columns) - 1
+        self.__columns  = columns
+        self.__assigned = 0
+        self.__true     = 0
+        self.__watches  = [[] for row in rows]
+        self.__watchers = [set() for col in range(columns)]
+        for r, row in enumerate(rows):
+            other = row & self.__mask & ~(1 << basic[r])
+            self.__watch(r, [basic[r], gje.lowest(other)] if other else [basic[r]])
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __getitem__(self, idx):
+        return self.__rows[idx]
+
+    def basic(self, r):
+        return self.__basic[r]
+
+    def watches(self, r):
+        return self.__watches[r]
+
+    def fixed(self):
+        """
+        The matrix with the assigned columns occurring in a row folded into
+        the parity column, reduced again. Returns None if no row has an
+        assigned column. On the top level, the returned matrix is equivalent
+        to the rows.
+        """
+        used = 0
+        for row in self.__rows:
+            used |= row
+        assigned = used & self.__mask & self.__assigned
+        if not assigned:
+            return None
+        return gje.BitMatrix(list(self.__rows), self.__columns).restrict(self.__mask & ~assigned, self.__true & assigned).eliminate()
+
+    def assign(self, col, value):
+        bit = 1 << col
+        self.__assigned |= bit
+        if value:
+            self.__true |= bit
+
+    def unassign(self, col):
+        bit = ~(1 << col)
+        self.__assigned &= bit
+        self.__true &= bit
+
+    def __watch(self, r, watches):
+        for col in self.__watches[r]:
+            if col not in watches:
+                self.__watchers[col].discard(r)
+        for col in watches:
+            self.__watchers[col].add(r)
+        self.__watches[r] = watches
+
+    def __pivot(self, r, col, todo):
+        """
+        Make the given column basic in row r and eliminate it from the other
+        rows, which have to be evaluated again.
+        """
+        self.__basic[r] = col
+        bit = 1 << col
+        row = self.__rows[r]
+        rows = self.__rows
+        for s in range(len(rows)):
+            if s != r and rows[s] & bit:
+                rows[s] ^= row
+                todo.append(s)
+
+    def __latest(self, control, lits, cols, n):
+        """ The n columns among the given ones assigned last """
+        level = control.assignment.level
+        return sorted(gje.bits(cols), key=lambda col: level(lits[col]), reverse=True)[:n]
+
+    def __nogood(self, lits, cols):
+        true = self.__true
+        return [lits[col] if (true >> col) & 1 else -lits[col] for col in gje.bits(cols)]
+
+    def propagate(self, control, lits, cols):
+        """
+        Evaluate the rows watching one of the given assigned columns. Returns
+        false if propagation has to stop.
+        """
+        todo = []
+        for col in cols:
+            todo.extend(self.__watchers[col])
+        while todo:
+            if not self.__evaluate(control, lits, todo.pop(), todo):
+                # rows changed by pivoting need valid watches even if the
+                # remaining rows are not propagated anymore
+                while todo:
+                    self.__evaluate(control, lits, todo.pop(), None)
+                return False
+        return True
+
+    def __evaluate(self, control, lits, r, todo):
+        """
+        Update the watches of row r. The row is pivoted if its basic column is
+        assigned, and unit or conflicting rows are propagated, unless todo is
+        None. Returns false if propagation has to stop.
+        """
+        row = self.__rows[r]
+        cols = row & self.__mask
+        unassigned = cols & ~self.__assigned
+        basic = self.__basic[r]
+        if todo is not None and unassigned and not (unassigned >> basic) & 1:
+            basic = gje.lowest(unassigned)
+            self.__pivot(r, basic, todo)
+
+        ## Enough unassigned columns to watch, preferably the basic one
+        if gje.popcount(unassigned) > 1:
+            first = basic if (unassigned >> basic) & 1 else gje.lowest(unassigned)
+            other = unassigned & ~(1 << first)
+            keep = [col for col in self.__watches[r] if (other >> col) & 1]
+            self.__watch(r, [first, keep[0] if keep else gje.lowest(other)])
+            return True
+
+        ## Unit or fully assigned, watch the columns assigned last
+        assigned = cols & self.__assigned
+        self.__watch(r, list(gje.bits(unassigned)) + self.__latest(control, lits, assigned, 2 - gje.popcount(unassigned)))
+        if todo is None:
+            return True
+        parity = (row >> self.__columns) ^ (gje.popcount(row & self.__true) & 1)
+        nogood = self.__nogood(lits, assigned)
+        if unassigned:
+            col = gje.lowest(unassigned)
+            lit = lits[col] if parity else -lits[col]
+            return control.add_nogood(nogood + [-lit]) and control.propagate()
+        if parity:
+            return control.add_nogood(nogood) and control.propagate()
+        return True
+
+class Watch_GJE:
+    """
+    Propagator keeping the matrix of each component of XOR constraints in
+    reduced row echelon form with one basic and one more watched column per
+    row.
+
+    The components are reduced once in init. Every thread pivots its own copy
+    and only reverts its assignment on backtracking.
+    """
+    def __init__(self):
+        self.__threads      = []
+        self.__literals     = []
+        self.__column       = {}
+        self.__consequences = []
+        self.__pushed       = []
+        self.__sat          = True
+
+    def init(self, init):
+        """
+        Reduce the matrix of each component and watch its variables. Rows with
+        a single column are consequences.
+        """
+        init.check_mode = clingo.PropagatorCheckMode.Fixpoint
+
+        ## Start over when solving again, only the watches of the solver stay
+        self.__threads      = []
+        self.__literals     = []
+        self.__column       = {}
+        self.__consequences = []
+        self.__pushed       = []
+        self.__sat          = True
+
+        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
+        if ret is None:
+            self.__sat = False
+            return
+        constraints, facts = ret
+        self.__consequences.extend(facts)
+
+        matrices = []
+        for component in util.components(constraints):
+            literals = sorted(set(abs(lit) for constraint in component for lit in constraint))
+            matrix = gje.BitMatrix.from_constraints(component, dict((lit, i) for i, lit in enumerate(literals))).eliminate()
+            if matrix.check_sat():
+                self.__sat = False
+                break
+
+            rows, basic, units = _split(matrix)
+            self.__consequences.extend(literals[col] if value else -literals[col] for col, value in units)
+            if not rows:
+                continue
+
+            for col, lit in enumerate(literals):
+                self.__column[lit] = (len(matrices), col)
+                init.add_watch( lit)
+                init.add_watch(-lit)
+            self.__literals.append(literals)
+            matrices.append((rows, basic, len(literals)))
+
+        self.__threads = [[Rows(list(rows), list(basic), columns) for rows, basic, columns in matrices] for thread_id in range(init.number_of_threads)]
+        self.__pushed  = [0] * init.number_of_threads
+
+    def check(self, control):
+        """
+        Propagate the top-level conflict or the consequences found in init,
+        each once per thread, and simplify the rows of the thread.
+        """
+        if control.assignment.decision_level == 0:
+            if not self.__sat:
+                control.add_clause([]) and control.propagate()
+                return
+            pushed = self.__pushed
+            while pushed[control.thread_id] < len(self.__consequences):
+                lit = self.__consequences[pushed[control.thread_id]]
+                pushed[control.thread_id] += 1
+                if not control.add_clause([lit]) or not control.propagate():
+                    return
+            self.__simplify(control)
+
+    def __simplify(self, control):
+        """
+        Remove the columns fixed on the top level from the rows of the thread.
+        Rows that become unit are propagated and dropped, and the basic
+        columns are chosen again. The columns keep their indexes, so the
+        watches of the solver stay valid.
+        """
+        matrices = self.__threads[control.thread_id]
+        for component, rows in enumerate(matrices):
+            matrix = rows.fixed()
+            if matrix is None:
+                continue
+            lits = self.__literals[component]
+            if matrix.check_sat():
+                control.add_clause([]) and control.propagate()
+                return
+            reduced, basic, units = _split(matrix)
+            matrices[component] = Rows(reduced, basic, len(lits))
+            for col, value in units:
+                if not control.add_clause([lits[col] if value else -lits[col]]) or not control.propagate():
+                    return
+
+    def propagate(self, control, changes):
+        """
+        Assign the changed columns of all components before evaluating the
+        rows watching them, so that undo can revert them even if propagation
+        stops early.
+        """
+        if not self.__sat:
+            ## Only watches of earlier calls are left
+            return
+        matrices = self.__threads[control.thread_id]
+        changed = {}
+        for literal in changes:
+            if abs(literal) not in self.__column:
+                continue
+            component, col = self.__column[abs(literal)]
+            matrices[component].assign(col, literal > 0)
+            changed.setdefault(component, []).append(col)
+        for component, cols in changed.items():
+            if not matrices[component].propagate(control, self.__literals[component], cols):
+                return
+
+    def undo(self, thread_id, assignment, changes):
+        """
+        Unassign the columns, the reduced matrices stay as they are.
+        """
+        if not self.__sat:
+            return
+        matrices = self.__threads[thread_id]
+        for literal in changes:
+            if abs(literal) in self.__column:
+                component, col = self.__column[abs(literal)]
+                matrices[component].unassign(col)
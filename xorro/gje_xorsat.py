@@ -1,7 +1,7 @@
 from . import util
 import clingo
 
-class XOR:
+class XOR(object):
     """
     A XOR constraint maintains the following invariants:
     1. there are at least two literals, and
@@ -12,21 +12,30 @@ class XOR:
     last is maintained. We start the search for the next unassigned literal
     from this point. This is important to get the amortized linear propagation
     time.
+
+    The literals are the slice [begin, end) of an array of literals as
+    returned by util.pack.
     """
-    def __init__(self, id, literals):
-        assert(len(literals) >= 2)
+    __slots__ = ("__literals", "__begin", "__size", "__index", "__id")
+
+    def __init__(self, id, literals, begin=0, end=None):
+        if end is None:
+            end = len(literals)
+        assert(end - begin >= 2)
         self.__literals = literals
+        self.__begin = begin
+        self.__size = end - begin
         self.__index = 2
         self.__id = id
 
     def __len__(self):
-        return len(self.__literals)
+        return self.__size
 
     def __getitem__(self, idx):
-        return self.__literals[idx]
+        return self.__literals[self.__begin + idx]
 
     def __setitem__(self, idx, val):
-        self.__literals[idx] = val
+        self.__literals[self.__begin + idx] = val
         return val
 
     def check(self, ass):
@@ -34,9 +43,12 @@ class XOR:
             return [lit if ass.is_true(lit) else -lit for lit in self]
 
     def __iter__(self):
-        return iter(self.__literals)
+        return iter(self.__literals[self.__begin:self.__begin + self.__size])
 
-    def reason(self, assignment):
+    def id(self):
+        return self.__id
+
+    def reason(self, values):
         """
         If the constraint is unit resulting or conflicting returns a reason in
         form of a clause.
@@ -44,21 +56,27 @@ class XOR:
         count, i = 0, None
         nogood = []
         for j in range(len(self)):
-            if assignment.is_true(self[j]):
+            value = values[self[j]]
+            if value == util.TRUE:
                 nogood.append(self[j])
                 count += 1
-            elif assignment.is_false(self[j]):
+            elif value == util.FALSE:
                 nogood.append(-self[j])
-            elif assignment.value(self[j]) is None:
+            else:
                 i = j
         if i is not None:
             nogood.append(self[i] if count % 2 else -self[i])
         elif i is None and count %2 != 1:
             return nogood
         
-        return None if assignment.is_true(nogood[-1]) else nogood
+        return None if values[nogood[-1]] == util.TRUE else nogood
 
 class XorSat_GJE:
+    """
+    Propagator counting the unassigned literals of the reduced XOR
+    constraints. Every thread has its own counters, which are only changed
+    by the literals passed to propagate and undo.
+    """
     def __init__(self):
         self.__states  = []
         self.__binary  = []
@@ -66,9 +84,11 @@ class XorSat_GJE:
         self.__tableau = []
         self.__sat = True
         self.__consequences = []
-        self.__assignment = []
+        self.__pushed = []
+        self.__counters = []
+        self.__values = []
         self.__lits_to_propagate = []
-        self.__update = False
+        self.__size = 0
 
     def __add_watch(self, ctl, xor, i, thread_ids):
         """
@@ -132,17 +152,29 @@ class XorSat_GJE:
         Constraints of length zero and one are handled specially, to keep the
         implementation of the general constraints simple.
         """
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append({})
-            self.__binary.append([])
-            self.__basics.append({})
-            #self.__tableau.append([]) ## This needs to work
+        ## Start over when solving again, only the watches of the solver stay
+        self.__states  = [{} for thread_id in range(init.number_of_threads)]
+        self.__basics  = [{} for thread_id in range(init.number_of_threads)]
+        self.__binary  = []
+        self.__tableau = []
+        self.__sat = True
+        self.__consequences = []
+        self.__pushed = []
+        self.__counters = []
+        self.__values = []
+        self.__lits_to_propagate = []
 
         ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
+        if ret is not None:
+            ## Binary constraints are replaced by clauses over equivalent variables
+            ret = util.equivalences(*ret)
         if ret is None:
             self.__sat = False
         else:
-            constraints, facts = ret
+            constraints, facts, clauses = ret
+            for clause in clauses:
+                if not init.add_clause(clause):
+                    break
             self.__consequences.extend(facts)
 
             ## First, check if exist constraints of size 2 and move them to the binary state
@@ -171,15 +203,19 @@ class XorSat_GJE:
                 if self.__sat:
                     ## After reduce
                     k = 0
+                    literals, offsets = util.pack(sorted(constraint) for constraint in constraints)
                     for i in range(len(constraints)):
+                        ## Unary XORs
+                        if len(constraints[i]) == 1:
+                            self.__consequences.extend(constraints[i])
                         ## Binary XORs
-                        if len(constraints[i]) == 2:
-                            xor = XOR(0,list(sorted(constraints[i])))
-                            self.__binary[thread_id].append(xor)            
+                        elif len(constraints[i]) == 2:
+                            xor = XOR(0, literals, offsets[i], offsets[i+1])
+                            self.__binary.append(xor)            
                         ## Ternary or greater XORs
                         elif len(constraints[i]) > 2:         
                             self.__lits_to_propagate.append(len(constraints[i]))
-                            xor = XOR(k,sorted(constraints[i]))
+                            xor = XOR(k, literals, offsets[i], offsets[i+1])
                             k +=1
                             self.__tableau.append(xor)
                             self.__add_basic(init, xor, range(init.number_of_threads))
@@ -187,8 +223,17 @@ class XorSat_GJE:
                                 self.__add_watch(init, xor, j, range(init.number_of_threads))
             ## Only one XOR exists
             elif len(constraints) == 1:
-                xor = XOR(0,list(sorted(constraints[0])))
-                self.__binary[thread_id].append(xor)   
+                xor = XOR(0, sorted(constraints[0]))
+                self.__binary.append(xor)   
+
+            ## Every thread counts the unassigned literals on its own, the
+            ## mirrors also cover the variables watched in earlier calls
+            self.__size = max([self.__size] + [abs(lit) for constraint in constraints for lit in constraint])
+            variables = self.__size
+            for thread_id in range(init.number_of_threads):
+                self.__counters.append(self.__lits_to_propagate[:])
+                self.__values.append(util.values(init.assignment, variables))
+                self.__pushed.append(0)
 
         init.check_mode = clingo.PropagatorCheckMode.Fixpoint
 
@@ -205,13 +250,16 @@ class XorSat_GJE:
             if not self.__sat:
                 control.add_clause([]) and control.propagate()
                 return
-            for lit in self.__consequences:
+            ## Consequences are pushed once per thread
+            pushed = self.__pushed
+            while pushed[control.thread_id] < len(self.__consequences):
+                lit = self.__consequences[pushed[control.thread_id]]
+                pushed[control.thread_id] += 1
                 if not control.add_clause([lit]) or not control.propagate():
                     return
 
         if control.assignment.is_total:
-            state = self.__binary[control.thread_id]
-            for xor in state:
+            for xor in self.__binary:
                 nogood = xor.check(control.assignment)
                 if nogood is not None:
                     control.add_nogood(nogood) and control.propagate()
@@ -219,60 +267,42 @@ class XorSat_GJE:
         
     def propagate(self, control, changes):
         """
-        Propagates XOR constraints maintaining two watches per constraint.
+        Propagates XOR constraints counting their unassigned literals.
 
-        Generated conflicts are guaranteed to be asserting (have at least two
-        literals from the current decision level).
+        The counters are updated for all changes before propagating, so that
+        undo can revert them even if propagation stops early.
         """
-        state        = self.__states[control.thread_id]
-        to_propagate = self.__lits_to_propagate
-        assignment   = self.__assignment
-        basics       = self.__basics[control.thread_id]
-        tableau      = self.__tableau
+        if not self.__sat:
+            ## Only watches of earlier calls are left
+            return
+        state    = self.__states[control.thread_id]
+        counters = self.__counters[control.thread_id]
+        values   = self.__values[control.thread_id]
 
-        if self.__update:
-            ## Update counters
-            for constraint in tableau:
-                id = constraint._XOR__id
-                literals = constraint._XOR__literals
-                unassigned = 0
-                for lit in literals:
-                    if control.assignment.value(lit) is None:
-                        unassigned+=1
-                to_propagate[id] = unassigned
+        ## Update counters and values
+        util.assign(values, changes)
+        for literal in changes:
+            for xor in state.get(abs(literal), ()):
+                counters[xor.id()] -= 1
                                 
         for literal in changes:
-            assignment.append(literal)
-            variable = abs(literal)
-            watches = state[variable]
-            assert(len(watches) > 0)
-            for i in range(len(watches)):
-                if watches[i]:
-                    xor = watches[i]
-                    if self.__update == False:
-                        to_propagate[xor._XOR__id] -= 1
-                    # Here the constraint is either unit, satisfied, or conflicting. 
-                    if to_propagate[xor._XOR__id] == 1 or to_propagate[xor._XOR__id] == 0:
-                        nogood = xor.reason(control.assignment)
-                        if nogood is not None:
-                            if not control.add_nogood(nogood) or not control.propagate():
-                                self.__update = True
-                                return
-        if self.__update == True:
-            self.__update = False
+            for xor in state.get(abs(literal), ()):
+                # Here the constraint is either unit, satisfied, or conflicting. 
+                if counters[xor.id()] <= 1:
+                    nogood = xor.reason(values)
+                    if nogood is not None:
+                        if not control.add_nogood(nogood) or not control.propagate():
+                            return
             
     def undo(self, thread_id, assignment, changes):
         """
-        Remove from assignment
+        Revert the counters and values of the given changes
         """
-        state  = self.__states[thread_id]
-        assign = self.__assignment
-        to_propagate = self.__lits_to_propagate
+        if not self.__sat:
+            return
+        state    = self.__states[thread_id]
+        counters = self.__counters[thread_id]
+        util.unassign(self.__values[thread_id], changes)
         for literal in changes:
-            if literal in assign:
-                assign.remove(literal)
-            variable = abs(literal)
-            watches = state[variable]
-            for i in range(len(watches)):
-                xor = watches[i]
-                to_propagate[xor._XOR__id] += 1
+            for xor in state.get(abs(literal), ()):
+                counters[xor.id()] += 1
@@ -4,6 +4,7 @@ Gauss-Jordan Tests Suite
 import xorro
 from xorro import gje
 from xorro import gje_simplex as simplex
+import xorro.gje_watch
 import numpy as np
 
 def cols_state_to_matrix(state):
@@ -534,3 +535,161 @@ def test_remove_col(self):
     self.assertEqual(mm.__remove_col__(2),
                      [[1, 0, 1, 1, 0, 1],
                       [0, 1, 0, 1, 1, 0]])
+
+def test_copy_matrix(self):
+    mm = simplex.Matrix([[1, 0, 1, 1, 1],
+                         [0, 1, 1, 0, 0]])
+    cp = mm.copy()
+    ## Pivot column 2 in the second row of the copy only
+    self.assertEqual(cp.__reduce__(2, 1), ([0], []))
+    self.assertEqual([cp[0], cp[1]], [0b11011, 0b00110])
+    self.assertEqual([mm[0], mm[1]], [0b11101, 0b00110])
+
+"""
+Packed Binary Matrix Tests
+"""
+def test_bit_matrix(self):
+    m = gje.BitMatrix.from_rows([[1, 0, 1, 1],
+                                 [0, 1, 1, 0]])
+    self.assertEqual(list(m), [0b1101, 0b0110])
+    self.assertEqual(m.columns(), 3)
+    self.assertEqual(m.to_rows(), [[1, 0, 1, 1],
+                                   [0, 1, 1, 0]])
+
+    m = gje.BitMatrix.from_constraints([[-2, 3, 4], [3, 5]], {2: 0, 3: 1, 4: 2, 5: 3})
+    self.assertEqual(m.to_rows(), [[1, 1, 1, 0, 0],
+                                   [0, 1, 0, 1, 1]])
+
+    ## Column 0 is true, column 2 is false, columns 1 and 3 are unassigned
+    self.assertEqual(m.restrict(0b1010, 0b0001).to_rows(), [[0, 1, 0, 0, 1],
+                                                            [0, 1, 0, 1, 1]])
+
+    self.assertEqual(m.restrict(0b1010, 0b0001).eliminate().to_rows(), [[0, 1, 0, 0, 1],
+                                                                        [0, 0, 0, 1, 0]])
+
+    self.assertEqual(m.restrict(0b1010, 0b0001).eliminate().deduce_clause([2, 3, 4, 5]), [3, -5])
+
+    ## The second row of the reduced matrix is the sum of both original rows
+    r = m.restrict(0b1010, 0b0001, True).eliminate()
+    self.assertEqual(r.to_rows(), [[0, 1, 0, 0, 1],
+                                   [0, 0, 0, 1, 0]])
+    self.assertEqual([r.combination(0), r.combination(1)], [0b0111, 0b1101])
+    self.assertEqual(r.units(), [(0, (1, True)), (1, (3, False))])
+    self.assertEqual(r.conflicts(), [])
+
+    m = gje.BitMatrix.from_rows([[1, 1, 0],
+                                 [1, 1, 1]]).eliminate()
+    self.assertEqual(m.check_sat(), True)
+    self.assertEqual(m.to_rows(), [[1, 1, 0],
+                                   [0, 0, 1]])
+
+    m.remove_column(1)
+    self.assertEqual(m.to_rows(), [[1, 0],
+                                   [0, 1]])
+
+def test_echelon(self):
+    m = gje.BitMatrix.from_rows([[1, 0, 1, 0, 1],
+                                 [0, 1, 1, 1, 0]]).eliminate()
+    e = gje.Echelon(m)
+    self.assertEqual(e.implied(0), None)
+
+    ## Column 2 true moves the pivot of no row but changes both
+    self.assertEqual(sorted(e.assign(2, True)), [0, 1])
+    self.assertEqual(e.assigned(), 1)
+    self.assertEqual(e.implied(0), (0, False))
+    self.assertEqual(e.implied(1), None)
+    self.assertEqual(e.reason(0), 0b100)
+
+    ## Column 0 true conflicts with the first row
+    e.assign(0, True)
+    self.assertEqual(e.conflict(0), True)
+
+    e.backtrack(1)
+    self.assertEqual(e.assigned(), 1)
+    self.assertEqual(e.conflict(0), False)
+
+    ## Column 1 is the pivot of the second row, column 3 becomes its pivot
+    e.assign(1, False)
+    self.assertEqual(e.implied(1), (3, True))
+    self.assertEqual(e.reason(1), 0b110)
+
+    e.backtrack(0)
+    self.assertEqual([e[i] for i in range(len(e))], list(m))
+
+def test_sparse_matrix(self):
+    m = gje.SparseMatrix([[0, 1, 2], [1, 2], [2, 3]], [1, 0, 1])
+    self.assertEqual(m.nonzeros(), 7)
+    m.eliminate()
+    self.assertEqual(m.check_sat(), False)
+    ## Pivots 1, 0 and 3 occur in exactly one row, column 2 is free
+    self.assertEqual(list(m), [([1, 2], 0),
+                               ([0], 1),
+                               ([2, 3], 1)])
+
+    m = gje.SparseMatrix([[0, 1], [0, 1]], [1, 0]).eliminate()
+    self.assertEqual(m.check_sat(), True)
+    self.assertEqual(list(m), [([0, 1], 1),
+                               ([], 1)])
+
+def test_schedule(self):
+    s = gje.Schedule(10, 0.5, 4)
+    self.assertEqual(s.run(4), False)
+    self.assertEqual(s.run(5), True)
+
+    ## Useless calls skip 1, 3, 4 (the limit) triggers
+    s.report(False)
+    self.assertEqual([s.run(5) for i in range(2)], [False, True])
+    s.report(False)
+    self.assertEqual([s.run(5) for i in range(4)], [False, False, False, True])
+    s.report(False)
+    s.report(True)
+    self.assertEqual([s.run(5) for i in range(3)], [False, False, True])
+    self.assertEqual((s.calls(), s.useful()), (4, 1))
+
+class _Control:
+    ## Just enough of a propagate control to run the watched rows
+    def __init__(self):
+        self.assignment = self
+        self.nogoods = []
+
+    def level(self, lit):
+        return 1
+
+    def add_nogood(self, nogood):
+        self.nogoods.append(nogood)
+        return True
+
+    def propagate(self):
+        return True
+
+def test_watched_rows(self):
+    ## x1^x2^x3 = 1, x2^x3^x4 = 0
+    rows = xorro.gje_watch.Rows([0b10111, 0b01110], [0, 3], 4)
+    self.assertEqual(rows.watches(0), [0, 1])
+    self.assertEqual(rows.watches(1), [3, 1])
+    ## Assigning an unwatched column costs nothing
+    control = _Control()
+    rows.assign(2, False)
+    self.assertTrue(rows.propagate(control, [1, 2, 3, 4], [2]))
+    self.assertEqual(control.nogoods, [])
+    ## Assigning a basic column pivots, x2 and x4 are implied false
+    rows.assign(0, True)
+    self.assertTrue(rows.propagate(control, [1, 2, 3, 4], [0]))
+    self.assertEqual(rows.basic(0), 1)
+    self.assertEqual(rows[1], 0b11001)
+    self.assertEqual(control.nogoods, [[1, -3, 2], [1, 4]])
+    ## Backtracking keeps the equivalent matrix
+    rows.unassign(0)
+    rows.unassign(2)
+    self.assertEqual(rows[1], 0b11001)
+
+def test_simplify(self):
+    ## x1^x2^x3 = 1, x1^x2^x4 = 0, x1^x4 = 1, x1^x2^x3^x4 = 1 with x1 true and x4 false
+    matrix, kept = xorro.gje.BitMatrix([0b10111, 0b01011, 0b11001, 0b11111], 4).simplify(0b1001, 0b0001)
+    self.assertEqual(kept, [1, 2])
+    self.assertEqual(list(matrix), [0b011, 0b101])
+    ## Rows fold assigned columns they contain and keep the column indexes
+    rows = xorro.gje_watch.Rows([0b10111, 0b01110], [0, 3], 4)
+    self.assertIsNone(rows.fixed())
+    rows.assign(0, True)
+    self.assertEqual(list(rows.fixed()), [0b00110, 0b01000])
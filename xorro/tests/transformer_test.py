@@ -5,6 +5,7 @@ from xorro import transformer
 import clingo
 from textwrap import dedent
 from . import gje_test
+from . import util_test
 
 class TestCase(unittest.TestCase):
     def assertRaisesRegex(self, *args, **kwargs):
@@ -12,14 +13,14 @@ class TestCase(unittest.TestCase):
             if sys.version_info[0] < 3
             else unittest.TestCase.assertRaisesRegex(self, *args, **kwargs))
     
-def solve(s, mode):
+def solve(s, mode, trigger="change"):
     messages = []
     prg = clingo.Control(logger=lambda c, m: messages.append(m))
     with prg.builder() as b:
         transformer.transform([s], b.add)
     prg.ground([("base", [])])
 
-    xorro.translate(mode, prg, 0.0)
+    xorro.translate(mode, prg, 0.0, trigger=trigger)
 
     prg.configuration.solve.models = 0
 
@@ -33,10 +34,40 @@ def solve(s, mode):
     return models
 
 
+def solve_twice(s, mode, step=None):
+    ## Solve the rewritten program twice on the same control, grounding the
+    ## given step in between
+    prg = clingo.Control(["0"], logger=lambda c, m: None)
+    prg.add("base", [], s)
+    prg.ground([("base", [])])
+    xorro.translate(mode, prg, 0.0)
+    models = []
+    for i in range(2):
+        if i and step is not None:
+            prg.add("step", [], step)
+            prg.ground([("step", [])])
+        models.append([])
+        prg.solve(on_model=lambda m: models[-1].append(sorted(str(sym) for sym in m.symbols(atoms=True) if not sym.name.startswith("__"))))
+        models[-1].sort()
+    return models
+
+class _Backend:
+    ## Backend numbering atoms from 10 and recording rules
+    def __init__(self):
+        self.atoms = 9
+        self.rules = []
+
+    def add_atom(self):
+        self.atoms += 1
+        return self.atoms
+
+    def add_rule(self, head, body=[], choice=False):
+        self.rules.append((head, body))
+
 class TestProgramTransformer(TestCase):
 
 
-    modes = ["count", "list", "tree", "countp", "up", "gje-prop", "gje-simplex", "gje-xorsat" ]
+    modes = ["count", "list", "tree", "cnf", "hybrid", "countp", "up", "gje-prop", "gje-simplex", "gje-xorsat", "gje-watch" ]
 
     def test_trivial(self):
         for mode in TestProgramTransformer.modes:
@@ -66,6 +97,33 @@ class TestProgramTransformer(TestCase):
         for mode in TestProgramTransformer.modes:
             self.assertEqual(solve("{a;b;c}. &even{ a:a;b:b;c:c }. a.", mode), [["a", "b"], ['a', 'c']])
 
+    def test_solve_twice(self):
+        prg = dedent("""\
+            {p(1..7)}.
+            :- p(6).
+            p(1) :- p(2).
+            __parity(0,odd). __parity(0,odd,(0,)) :- p(3). __parity(0,odd,(1,)) :- p(2).
+            __parity(1,odd). __parity(1,odd,(0,)) :- p(4).
+            __parity(2,odd). __parity(2,odd,(0,)) :- p(7). __parity(2,odd,(1,)) :- p(5).
+            __parity(3,even). __parity(3,even,(0,)) :- not p(5).
+            __parity(4,even). __parity(4,even,(0,)) :- p(6).
+            """)
+        for mode in TestProgramTransformer.modes + ["gje-prop-n", "up-check", "tree-check"]:
+            first, second = solve_twice(prg, mode)
+            self.assertEqual(len(first), 3)
+            self.assertEqual(first, second)
+
+        ## The rewriting approaches translate the constraints once, the
+        ## propagators have to pick up the new ones
+        step = dedent("""\
+            {q(1..4)}.
+            __parity(5,odd). __parity(5,odd,(0,)) :- q(1). __parity(5,odd,(1,)) :- q(2). __parity(5,odd,(2,)) :- p(3). __parity(5,odd,(3,)) :- q(4).
+            __parity(6,even). __parity(6,even,(0,)) :- q(2). __parity(6,even,(1,)) :- q(3). __parity(6,even,(2,)) :- p(1).
+            """)
+        models = [solve_twice(prg, "count")[0], solve_twice(prg + step, "count")[0]]
+        for mode in ["countp", "up", "gje-prop", "gje-prop-n", "gje-simplex", "gje-xorsat", "gje-watch", "up-check", "tree-check"]:
+            self.assertEqual(solve_twice(prg, mode, step), models)
+
     def test_complex(self):
         prg = dedent("""\
             {p(1..10)}.
@@ -79,6 +137,19 @@ class TestProgramTransformer(TestCase):
         for mode in TestProgramTransformer.modes:
             if mode != "count":
                 self.assertEqual(solve(prg, mode), models)
+        for mode in ["gje-prop", "gje-prop-n"]:
+            for trigger in ["batch", "fixpoint", "total"]:
+                self.assertEqual(solve(prg, mode, trigger), models)
+
+    def test_shared_xor(self):
+        backend, memo = _Backend(), {}
+        aux = xorro.translate_binary_xor(backend, 1, 2, memo)
+        ## Pairs of the same variables share an atom, negated if one literal is negative
+        self.assertEqual(xorro.translate_binary_xor(backend, 2, 1, memo), aux)
+        self.assertEqual(xorro.translate_binary_xor(backend, -1, -2, memo), aux)
+        self.assertEqual(xorro.translate_binary_xor(backend, 2, -1, memo), -aux)
+        self.assertEqual(len(backend.rules), 2)
+        self.assertNotEqual(xorro.translate_binary_xor(backend, 1, 3, memo), aux)
 
 
     ## Gauss-Jordan Elimination Tests
@@ -118,9 +189,61 @@ class TestProgramTransformer(TestCase):
     def test_incremental_reduce(self):
         gje_test.test_incremental_reduce(self)
 
+    def test_bit_matrix(self):
+        gje_test.test_bit_matrix(self)
+
+    def test_echelon(self):
+        gje_test.test_echelon(self)
+
+    def test_sparse_matrix(self):
+        gje_test.test_sparse_matrix(self)
+
+    def test_watched_rows(self):
+        gje_test.test_watched_rows(self)
+
+    def test_simplify(self):
+        gje_test.test_simplify(self)
+
+    def test_schedule(self):
+        gje_test.test_schedule(self)
+
     def test_remove_row(self):
         gje_test.test_remove_row(self)
 
     def test_remove_col(self):
         gje_test.test_remove_col(self)
 
+    def test_copy_matrix(self):
+        gje_test.test_copy_matrix(self)
+
+
+    ## Utility Tests
+    def test_components(self):
+        util_test.test_components(self)
+
+    def test_pack(self):
+        util_test.test_pack(self)
+
+    def test_parities(self):
+        util_test.test_parities(self)
+
+    def test_verifier(self):
+        util_test.test_verifier(self)
+
+    def test_equivalences(self):
+        util_test.test_equivalences(self)
+
+    def test_cache(self):
+        util_test.test_cache(self)
+
+    def test_heuristic(self):
+        util_test.test_heuristic(self)
+
+    def test_select_approaches(self):
+        util_test.test_select_approaches(self)
+
+    def test_definitions(self):
+        util_test.test_definitions(self)
+
+    def test_preprocessing(self):
+        util_test.test_preprocessing(self)
@@ -0,0 +1,158 @@
+"""
+Utility Tests Suite
+"""
+import xorro
+
+def test_components(self):
+    self.assertEqual(xorro.util.components([[1, 2], [-3, 4], [2, 5], [6, 7, 8], [4, -8]]),
+                     [[[1, 2], [2, 5]],
+                      [[-3, 4], [6, 7, 8], [4, -8]]])
+    self.assertEqual(xorro.util.components([]), [])
+    self.assertEqual(xorro.util.components([[1, 2], [3], [], [-2, 4]], ["a", "b", "c", "d"]), [["a", "d"], ["b"], ["c"]])
+
+def test_pack(self):
+    literals, offsets = xorro.util.pack([[-1, 2, 3], [4, 5]])
+    self.assertEqual(list(literals), [-1, 2, 3, 4, 5])
+    self.assertEqual(list(offsets), [0, 3, 5])
+
+def test_parities(self):
+    literals, offsets = xorro.util.pack([[-1, 2, 3], [3, 4], []])
+    parities = xorro.util.Parities(xorro.util.occurrences(literals, offsets), offsets)
+    ## The empty constraint is violated right away
+    self.assertEqual(parities.violated(), 2)
+    parities = xorro.util.Parities(xorro.util.occurrences(literals, offsets), offsets[:3])
+    parities.assign([3, -4])
+    self.assertEqual(parities.violated(), None)
+    parities.assign([1, 2])
+    self.assertEqual(parities.violated(), 0)
+    self.assertEqual(parities.violated(), 0)
+    parities.unassign([2])
+    self.assertEqual(parities.violated(), None)
+    parities.assign([-2])
+    self.assertEqual(parities.violated(), None)
+
+def test_verifier(self):
+    literals, offsets = xorro.util.pack([[-1, 2, 3], [3, 4], [1, 4], []])
+    verifier = xorro.util.Verifier(literals, offsets)
+    values = bytearray(2 * 4 + 1)
+    xorro.util.assign(values, [1, 2, -3, 4])
+    self.assertEqual(verifier.violated(values), [2, 3])
+    self.assertEqual(verifier.violated(values, True), [2])
+    xorro.util.unassign(values, [-3])
+    xorro.util.assign(values, [3])
+    self.assertEqual(verifier.violated(values), [0, 1, 2, 3])
+
+def test_equivalences(self):
+    ## x2 = -x1 and x3 = x2 turn x1^x3^x4^x5 = 1 into x4 = x5
+    constraints, facts, clauses = xorro.util.equivalences([[1, 2], [-2, 3], [1, 3, 4, 5], [3, 5, 6]], [])
+    self.assertEqual(constraints, [[-1, 4, 6]])
+    self.assertEqual(facts, [])
+    self.assertEqual(clauses, [[2, 1], [-2, -1], [3, 1], [-3, -1], [-5, 4], [5, -4]])
+    ## Facts are mapped to the representatives
+    self.assertEqual(xorro.util.equivalences([[1, 2], [1, 3, 4]], [2])[1], [-1])
+    ## Contradicting equivalences
+    self.assertIsNone(xorro.util.equivalences([[1, 2], [-1, 2]], []))
+
+class _Assignment:
+    ## Assignment with a fixed set of false literals
+    def __init__(self, false):
+        self.false = false
+
+    def is_false(self, lit):
+        return lit in self.false
+
+    def is_free(self, lit):
+        return lit not in self.false and -lit not in self.false
+
+def test_cache(self):
+    cache = xorro.util.Cache(2)
+    ## New nogoods are added
+    self.assertFalse(cache.skip(_Assignment({1}), [1, 2]))
+    ## Repeated nogoods are skipped only if satisfied
+    self.assertFalse(cache.skip(_Assignment(set()), [2, 1]))
+    self.assertTrue(cache.skip(_Assignment({1}), [1, 2]))
+    ## The least recently used nogood is evicted
+    self.assertFalse(cache.skip(_Assignment({3}), [3]))
+    self.assertFalse(cache.skip(_Assignment({4}), [4]))
+    self.assertFalse(cache.skip(_Assignment({1}), [1, 2]))
+    self.assertFalse(cache.skip(_Assignment({3}), [3]))
+    self.assertEqual((cache.lookups(), cache.hits()), (7, 1))
+    self.assertEqual(xorro.util.cache_statistics([cache, xorro.util.Cache()])["hit rate"], 1.0 / 7)
+
+def test_heuristic(self):
+    literals, offsets = xorro.util.pack([[1, 2, 3], [-3, 4], [4, 5, 6, 7]])
+    heuristic = xorro.util.Heuristic(literals, offsets, 1.0)
+    values = bytearray(15)
+    def assign(changes):
+        xorro.util.assign(values, changes)
+        heuristic.assign(changes)
+    ## The shortest constraint is satisfied by making -3 true
+    self.assertEqual(heuristic.branch(values), -3)
+    assign([3])
+    self.assertEqual(heuristic.branch(values), 4)
+    ## An odd number of true literals makes the branching literal false
+    assign([1, 2, 4])
+    self.assertEqual(heuristic.branch(values), -5)
+    assign([5, 6, 7])
+    self.assertIsNone(heuristic.branch(values))
+    heuristic.unassign([5, 6, 7])
+    xorro.util.unassign(values, [5, 6, 7])
+    self.assertEqual(heuristic.branch(values), -5)
+    ## Half of the decisions are left to the solver
+    heuristic = xorro.util.Heuristic(literals, offsets, 0.5)
+    heuristic.assign([3, 1, 2, 4])
+    self.assertEqual([heuristic.decide(values, _Assignment(set()), 9) for i in range(4)], [9, -5, 9, -5])
+
+def test_select_approaches(self):
+    variables = {0: {1, 2, 3}, 1: {3, 4}, 2: {4, 5, 6}, 3: {7, 8}, 4: {9, 10, 11, 12, 13, 14}, 5: set()}
+    ## The first three constraints overlap, the others are split by size
+    self.assertEqual(xorro.util.select_approaches(variables, 3, 3), ([3, 5], [4], [0, 1, 2]))
+    self.assertEqual(xorro.util.select_approaches(variables, 6, 4), ([0, 1, 2, 3, 4, 5], [], []))
+
+def test_definitions(self):
+    definitions = xorro.util.Definitions()
+    definitions.rule(False, [1], [-5])
+    definitions.rule(False, [2], [5, 6])
+    definitions.rule(False, [3], [5])
+    definitions.rule(False, [3], [6])
+    definitions.rule(True, [4], [5])
+    definitions.weight_rule(False, [7], 1, [(5, 1)])
+    definitions.rule(False, [7], [5])
+    self.assertEqual([definitions.alias(atom) for atom in range(1, 9)], [-5, 2, 3, 4, 5, 6, 7, 8])
+
+def test_preprocessing(self):
+    ## Signs are folded into the parities, facts are units
+    xors = xorro.util.xor_r_to_xors(([[1, 2, 3], [-2, 4]], [5, -6]))
+    self.assertEqual(xors.names, [1, 2, 3, 4, 5, 6])
+    self.assertEqual([(list(v), p) for v, p in (xors[i] for i in range(len(xors)))], [([0, 1, 2], 1), ([1, 3], 0), ([4], 1), ([5], 0)])
+    self.assertEqual(xorro.util.xor_r_to_xors(None)[0], (xorro.util.array('i'), 1))
+
+    ## Reduce a+b+c=1, b+d=0, d=1
+    xors = xorro.util.XORs()
+    xors.add_literals([1, 2, 3], 1)
+    xors.add_literals([2, -4], 1)
+    xors.add_literals([4], 1)
+    for density in (0.0, 1.0):
+        reduced = xorro.util.pre_gje(xors, False, density)
+        self.assertEqual(sorted((list(v), p) for v, p in (reduced[i] for i in range(len(reduced)))), [([0, 2], 0), ([1], 1), ([3], 1)])
+
+    ## Chain a+b+c+d+e=1 by two auxiliary atoms
+    xors = xorro.util.XORs()
+    xors.add_literals([1, 2, 3, 4, 5], 1)
+    splitted, choices, done = xorro.util.split(xors, 3, False)
+    self.assertTrue(done)
+    self.assertEqual(choices, ["{ __aux_1 ; __aux_2 }. "])
+    self.assertEqual(xorro.util.parities_to_program(splitted, {1: "a", 2: "b(1)"}, choices).split("\n"), [
+        "__parity(0,odd).",
+        "__parity(0,odd,(0,)) :- a.",
+        "__parity(0,odd,(1,)) :- b(1).",
+        "__parity(0,odd,(2,)) :- __aux_1.",
+        "__parity(1,even).",
+        "__parity(1,even,(0,)) :- __aux_1.",
+        "__parity(1,even,(1,)) :- 3.",
+        "__parity(1,even,(2,)) :- __aux_2.",
+        "__parity(2,even).",
+        "__parity(2,even,(0,)) :- __aux_2.",
+        "__parity(2,even,(1,)) :- 4.",
+        "__parity(2,even,(2,)) :- 5.",
+        "{ __aux_1 ; __aux_2 }. "])
@@ -11,6 +11,8 @@ str_location -- Turn a location into a string.
 
 Constants:
 g_aux_name -- The name for auxiliary predicates used in the translation.
+g_pre_name -- The name for auxiliary predicates holding the parity constraints
+              before preprocessing.
 """
 
 from clingo import ast as _ast
@@ -19,6 +21,7 @@ import clingo as _clingo
 # {{{1 basic functions and constants
 
 g_aux_name = "__parity"
+g_pre_name = "__xor"
 
 def str_location(loc):
     """
@@ -249,11 +252,13 @@ class ProgramTransformer(Transformer):
     Members:
     __add    -- Callback to add auxiliary statements.
     __remove -- Boolean indicating that the next rule should be removed.
+    __name   -- The name of the auxiliary predicates.
     """
-    def __init__(self, add):
+    def __init__(self, add, name=g_aux_name):
         self.__add    = add
         self.__remove = False
         self.__id     = 0
+        self.__name   = name
 
     def visit_Rule(self, rule):
         """
@@ -275,19 +280,19 @@ class ProgramTransformer(Transformer):
                 self.__remove = True
                 i = _ast.Symbol(atom.location, _clingo.Number(self.__id))
                 ct = _ast.Symbol(atom.location, _clingo.Function(atom.term.name))
-                head = _ast.SymbolicAtom(_ast.Function(atom.location, g_aux_name, [i, ct], False))
+                head = _ast.SymbolicAtom(_ast.Function(atom.location, self.__name, [i, ct], False))
                 head = _ast.Literal(atom.location, _ast.Sign.NoSign, head)
                 self.__add(_ast.Rule(atom.location, head, []))
                 for element in atom.elements:
                     head = _ast.Function(atom.location, "", [theory_term_to_term(t) for t in element.tuple], False)
-                    head = _ast.SymbolicAtom(_ast.Function(atom.location, g_aux_name, [i, ct, head], False))
+                    head = _ast.SymbolicAtom(_ast.Function(atom.location, self.__name, [i, ct, head], False))
                     head = _ast.Literal(atom.location, _ast.Sign.NoSign, head)
                     body = element.condition
                     self.__add(_ast.Rule(atom.location, head, body))
                 self.__id += 1
         return atom
 
-def transform(inputs, add):
+def transform(inputs, add, name=g_aux_name):
     """
     Rewrites the given statement if it is a parity constraint and the resulting
     rules to the program using a callback.
@@ -296,8 +301,9 @@ def transform(inputs, add):
     statement -- The statement to rewrite.
     add       -- Callback to add statements to the logic program beeing
                  rewritten.
+    name      -- The name of the auxiliary predicates.
     """
-    pt = ProgramTransformer(add)
+    pt = ProgramTransformer(add, name)
     def add_if_not_none(statement):
         statement = pt(statement)
         if statement is not None:
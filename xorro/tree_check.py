@@ -11,14 +11,25 @@ from . import util
 def tree_check(constraint):
         half = len(constraint)//2
         left, right = constraint[half:], constraint[:half]
-        if len(constraint) == 1:
+        if len(constraint) == 0:
+            return False
+        elif len(constraint) == 1:
             return constraint[0]
         else:
             return tree_check(left) ^ tree_check(right)
     
-class XOR:
-    def __init__(self, literals):
+class XOR(object):
+    """
+    The literals of a XOR are the slice [begin, end) of an array of literals
+    as returned by util.pack.
+    """
+    __slots__ = ("__literals", "__begin", "__end")
+
+    def __init__(self, literals, begin, end):
         self.__literals = literals
+        self.__begin = begin
+        self.__end = end
+
 
     def reason(self, ass):
         constraint = [True if ass.is_true(lit) else False for lit in self]
@@ -26,32 +37,8 @@ class XOR:
             return [lit if ass.is_true(lit) else -lit for lit in self]
         
     def __iter__(self):
-        return iter(self.__literals)
+        return iter(self.__literals[self.__begin:self.__end])
 
-class TreeCheckPropagator:
+class TreeCheckPropagator(util.TotalCheck):
     def __init__(self):
-        self.__states = []
-
-    def init(self, init):
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append([])
-
-        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
-        if ret is None:
-            constraints = [[]]
-        else:
-            constraints, facts = ret
-            constraints.extend([fact] for fact in facts)
-
-        for constraint in constraints:
-            xor = XOR(list(sorted(constraint)))
-            self.__states[thread_id].append(xor)
-
-    def check(self, control):
-        if control.assignment.is_total:
-            state = self.__states[control.thread_id]
-            for xor in state:
-                nogood = xor.reason(control.assignment)  
-                if nogood is not None:
-                    control.add_nogood(nogood) and control.propagate()
-                    return
+        util.TotalCheck.__init__(self, XOR, XOR.reason)
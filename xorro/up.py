@@ -2,50 +2,62 @@ from . import util
 from itertools import chain
 import clingo
 
-class XOR:
+class XOR(object):
     """
     A XOR constraint maintains the following invariants:
     1. there are at least two literals, and
-    2. the first two literals are unassigned, or all literals are assigned and
-       the first two literals have been assigned last on the same decision
+    2. the two watched literals are unassigned, or all literals are assigned
+       and the watched literals have been assigned last on the same decision
        level.
     Furthermore, an index pointing to the literal after the literal assigned
     last is maintained. We start the search for the next unassigned literal
     from this point. This is important to get the amortized linear propagation
     time.
+
+    The literals are never modified and can be shared by the XORs of all
+    threads. They are the slice [begin, end) of an array of literals as
+    returned by util.pack. Only the positions of the watched literals and the
+    index belong to a thread.
     """
-    def __init__(self, literals):
-        assert(len(literals) >= 2)
+    __slots__ = ("__literals", "__begin", "__size", "__watches", "__index")
+
+    def __init__(self, literals, begin=0, end=None):
+        if end is None:
+            end = len(literals)
+        assert(end - begin >= 2)
         self.__literals = literals
+        self.__begin = begin
+        self.__size = end - begin
+        self.__watches = [0, 1]
         self.__index = 2
 
     def __len__(self):
-        return len(self.__literals)
+        return self.__size
 
     def __getitem__(self, idx):
-        return self.__literals[idx]
+        return self.__literals[self.__begin + idx]
 
-    def __setitem__(self, idx, val):
-        self.__literals[idx] = val
-        return val
+    def watched(self, i):
+        """ The i-th watched literal """
+        return self.__literals[self.__begin + self.__watches[i]]
 
-    def propagate(self, assignment, i):
+    def propagate(self, values, i):
         """
         Propagates the given assigned index.
 
-        If an unwatched unassigned literal is found, the literals are
-        rearranged so that the given index points to it. The function returns
-        true if an such a literal is found.
+        If an unwatched unassigned literal is found, the given watch is moved
+        to it. The function returns true if an such a literal is found.
         """
         assert(i < 2)
-        for j in chain(range(self.__index, len(self)), range(2, self.__index)):
-            if assignment.value(self[j]) is None:
-                self.__index = j + 1 if j + 1 < len(self) else 2
-                self[i], self[j] = self[j], self[i]
+        watches = self.__watches
+        for j in chain(range(self.__index, len(self)), range(0, self.__index)):
+            if j != watches[0] and j != watches[1] and not values[self[j]]:
+                self.__index = j + 1 if j + 1 < len(self) else 0
+                watches[i] = j
                 return True
         return False
 
-    def reason(self, assignment, i):
+    def reason(self, values, i):
         """
         If the constraint is unit resulting or conflicting returns a reason in
         form of a clause.
@@ -54,13 +66,13 @@ class XOR:
         # unassigned and has to be propagated or has to be checked for a
         # conflict. In the second case it was assigned on the same level as the
         # propagated literal.
-        i = 1 - i
+        i = self.__watches[1 - i]
         count = 0
         clause = []
         for j in range(len(self)):
             if i == j:
                 continue
-            if assignment.is_true(self[j]):
+            if values[self[j]] == util.TRUE:
                 clause.append(-self[j])
                 count += 1
             else:
@@ -68,27 +80,36 @@ class XOR:
 
         clause.append(-self[i] if count % 2 else self[i])
 
-        return None if assignment.is_true(clause[-1]) else clause
+        return None if values[clause[-1]] == util.TRUE else clause
 
 class UnitPropagator:
-    def __init__(self):
+    def __init__(self, heuristic=0.0, ids=None):
         self.__states  = []
+        self.__values  = []
+        self.__heuristics = []
+        self.__size = 0
         self.__sat = True
         self.__consequences = []
+        self.__ratio = heuristic
+        self.__ids = ids
 
-    def __add_watch(self, ctl, xor, unassigned, thread_ids):
+    def __add_watch(self, xor, unassigned, thread_ids):
         """
         Adds a watch for the for the given index.
 
         The literal at the given index has to be either unassigned or become
         unassigned through backtracking before the associated constraint can
         become unit resulting again.
+
+        The watch lists of a thread are indexed by variable. Variables that
+        were never watched have no list yet.
         """
-        variable = abs(xor[unassigned])
-        ctl.add_watch( variable)
-        ctl.add_watch(-variable)
+        variable = abs(xor.watched(unassigned))
         for thread_id in thread_ids:
-            self.__states[thread_id].setdefault(variable, []).append((xor, unassigned))
+            state = self.__states[thread_id]
+            if state[variable] is None:
+                state[variable] = []
+            state[variable].append((xor, unassigned))
 
     def init(self, init):
         """
@@ -97,19 +118,37 @@ class UnitPropagator:
         Constraints of length zero and one are handled specially, to keep the
         implementation of the general constraints simple.
         """
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append({})
+        ## Start over when solving again, only the watches of the solver stay
+        self.__states  = []
+        self.__values  = []
+        self.__heuristics = []
+        self.__sat = True
+        self.__consequences = []
 
-        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
+        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init), self.__ids)
         if ret is None:
             self.__sat = False
         else:
             constraints, facts = ret
             self.__consequences.extend(facts)
-            for constraint in constraints:
-                xor = XOR(constraint)
-                self.__add_watch(init, xor, 0, range(init.number_of_threads))
-                self.__add_watch(init, xor, 1, range(init.number_of_threads))
+            literals, offsets = util.pack(constraints)
+            if self.__ratio:
+                self.__heuristics = [util.Heuristic(literals, offsets, self.__ratio) for thread_id in range(init.number_of_threads)]
+            ## The mirrors also cover the variables watched in earlier calls
+            self.__size = max([self.__size] + [abs(lit) for lit in literals])
+            variables = self.__size
+            self.__states = [[None] * (variables + 1) for thread_id in range(init.number_of_threads)]
+            for i in range(len(constraints)):
+                for thread_id in range(init.number_of_threads):
+                    xor = XOR(literals, offsets[i], offsets[i+1])
+                    self.__add_watch(xor, 0, (thread_id,))
+                    self.__add_watch(xor, 1, (thread_id,))
+
+            # All variables are watched in the solver to mirror their values
+            for variable in set(abs(lit) for lit in literals):
+                init.add_watch( variable)
+                init.add_watch(-variable)
+            self.__values = [util.values(init.assignment, variables) for thread_id in range(init.number_of_threads)]
 
         init.check_mode = clingo.PropagatorCheckMode.Fixpoint
 
@@ -136,34 +175,59 @@ class UnitPropagator:
         Generated conflicts are guaranteed to be asserting (have at least two
         literals from the current decision level).
         """
+        if not self.__sat:
+            ## Only watches of earlier calls are left
+            return
         state  = self.__states[control.thread_id]
+        values = self.__values[control.thread_id]
+        util.assign(values, changes)
+        if self.__heuristics:
+            self.__heuristics[control.thread_id].assign(changes)
         for literal in changes:
-            variable = abs(literal)
+            watches = state[abs(literal)]
+            if not watches:
+                continue
 
-            state[variable], watches = [], state[variable]
-            assert(len(watches) > 0)
+            # The watches that stay are moved to the front of the list.
+            j = 0
             for i in range(len(watches)):
-                xor, unassigned = watches[i]
-                if xor.propagate(control.assignment, unassigned):
+                watch = watches[i]
+                xor, unassigned = watch
+                if xor.propagate(values, unassigned):
                     # We found an unassigned literal, which is watched next.
-                    self.__add_watch(control, xor, unassigned, (control.thread_id,))
+                    self.__add_watch(xor, unassigned, (control.thread_id,))
                 else:
                     # Here the constraint is either unit, satisfied, or
                     # conflicting. In any case, we can keep the watch because
                     # (*) the current decision level has to be backtracked
                     # before the constraint can become unit again.
-                    state[variable].append((xor, unassigned))
+                    watches[j] = watch
+                    j += 1
 
-                    clause = xor.reason(control.assignment, unassigned)
+                    clause = xor.reason(values, unassigned)
                     if clause is not None:
                         if not control.add_clause(clause) or not control.propagate():
-                            assert(state[variable])
                             # reestablish the remaining watches with the same
                             # reason as in (*)
-                            state[variable].extend(watches[i + 1:])
+                            watches[j:i + 1] = []
                             return
+            del watches[j:]
+
+    def decide(self, thread_id, assignment, fallback):
+        """
+        Branch on the variables of the XOR constraints if a heuristic ratio
+        is set, otherwise keep the decision of the solver.
+        """
+        if not self.__heuristics:
+            return fallback
+        return self.__heuristics[thread_id].decide(self.__values[thread_id], assignment, fallback)
 
-            if len(state[variable]) == 0:
-                control.remove_watch( variable)
-                control.remove_watch(-variable)
-                state.pop(variable)
+    def undo(self, thread_id, assignment, changes):
+        """
+        Unassign the changes in the value mirror of the thread.
+        """
+        if not self.__sat:
+            return
+        util.unassign(self.__values[thread_id], changes)
+        if self.__heuristics:
+            self.__heuristics[thread_id].unassign(changes)
@@ -7,10 +7,18 @@ the nogood and let clasp to propagate again
 
 from . import util
 
-class XOR:
-    def __init__(self, literals):
+class XOR(object):
+    """
+    The literals of a XOR are the slice [begin, end) of an array of literals
+    as returned by util.pack.
+    """
+    __slots__ = ("__literals", "__begin", "__end")
+
+    def __init__(self, literals, begin, end):
         self.__literals = literals
-        
+        self.__begin = begin
+        self.__end = end
+
     def up(self, ass):
         conflict = True
         for lit in self:
@@ -19,32 +27,8 @@ class XOR:
             return [lit if ass.is_true(lit) else -lit for lit in self]
 
     def __iter__(self):
-        return iter(self.__literals)
+        return iter(self.__literals[self.__begin:self.__end])
 
-class UPTotalPropagator:
+class UPTotalPropagator(util.TotalCheck):
     def __init__(self):
-        self.__states = []
-
-    def init(self, init):
-        for thread_id in range(len(self.__states), init.number_of_threads):
-            self.__states.append([])
-
-        ret = util.symbols_to_xor_r(init.symbolic_atoms, util.default_get_lit(init))
-        if ret is None:
-            constraints = [[]]
-        else:
-            constraints, facts = ret
-            constraints.extend([fact] for fact in facts)
-
-        for constraint in constraints:
-            xor = XOR(list(sorted(constraint)))
-            self.__states[thread_id].append(xor)
-
-    def check(self, control):
-        if control.assignment.is_total:
-            state = self.__states[control.thread_id]
-            for xor in state:
-                nogood = xor.up(control.assignment)
-                if nogood is not None:
-                    control.add_nogood(nogood) and control.propagate()
-                    return
+        util.TotalCheck.__init__(self, XOR, XOR.up)
@@ -1,11 +1,13 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from itertools import *
 from functools import *
 import sys
-from textwrap import dedent as _dedent
 from math import log
 from random import randint, sample
+from array import array
+from binascii import hexlify
 from . import gje
+import numpy as np
 
 
 def attrdef(m, a, b):
@@ -42,7 +44,7 @@ class _XORConstraint:
         self.parity = parity
         self.literals = set()
 
-def symbols_to_xor_r(symbolic_atoms, get_lit):
+def symbols_to_xor_r(symbolic_atoms, get_lit, ids=None, name="__parity"):
     """
     Returns None if the constraints are trivially unsatisfiable, otherwise
     returns a list of xor constraints and a list of facts. A xor constraint is
@@ -52,16 +54,22 @@ def symbols_to_xor_r(symbolic_atoms, get_lit):
     symbolic_atoms -- The domain having predicates __parity/2 and __parity/3.
     get_lit        -- Function mapping a symbolic atom to a litral and its
                       truth value.
+    ids            -- The identifiers of the constraints to return, all if
+                      None.
+    name           -- The name of the predicates holding the constraints.
     """
     constraints = {}
     lits = []
-    for atom in symbolic_atoms.by_signature("__parity",2):
+    for atom in symbolic_atoms.by_signature(name,2):
         cid = atom.symbol.arguments[0].number
         par = atom.symbol.arguments[1].name
-        constraints[cid] = _XORConstraint(get_parity(par))
+        if ids is None or cid in ids:
+            constraints[cid] = _XORConstraint(get_parity(par))
 
-    for atom in symbolic_atoms.by_signature("__parity",3):
-        constraint = constraints[atom.symbol.arguments[0].number]
+    for atom in symbolic_atoms.by_signature(name,3):
+        constraint = constraints.get(atom.symbol.arguments[0].number)
+        if constraint is None:
+            continue
         lit, truth = get_lit(atom)
 
         if truth:
@@ -100,242 +108,720 @@ def symbols_to_xor_r(symbolic_atoms, get_lit):
     return result, sorted(facts)
 
 
-def generate_random_xors(prg, files, s, q):
+class Definitions:
     """
-    Of course adding the theory may not be the best way to do it. This is just a hack
-    Using the AST is a better alternative to extract the symbols to build the xor constraints.
-    In the end, we just need the symbols to write a file with random constraints. 
+    Observer recording how the atoms of the ground program are defined.
+
+    An atom that is the head of exactly one normal rule whose body is a single
+    literal, and of no other rule, is equivalent to this literal. This holds
+    for the element atoms of parity constraints with a single literal as
+    condition.
     """
-    for f in files:
-        prg.load(f)
+    def __init__(self):
+        self.__bodies = {}
 
-    prg.add("base", [], _dedent("""\
-      #theory parity { 
-        element {}; 
-        &odd/0 : element, directive; 
-        &even/0 : element, directive }.
-      """))
+    def rule(self, choice, head, body):
+        for atom in head:
+            self.__bodies.setdefault(atom, []).append(body[0] if not choice and len(head) == 1 and len(body) == 1 else None)
 
-    prg.ground([("base", [])])
+    def weight_rule(self, choice, head, lower_bound, body):
+        for atom in head:
+            self.__bodies.setdefault(atom, []).append(None)
 
-    estimated_s = s
-    constraints = []
-    parities = []
-    xors  = ""
-    symbols = [atom.symbol for atom in prg.symbolic_atoms if atom.is_fact is False and "__parity" not in str(atom.symbol)]
-    if len(symbols) > 0:
-        if s == 0:
-            estimated_s = int(log(len(symbols) + 1, 2))
-        print("Random XOR constraints: %s"%estimated_s)
-        for i in range(estimated_s):
-            range_ = int((len(symbols))*q)
-            size = randint(range_, range_)
-            xors = build_theory_atoms(xors, sorted(sample(symbols, size)), randint(0,1))
-
-        file_ = open("examples/__temp_xors.lp","w")
-        file_.write(xors)
-        file_.close()
+    def alias(self, atom):
+        """ The literal the given atom is equivalent to, the atom itself if unknown """
+        bodies = self.__bodies.get(atom)
+        if bodies is None or len(bodies) != 1 or bodies[0] is None:
+            return atom
+        return bodies[0]
+
+def symbols_to_variables(symbolic_atoms, get_lit):
+    """
+    Map the identifier of each parity constraint to the set of variables of
+    its elements that are not fixed.
+    """
+    variables = {}
+    for atom in symbolic_atoms.by_signature("__parity",2):
+        variables[atom.symbol.arguments[0].number] = set()
+    for atom in symbolic_atoms.by_signature("__parity",3):
+        lit, truth = get_lit(atom)
+        if truth is None:
+            variables[atom.symbol.arguments[0].number] ^= {abs(lit)}
+    return variables
+
+def select_approaches(variables, size, overlap):
+    """
+    Split the identifiers of parity constraints with variables as returned by
+    symbols_to_variables into three lists. Groups of at least overlap
+    constraints sharing variables go to the third list for GJE. Of the
+    remaining constraints, those with at most size variables go to the first
+    list to be translated and the others to the second list for unit
+    propagation.
+    """
+    ids = list(variables)
+    constraints = [sorted(variables[cid]) for cid in ids]
+    translated, propagated, eliminated = [], [], []
+    for group in components(constraints, ids):
+        if len(group) >= overlap and variables[group[0]]:
+            eliminated.extend(group)
+            continue
+        for cid in group:
+            (translated if len(variables[cid]) <= size else propagated).append(cid)
+    return translated, propagated, eliminated
+
+def pack(constraints):
+    """
+    Store xor constraints in compressed sparse row form. Returns an array
+    with the literals of all constraints and an array of offsets such that
+    constraint i occupies literals[offsets[i]:offsets[i+1]].
+    """
+    literals = array('i')
+    offsets  = array('i', [0])
+    for constraint in constraints:
+        literals.extend(constraint)
+        offsets.append(len(literals))
+    return literals, offsets
+
+def components(constraints, ids=None):
+    """
+    Split xor constraints in the form of symbols_to_xor_r into groups that do
+    not share variables. The groups are returned in the order of their first
+    constraint. If a list of identifiers of the constraints is given, the
+    groups consist of these identifiers instead of the constraints.
+    """
+    parent = {}
+    def find(var):
+        while parent[var] != var:
+            parent[var] = parent[parent[var]]
+            var = parent[var]
+        return var
+
+    for constraint in constraints:
+        root = None
+        for lit in constraint:
+            var = parent.setdefault(abs(lit), abs(lit))
+            var = find(var)
+            if root is None:
+                root = var
+            elif var != root:
+                parent[var] = root
+
+    groups = {}
+    for i, constraint in enumerate(constraints):
+        key = find(abs(constraint[0])) if constraint else None
+        groups.setdefault(key, []).append(constraint if ids is None else ids[i])
+    return list(groups.values())
+
+def equivalences(constraints, facts):
+    """
+    Replace the variables of binary xor constraints in the form of
+    symbols_to_xor_r by the representative of their equivalence class, which
+    is the smallest variable of the class. Constraints becoming binary by the
+    substitution are merged again.
+
+    Returns None if the constraints are unsatisfiable, otherwise returns the
+    remaining constraints with at least three literals, the facts over the
+    representatives, and the clauses tying each other variable to its
+    representative.
+    """
+    parent = {}
+    def find(var):
+        ## Returns the representative rep and the parity of var xor rep
+        path = []
+        while var in parent:
+            path.append(var)
+            var = parent[var][0]
+        parity = 0
+        for other in reversed(path):
+            parity ^= parent[other][1]
+            parent[other] = (var, parity)
+        return var, parity
+
+    def substitute(constraint):
+        variables, parity = set(), 1
+        for lit in constraint:
+            var, flip = find(abs(lit))
+            variables ^= {var}
+            parity ^= flip ^ (lit < 0)
+        return sorted(variables), parity
+
+    while True:
+        rest = []
+        for constraint in constraints:
+            if len(constraint) != 2:
+                rest.append(constraint)
+                continue
+            (a, pa), (b, pb) = (find(abs(lit)) for lit in constraint)
+            parity = 1 ^ (constraint[0] < 0) ^ (constraint[1] < 0) ^ pa ^ pb
+            if a == b:
+                if parity:
+                    return None
+                continue
+            parent[max(a, b)] = (min(a, b), parity)
+
+        constraints = []
+        for constraint in rest:
+            literals, parity = substitute(constraint)
+            if not literals:
+                if parity:
+                    return None
+                continue
+            if not parity:
+                literals[0] = -literals[0]
+            if len(literals) == 1:
+                facts = list(facts) + literals
+            else:
+                constraints.append(literals)
+        if all(len(constraint) != 2 for constraint in constraints):
+            break
+
+    units = set()
+    for lit in facts:
+        var, parity = find(abs(lit))
+        units.add(var if (lit > 0) != parity else -var)
+    if any(-lit in units for lit in units):
+        return None
+
+    clauses = []
+    for var in sorted(parent):
+        rep, parity = find(var)
+        clauses.append([var, rep] if parity else [-var, rep])
+        clauses.append([-var, -rep] if parity else [var, -rep])
+    return constraints, sorted(units), clauses
+
+TRUE  = 1
+FALSE = 2
+
+def values(assignment, variables):
+    """
+    Mirror the values of the variables 1..variables of the given assignment
+    in a bytearray indexed by literal holding 0 for unassigned literals, TRUE
+    or FALSE. A negative literal indexes from the end of the array, so the
+    value of a literal is a single lookup without calling into the solver.
+
+    The mirror is kept up to date with assign and unassign from the changes
+    passed to propagate and undo.
+    """
+    values = bytearray(2 * variables + 1)
+    for var in range(1, variables + 1):
+        value = assignment.value(var)
+        if value is not None:
+            values[var], values[-var] = (TRUE, FALSE) if value else (FALSE, TRUE)
+    return values
+
+def assign(values, changes):
+    for lit in changes:
+        values[lit] = TRUE
+        values[-lit] = FALSE
+
+def unassign(values, changes):
+    for lit in changes:
+        values[lit] = 0
+        values[-lit] = 0
+
+def masks(values, literals):
+    """
+    Gather the values of a numpy array of literals from a mirror and return
+    the bit masks of the unassigned and of the true literals.
+    """
+    gathered = np.frombuffer(values, dtype=np.uint8)[literals]
+    return _to_bits(gathered == 0), _to_bits(gathered == TRUE)
+
+def _to_bits(mask):
+    ## Pack the reversed mask most significant bit first, the padding ends up
+    ## in the lowest bits
+    if len(mask) == 0:
+        return 0
+    return int(hexlify(np.packbits(mask[::-1]).tobytes()), 16) >> (-len(mask) % 8)
+
+class Verifier:
+    """
+    Checks the parities of all xor constraints packed with pack at once.
+
+    The constraints are kept as the rows of a sparse incidence matrix, whose
+    product with the truth values of the literals modulo 2 yields the
+    parities of all constraints.
+    """
+    def __init__(self, literals, offsets):
+        sizes = np.diff(np.asarray(offsets, dtype=np.intp))
+        self.__literals = np.asarray(literals, dtype=np.intp)
+        self.__rows = np.repeat(np.arange(len(sizes)), sizes)
+        self.__size = len(sizes)
+
+    def violated(self, values, first=False):
+        """
+        Returns the indices of the constraints with an even number of true
+        literals under the given value mirror, only the first one if first is
+        set.
+        """
+        true = np.frombuffer(values, dtype=np.uint8)[self.__literals] == TRUE
+        parities = np.bincount(self.__rows, weights=true, minlength=self.__size).astype(np.intp) & 1
+        violated = np.flatnonzero(parities == 0)
+        return violated[:1].tolist() if first else violated.tolist()
+
+class TotalCheck:
+    """
+    Base of the propagators checking xor constraints only on total
+    assignments.
+
+    Every thread counts the assigned literals of the constraints with
+    Parities, so that detecting a violated constraint costs time in the
+    number of changes. Only then, the Verifier locates all violated
+    constraints in one pass over a mirror of the values, and a nogood is
+    added for each of them. The nogood of a constraint is built by calling
+    reason with the constraint and the assignment.
+
+    Arguments:
+    xor    -- Class wrapping the slice [begin, end) of packed literals.
+    reason -- Function returning the nogood of a violated constraint.
+    """
+    def __init__(self, xor, reason):
+        self.__xor      = xor
+        self.__reason   = reason
+        self.__state    = []
+        self.__parities = []
+        self.__values   = []
+        self.__verifier = None
+        self.__size     = 0
+
+    def init(self, init):
+        """
+        Collects the constraints, which are checked by all threads alike. When
+        solving again, the watches of earlier calls stay, so the mirrors also
+        cover their variables.
+        """
+        ret = symbols_to_xor_r(init.symbolic_atoms, default_get_lit(init))
+        if ret is None:
+            constraints = [[]]
+        else:
+            constraints, facts = ret
+            constraints.extend([fact] for fact in facts)
+
+        literals, offsets = pack(sorted(constraint) for constraint in constraints)
+        self.__state = [self.__xor(literals, offsets[i], offsets[i+1]) for i in range(len(offsets) - 1)]
+
+        occurs = occurrences(literals, offsets)
+        for variable in occurs:
+            init.add_watch( variable)
+            init.add_watch(-variable)
+        self.__size = max([self.__size] + list(occurs))
+        self.__parities = [Parities(occurs, offsets) for thread_id in range(init.number_of_threads)]
+        self.__values = [values(init.assignment, self.__size) for thread_id in range(init.number_of_threads)]
+        self.__verifier = Verifier(literals, offsets)
+
+    def propagate(self, control, changes):
+        self.__parities[control.thread_id].assign(changes)
+        assign(self.__values[control.thread_id], changes)
+
+    def undo(self, thread_id, assignment, changes):
+        self.__parities[thread_id].unassign(changes)
+        unassign(self.__values[thread_id], changes)
+
+    def check(self, control):
+        """
+        On total assignments with a violated constraint, a nogood is added
+        for each violated one.
+        """
+        if control.assignment.is_total and self.__parities[control.thread_id].violated() is not None:
+            for i in self.__verifier.violated(self.__values[control.thread_id]):
+                nogood = self.__reason(self.__state[i], control.assignment)
+                if not control.add_nogood(nogood) or not control.propagate():
+                    return
+
+class Heuristic(object):
+    """
+    Branches on the variables of xor constraints packed with pack for one
+    thread.
+
+    The decision picks the constraint with the fewest unassigned literals and
+    makes its first unassigned literal true if that satisfies the constraint
+    with the other unassigned literals false, and false otherwise. The given
+    ratio of the decisions is made this way, the others are left to the
+    solver.
+
+    Like with Parities, the numbers of unassigned literals are updated from
+    the changes passed to propagate and undo. The constraints are kept in
+    buckets by these numbers, so that picking one costs no pass over all
+    literals.
+    """
+    __slots__ = ("__literals", "__offsets", "__occurs", "__unassigned", "__buckets", "__ratio", "__credit")
+
+    def __init__(self, literals, offsets, ratio):
+        self.__literals   = literals
+        self.__offsets    = offsets
+        self.__occurs     = occurrences(literals, offsets)
+        self.__unassigned = array('i', (offsets[i+1] - offsets[i] for i in range(len(offsets) - 1)))
+        self.__buckets    = [set() for n in range(max(self.__unassigned) + 1 if self.__unassigned else 1)]
+        for i, n in enumerate(self.__unassigned):
+            self.__buckets[n].add(i)
+        self.__ratio      = ratio
+        self.__credit     = 0.0
+
+    def assign(self, changes):
+        occurs, unassigned, buckets = self.__occurs, self.__unassigned, self.__buckets
+        for lit in changes:
+            for i, xlit in occurs.get(abs(lit), ()):
+                buckets[unassigned[i]].remove(i)
+                unassigned[i] -= 1
+                buckets[unassigned[i]].add(i)
+
+    def unassign(self, changes):
+        occurs, unassigned, buckets = self.__occurs, self.__unassigned, self.__buckets
+        for lit in changes:
+            for i, xlit in occurs.get(abs(lit), ()):
+                buckets[unassigned[i]].remove(i)
+                unassigned[i] += 1
+                buckets[unassigned[i]].add(i)
+
+    def branch(self, values):
+        """
+        Returns the literal to branch on under the given value mirror or None
+        if all constraints are assigned.
+        """
+        for bucket in self.__buckets[1:]:
+            if bucket:
+                i = next(iter(bucket))
+                break
+        else:
+            return None
+        row = self.__literals[self.__offsets[i]:self.__offsets[i+1]]
+        lit = next(lit for lit in row if not values[lit])
+        return -lit if sum(1 for xlit in row if values[xlit] == TRUE) % 2 else lit
+
+    def decide(self, values, assignment, fallback):
+        """
+        Implements the decide callback of a propagator.
+        """
+        self.__credit += self.__ratio
+        if self.__credit < 1:
+            return fallback
+        self.__credit -= 1
+        lit = self.branch(values)
+        return fallback if lit is None or not assignment.is_free(lit) else lit
+
+class Cache:
+    """
+    Bounded set of the nogoods a thread added recently, with least recently
+    used eviction.
+
+    A nogood added before is either still known to the solver, which then
+    propagates it before the propagator sees it again, or it was deleted. So
+    a repeated nogood is only added again if it is unit or conflicting, and
+    skipped if one of its literals is false.
+    """
+    def __init__(self, size=1024):
+        self.__nogoods = OrderedDict()
+        self.__size    = size
+        self.__lookups = 0
+        self.__hits    = 0
+
+    def skip(self, assignment, nogood):
+        """
+        Record the nogood and return whether it can be skipped given the
+        assignment of the solver. The value mirror of a thread may lag behind
+        literals the solver assigned during the current propagation.
+        """
+        self.__lookups += 1
+        key = frozenset(nogood)
+        nogoods = self.__nogoods
+        if key in nogoods:
+            nogoods[key] = nogoods.pop(key)
+            if any(assignment.is_false(lit) for lit in nogood):
+                self.__hits += 1
+                return True
+            return False
+        nogoods[key] = None
+        if len(nogoods) > self.__size:
+            nogoods.popitem(last=False)
+        return False
+
+    def lookups(self):
+        return self.__lookups
+
+    def hits(self):
+        return self.__hits
+
+def cache_statistics(caches):
+    """ Accumulated lookups, hits, and hit rate of the given caches """
+    lookups = sum(cache.lookups() for cache in caches)
+    hits    = sum(cache.hits() for cache in caches)
+    return {"lookups": lookups, "hits": hits, "hit rate": float(hits) / lookups if lookups else 0.0}
+
+def occurrences(literals, offsets):
+    """
+    Map each variable of xor constraints packed with pack to the list of
+    pairs of constraint index and the literal of the variable in it.
+    """
+    occurs = {}
+    for i in range(len(offsets) - 1):
+        for lit in literals[offsets[i]:offsets[i+1]]:
+            occurs.setdefault(abs(lit), []).append((i, lit))
+    return occurs
+
+class Parities(object):
+    """
+    Running parities and numbers of unassigned literals of packed xor
+    constraints for one thread.
+
+    The counters are updated from the changes passed to propagate and undo.
+    Changes of variables not occurring in any constraint are ignored, they
+    stem from watches of earlier solve calls. Constraints becoming fully
+    assigned are recorded, so that checking them only costs time in the
+    number of changes and not in the total number of literals.
+    """
+    __slots__ = ("__occurs", "__unassigned", "__parity", "__full")
+
+    def __init__(self, occurs, offsets):
+        self.__occurs = occurs
+        self.__unassigned = array('i', (offsets[i+1] - offsets[i] for i in range(len(offsets) - 1)))
+        self.__parity = bytearray(len(self.__unassigned))
+        self.__full = set(i for i, n in enumerate(self.__unassigned) if n == 0)
+
+    def assign(self, changes):
+        occurs, unassigned, parity, full = self.__occurs, self.__unassigned, self.__parity, self.__full
+        for lit in changes:
+            for i, xlit in occurs.get(abs(lit), ()):
+                unassigned[i] -= 1
+                if xlit == lit:
+                    parity[i] ^= 1
+                if not unassigned[i]:
+                    full.add(i)
+
+    def unassign(self, changes):
+        occurs, unassigned, parity = self.__occurs, self.__unassigned, self.__parity
+        for lit in changes:
+            for i, xlit in occurs.get(abs(lit), ()):
+                unassigned[i] += 1
+                if xlit == lit:
+                    parity[i] ^= 1
+
+    def violated(self):
+        """
+        Returns the index of a constraint that became fully assigned with an
+        even number of true literals or None. Such a constraint stays
+        recorded until it is no longer fully assigned or satisfied.
+        """
+        full = self.__full
+        while full:
+            i = full.pop()
+            if not self.__unassigned[i] and not self.__parity[i]:
+                full.add(i)
+                return i
+        return None
+
+
+class XORs(object):
+    """
+    XOR constraints over interned variables for the preprocessing passes.
+
+    Variables are numbered from 0 in the order their names are interned. A
+    name is a positive program literal or the name of an auxiliary atom. The
+    constraints are packed like with pack: constraint i consists of the
+    variables variables[offsets[i]:offsets[i+1]] and has parity parities[i].
+    Signs of literals are folded into the parities.
+    """
+    __slots__ = ("names", "index", "variables", "offsets", "parities")
+
+    def __init__(self, names=None, index=None):
+        self.names     = [] if names is None else names
+        self.index     = {} if index is None else index
+        self.variables = array('i')
+        self.offsets   = array('i', [0])
+        self.parities  = bytearray()
+
+    def __len__(self):
+        return len(self.parities)
+
+    def __getitem__(self, i):
+        return self.variables[self.offsets[i]:self.offsets[i+1]], self.parities[i]
+
+    def intern(self, name):
+        """ The variable with the given name """
+        var = self.index.get(name)
+        if var is None:
+            var = self.index[name] = len(self.names)
+            self.names.append(name)
+        return var
+
+    def add(self, variables, parity):
+        self.variables.extend(variables)
+        self.offsets.append(len(self.variables))
+        self.parities.append(parity & 1)
+
+    def add_literals(self, literals, parity):
+        """ Add a constraint over signed program literals """
+        for lit in literals:
+            if lit < 0:
+                parity ^= 1
+        self.add(sorted(self.intern(abs(lit)) for lit in literals), parity)
+
+    def empty(self):
+        """ An empty system over the same variables """
+        return XORs(self.names, self.index)
+
+    def theory_atoms(self, symbols):
+        """
+        The constraints as theory atoms, where symbols maps program literals
+        to the strings of their atoms.
+        """
+        out = ""
+        for i in range(len(self)):
+            variables, parity = self[i]
+            out = build_theory_atoms(out, [symbols.get(self.names[var], self.names[var]) for var in variables], parity)
+        return out
+
+
+def xor_r_to_xors(ret):
+    """
+    Intern the result of symbols_to_xor_r. Facts become constraints with one
+    variable and a trivially unsatisfiable result becomes the empty
+    constraint with odd parity.
+    """
+    xors = XORs()
+    if ret is None:
+        xors.add([], 1)
+        return xors
+    constraints, facts = ret
+    for constraint in constraints:
+        xors.add_literals(constraint, 1)
+    for fact in facts:
+        xors.add_literals([fact], 1)
     return xors
 
 
-def get_xors(prg, files):
-    """
-    Get XORs from encoding(s)/instance(s)
-    """
-
-    ## Load files
-    for f in files:
-        prg.load(f)
-
-    ## Theory is added when Random XORs are built.
-    ## So, if not sampling, theory must be added here.
-    ## This must be substitute by using the AST        
-    prg.add("base", [], _dedent("""\
-    #theory parity { 
-    element {}; 
-    &odd/0 : element, directive; 
-    &even/0 : element, directive }.
-    """))
-
-    prg.ground([("base", [])])
-
-    ## Get XORS
-    all_lits       = []
-    xors_parities  = []
-    xors_lits      = []
-
-    for atom in prg.theory_atoms:
-        xors_parities.append(get_parity(atom.term))
-        lits = []
-        
-        for e in atom.elements:
-            element_str = str(e)
-            condition = element_str.split(':')[-1]
-            if "not " in condition:
-                condition = condition.replace("not ", '')
-            lits.append(condition)
-            if condition not in all_lits:
-                all_lits.append(condition)
-            
-            
-            #if len(e.terms) == 2:
-            #    lits.append(str(e.terms[1]))
-            #    if str(e.terms[1]) not in all_lits:
-            #        all_lits.append(str(e.terms[1]))
-            #else:
-            #    lits.append(str(e.terms[0]))
-            #    if str(e.terms[0]) not in all_lits:
-            #        all_lits.append(str(e.terms[0]))
-        xors_lits.append(lits)
-
-    return xors_lits, xors_parities, all_lits
-
-
-def split_x(data, _split, prev):
-    _aux_prefix   = "__aux"
-    start = prev
-    
+def random_parities(xors, variables, s, q):
+    """
+    Add s random XOR constraints with a ratio q of the given program literals.
+    If s is 0, it is estimated from the number of literals.
+    """
+    if len(variables) > 0:
+        if s == 0:
+            s = int(log(len(variables) + 1, 2))
+        print("Random XOR constraints: %s"%s)
+        for i in range(s):
+            xors.add_literals(sample(variables, int(len(variables)*q)), randint(0,1))
+
+
+def parities_to_program(xors, symbols, add_rules, name="__parity"):
+    """
+    Build the ground rules of the given XOR constraints like the ones rewritten
+    from theory atoms, followed by the additional rules, e.g. choices for
+    split. Program literals are mapped to atoms using symbols, auxiliary
+    variables are named by their atoms already.
+    """
+    rules = []
+    for i in range(len(xors)):
+        variables, parity = xors[i]
+        par = get_str_parity(parity)
+        rules.append("%s(%s,%s)."%(name, i, par))
+        for k, var in enumerate(variables):
+            rules.append("%s(%s,%s,(%s,)) :- %s."%(name, i, par, k, symbols.get(xors.names[var], xors.names[var])))
+    return "\n".join(rules + list(add_rules))
+
+
+def split_x(data, _split, fresh):
+    """
+    Cut the variables of a XOR constraint into sub XORs with at most _split
+    variables chained by auxiliary variables obtained from fresh. The first
+    sub XOR keeps the parity, the others are even. Returns the sub XORs and
+    the auxiliary variables.
+    """
     # Slice the first sub_xor of size "_split" -1
-    base_xor = data[:(_split-1)]
+    base_xor = list(data[:(_split-1)])
     rest_xor = data[(_split-1):]
 
     # Slice the rest chunk from the original xor of size "_split" -2
-    xor_chunks = [rest_xor[x:x+(_split-2)] for x in range(0, len(rest_xor), _split-2)]
+    xor_chunks = [list(rest_xor[x:x+(_split-2)]) for x in range(0, len(rest_xor), _split-2)]
     # If the last chunk is of size 1, do not add an aux variable and insert this last element in a previous chunk if exist
     if len(xor_chunks) > 1 and len(xor_chunks[-1]) == 1:
-        last = xor_chunks[-1]
-        xor_chunks[-2].append(last[0])
-        del xor_chunks[-1]
-
-    # Add the prev and the following aux variables
-    for i in range(len(xor_chunks)-1):
-        xor_chunks[i].append("%s_%s"%(_aux_prefix, prev+1))
-        xor_chunks[i].insert(0, "%s_%s"%(_aux_prefix, prev))
-        prev += 1
-
-    # Add first aux variable in base_xor
-    xor_chunks.insert(0, base_xor)
-    xor_chunks[0].insert(_split-1, "%s_%s"%(_aux_prefix, start))
-
-    # Add the last aux variable in the last sub xor
-    xor_chunks[-1].insert(0, "%s_%s"%(_aux_prefix, prev))
+        xor_chunks[-2].append(xor_chunks.pop()[0])
 
-    # Build the choice rule of aux variables
-    _auxs = []
-    
-    for i in range(start,prev+1):
-        _auxs.append("%s_%s"%(_aux_prefix, i))
+    # Each chunk starts with the aux variable of the previous sub xor and
+    # all but the last end in the aux variable of the next one
+    auxs = [fresh() for chunk in xor_chunks]
+    base_xor.append(auxs[0])
+    for i, chunk in enumerate(xor_chunks):
+        chunk.insert(0, auxs[i])
+        if i + 1 < len(xor_chunks):
+            chunk.append(auxs[i+1])
 
-    # Parse string of the choice rule
-    terms = " ; ".join(str(x) for x in _auxs)
-    choice_rule = "{ %s }. "%(terms)
+    return [base_xor] + xor_chunks, auxs
 
-    return xor_chunks, choice_rule, prev
-    
 
-def split(xors, parities, split, display):
+def split(xors, split, display):
     """
-    Split XORs
+    Split XORs with more than split variables. Returns the resulting XORs,
+    the choice rules of the auxiliary atoms, and whether a XOR was split.
     """
-    choice_rule = ""
-    sub_pars = []
-    splitted_xors = []
-    splitted_pars = []
-    aux_index = 0
+    splitted_xors = xors.empty()
     choices = []
-    splitted = False
-    
+    aux_index = [0]
+    def fresh():
+        aux_index[0] += 1
+        return splitted_xors.intern("__aux_%s"%aux_index[0])
+
     ## If len of xor is less or equal the split value, do not split
     for i in range(len(xors)):
-        if len(xors[i]) <= split:
+        variables, parity = xors[i]
+        if len(variables) <= split:
             if display:
                 print("XOR %s not splitted. XOR size is less than the split value"%(i+1))
-            splitted_xors.append(xors[i])
-            splitted_pars.append(parities[i])
-            choice_rule = None
+            splitted_xors.add(variables, parity)
         else:
             if display:
                 print("Splitting XOR %s"%(i+1))
-            splitted = True
-            sub_xors, choice_rule, aux_index = split_x(xors[i], split, aux_index+1)
-            choices.append(choice_rule)
-            sub_pars = [0] * len(sub_xors)
-            sub_pars[0] = parities[i]
-
-            for i in range(len(sub_xors)):
-                splitted_xors.append(sub_xors[i])
-                splitted_pars.append(sub_pars[i])
+            sub_xors, auxs = split_x(variables, split, fresh)
+            choices.append("{ %s }. "%" ; ".join(splitted_xors.names[aux] for aux in auxs))
+            for j, sub_xor in enumerate(sub_xors):
+                splitted_xors.add(sub_xor, parity if j == 0 else 0)
 
-    return splitted_xors, splitted_pars, choices, splitted
+    return splitted_xors, choices, len(choices) > 0
 
 
-def pre_gje(xors_lits, xors_parities, all_lits, show):
-    # If exist more than one constraint
+def pre_gje(xors, show, density=0.05):
     """
-    xors_lits = [['a','c','d','f'],
-                 ['c','d','e','f']]
-    xors_pars = [1, 0]
-    all_lits  = ['a','b','c','d','e','f','g','h']
+    Eliminate the given XORs and return the reduced XORs over the same
+    variables, which are the columns of the matrix.
+
+    Systems with a ratio of nonzeros below the given density are eliminated
+    on a sparse matrix whose cost scales with the nonzeros instead of the
+    rows x columns of the dense matrix.
     """
+    columns = len(xors.names)
+    reduced = xors.empty()
+    if len(xors.variables) < density * len(xors) * columns:
+        matrix = gje.SparseMatrix((xors[i][0] for i in range(len(xors))), xors.parities)
+        if show:
+            print("Initial Sparse Matrix")
+            matrix.print_matrix()
+        matrix.eliminate()
+        if show:
+            print("Reduced Sparse Matrix")
+            matrix.print_matrix()
+
+        for cols, parity in matrix:
+            reduced.add(cols, parity)
+        return reduced
 
     # Build Matrix
-    matrix = []
-    for i in range(len(xors_parities)):
-        row = []
-        for lit in all_lits:
-            if lit in xors_lits[i]:
-                row.append(1)
-            else:
-                row.append(0)
-        row.append(xors_parities[i])
-        matrix.append(row)
+    rows = []
+    for i in range(len(xors)):
+        row = 0
+        for col in xors[i][0]:
+            row ^= 1 << col
+        if xors.parities[i]:
+            row |= 1 << columns
+        rows.append(row)
+    matrix = gje.BitMatrix(rows, columns)
 
     if show:
         print("Initial Matrix")
-        gje.print_matrix(matrix)
-    matrix = gje.perform_gauss_jordan_elimination(matrix, False)
+        matrix.print_matrix()
+    matrix.eliminate()
     if show:
         print("Reduced Matrix")
-        gje.print_matrix(matrix)
+        matrix.print_matrix()
 
-    updated_xors, updated_pars = [], []
     for row in matrix:
-        updated_row = []
-        for i in range(len(row)-1):
-            if row[i] == 1:
-                updated_row.append(all_lits[i])
-        updated_pars.append(row[-1])
-        updated_xors.append(updated_row)
-
-    return updated_xors, updated_pars
-
-
-def write_file(fname, files, xors, add_rules):
-    """
-    Rewrite input files with preprocessed parity constraints
-    """
-    ## Create temp file
-    file_ = open(fname, 'w')
-
-    ## Get lines
-    lines = list(chain.from_iterable(open(f) for f in files))
-
-    ## Write lines excluding theory atoms
-    for i in range(len(lines)):
-        if "odd{" not in str(lines[i]) and "even{" not in str(lines[i]):
-            file_.write("%s"%lines[i])
-
-    ## Write XORs
-    file_.write("%s"%xors)
-
-    ## Write additional rules. e.g. choices for split
-    for rule in add_rules:
-        file_.write("%s"%rule)
-        
-    ## Close file
-    file_.close()
-
-    ## Update files list
-    files = [fname]
-    
-    return files
+        reduced.add(gje.bits(row & (matrix.parity_bit() - 1)), row >> columns)
+    return reduced